@@ -1,12 +1,111 @@
+from typing import List
+from typing import Optional
+
+import re
 import json
 import datetime
 
+from src.common import rollups
+from src.common import soundprintutils
 
-def handler(event, context):
-    data = {
-        'output': 'Hello World',
-        'timestamp': datetime.datetime.utcnow().isoformat()
-    }
-    return {'statusCode': 200,
+DEFAULT_GRANULARITY = rollups.GRANULARITY_DAY
+DEFAULT_GROUP_BY = rollups.GROUP_BY_TOTAL
+DEFAULT_RANGE = datetime.timedelta(days=7)
+
+# Callers are authenticated by the Cognito authorizer of the API, which passes the claims of their verified ID token.
+# Members of OWNER_GROUP read the stats of the original account, and other callers those of the listener whose
+# user-id is in their USER_ID_CLAIM, an attribute only administrators can set.
+OWNER_GROUP = 'soundprint-owner'
+GROUPS_CLAIM = 'cognito:groups'
+USER_ID_CLAIM = 'custom:soundprint_user_id'
+
+
+def parse_datetime(value: str) -> datetime.datetime:
+    """
+    Parses an ISO-8601 date or datetime query parameter as UTC, unless it has its own offset. A trailing Z, which
+    datetime.fromisoformat only accepts from Python 3.11, is read as the +00:00 offset.
+    """
+    if value.endswith(('Z', 'z')):
+        value = f"{value[:-1]}+00:00"
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def parse_groups(groups_claim) -> List[str]:
+    """
+    Returns the groups of a cognito:groups claim, which API Gateway passes as a list or as a string of the groups
+    separated by commas or spaces, possibly in brackets
+    """
+    if isinstance(groups_claim, list):
+        return groups_claim
+    return [group for group in re.split(r"[\s,]+", str(groups_claim or '').strip('[]')) if group]
+
+
+def get_authorized_user_id(event: dict) -> Optional[str]:
+    """
+    Returns the user-id of the listener whose stats the caller may read, from the claims of their ID token: None for
+    the original account if the caller is a member of OWNER_GROUP, else the user-id of their USER_ID_CLAIM
+    :raises PermissionError: If the caller is not linked to any listener
+    """
+    claims = ((event.get('requestContext') or {}).get('authorizer') or {}).get('claims') or {}
+    if OWNER_GROUP in parse_groups(claims.get(GROUPS_CLAIM)):
+        return None
+    user_id = claims.get(USER_ID_CLAIM)
+    if not user_id:
+        raise PermissionError('Caller is not linked to a listener')
+    try:
+        return soundprintutils.validate_user_id(user_id)
+    except ValueError:
+        raise PermissionError('Caller is not linked to a valid listener')
+
+
+def build_response(status_code: int, data: dict) -> dict:
+    return {'statusCode': status_code,
             'body': json.dumps(data),
             'headers': {'Content-Type': 'application/json'}}
+
+
+def handler(event, context):
+    """
+    API handler for querying listening stats, served from the listening rollups maintained by the archiver (see
+    src/common/rollups.py) rather than from the Aurora history tables. Serves the stats of the listener linked to the
+    authenticated caller (see get_authorized_user_id). Accepts the following query-string parameters:
+    granularity: <hour, day or week, by default day>
+    group_by: <total, track, album, artist or genre, by default total>
+    start, end: <ISO-8601 dates or datetimes of the time-range, in UTC unless an offset is given, by default the last
+                 week>
+    limit: <maximum number of groups per time bucket, those listened to the longest>
+    :return: listened minutes, play counts and average audio-features of every group in every time bucket of the range
+    """
+    event = event or {}
+    try:
+        user_id = get_authorized_user_id(event)
+    except PermissionError as pe:
+        return build_response(403, {'error': str(pe)})
+
+    parameters = event.get('queryStringParameters') or {}
+    try:
+        granularity = parameters.get('granularity', DEFAULT_GRANULARITY)
+        group_by = parameters.get('group_by', DEFAULT_GROUP_BY)
+        end_dt = parse_datetime(parameters['end']) if 'end' in parameters else \
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        start_dt = parse_datetime(parameters['start']) if 'start' in parameters else end_dt - DEFAULT_RANGE
+        limit = int(parameters['limit']) if 'limit' in parameters else None
+        if start_dt > end_dt:
+            raise ValueError(f"Start of the time-range is after its end: {start_dt.isoformat()}")
+        if limit is not None and limit < 1:
+            raise ValueError(f"Invalid limit: {limit}")
+
+        buckets = rollups.query_rollups(granularity, group_by, start_dt, end_dt, user_id, limit)
+    except ValueError as ve:
+        return build_response(400, {'error': str(ve)})
+
+    return build_response(200, {
+        'granularity': granularity,
+        'groupBy': group_by,
+        'start': start_dt.isoformat(),
+        'end': end_dt.isoformat(),
+        'buckets': buckets,
+    })
@@ -11,6 +11,11 @@ class AlbumerCommon:
     RELEASE_DATE = ('ALBUM_RELEASE_DATE', float)
     TOTAL_TRACKS = ('ALBUM_TRACK_COUNT', int)
 
-    SCHEMA = [ALBUM_ID[0], NAME[0], TYPE[0], GENRE[0], RELEASE_DATE[0], LABEL[0], TOTAL_TRACKS[0], POPULARITY[0]]
+    TYPED_SCHEMA = [ALBUM_ID, NAME, TYPE, GENRE, RELEASE_DATE, LABEL, TOTAL_TRACKS, POPULARITY]
+
+    SCHEMA = list(map(lambda ts: ts[0], TYPED_SCHEMA))
+
+    # Fields that change over time and have to be refreshed periodically when cached
+    VOLATILE_SCHEMA = [POPULARITY[0]]
 
     FILE_PATH_PREFIX = 'history/albums/'
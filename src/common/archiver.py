@@ -0,0 +1,74 @@
+from src.common.listener import ListenerCommon
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+
+
+# Tables of the normalized (star-schema) archive layout: a plays fact table, with a dimension table for each of
+# tracks, albums and artists, and bridge tables for the multi-valued track-artists, album-genres and artist-genres.
+# Each table defines its typed schema, primary key, and secondary indexes as index-name -> indexed fields.
+
+class PlaysTable:
+    NAME = 'soundprintplays'
+    TYPED_SCHEMA = [ListenerCommon.TIMESTAMP, ListenerCommon.TRACK_ID, ListenerCommon.LISTENED_TIME]
+    PRIMARY_KEY = [ListenerCommon.TIMESTAMP, ListenerCommon.TRACK_ID]
+    INDEXES = {'plays_track_idx': [ListenerCommon.TRACK_ID, ListenerCommon.TIMESTAMP]}
+
+
+class TracksTable:
+    NAME = 'soundprinttracks'
+    TYPED_SCHEMA = [ts for ts in TrackerCommon.TYPED_SCHEMA if ts != TrackerCommon.ARTIST_ID]
+    PRIMARY_KEY = [TrackerCommon.TRACK_ID]
+    INDEXES = {'tracks_album_idx': [TrackerCommon.ALBUM_ID]}
+
+
+class TrackArtistsTable:
+    NAME = 'soundprinttrackartists'
+    TYPED_SCHEMA = [TrackerCommon.TRACK_ID, TrackerCommon.ARTIST_ID]
+    PRIMARY_KEY = [TrackerCommon.TRACK_ID, TrackerCommon.ARTIST_ID]
+    INDEXES = {'trackartists_artist_idx': [TrackerCommon.ARTIST_ID]}
+
+
+class AlbumsTable:
+    NAME = 'soundprintalbums'
+    TYPED_SCHEMA = [ts for ts in AlbumerCommon.TYPED_SCHEMA if ts != AlbumerCommon.GENRE]
+    PRIMARY_KEY = [AlbumerCommon.ALBUM_ID]
+    INDEXES = {}
+
+
+class AlbumGenresTable:
+    NAME = 'soundprintalbumgenres'
+    TYPED_SCHEMA = [AlbumerCommon.ALBUM_ID, AlbumerCommon.GENRE]
+    PRIMARY_KEY = [AlbumerCommon.ALBUM_ID, AlbumerCommon.GENRE]
+    INDEXES = {'albumgenres_genre_idx': [AlbumerCommon.GENRE]}
+
+
+class ArtistsTable:
+    NAME = 'soundprintartists'
+    TYPED_SCHEMA = [ts for ts in ArtisterCommon.TYPED_SCHEMA if ts != ArtisterCommon.ARTIST_GENRE]
+    PRIMARY_KEY = [ArtisterCommon.ARTIST_ID]
+    INDEXES = {}
+
+
+class ArtistGenresTable:
+    NAME = 'soundprintartistgenres'
+    TYPED_SCHEMA = [ArtisterCommon.ARTIST_ID, ArtisterCommon.ARTIST_GENRE]
+    PRIMARY_KEY = [ArtisterCommon.ARTIST_ID, ArtisterCommon.ARTIST_GENRE]
+    INDEXES = {'artistgenres_genre_idx': [ArtisterCommon.ARTIST_GENRE]}
+
+
+class ArchiverCommon:
+    LAYOUT_WIDE = 'wide'
+    LAYOUT_STAR = 'star'
+
+    # Dimension and bridge tables are upserted only for rows that changed; the plays table is always upserted
+    DIMENSION_TABLES = [TracksTable, TrackArtistsTable, AlbumsTable, AlbumGenresTable, ArtistsTable, ArtistGenresTable]
+    FACT_TABLES = [PlaysTable]
+    STAR_TABLES = FACT_TABLES + DIMENSION_TABLES
+
+    # Spotify ids are 22 characters long, so id columns are stored narrower than other string columns
+    COLUMN_SQL_TYPES = {
+        TrackerCommon.TRACK_ID[0]: 'VARCHAR(32)',
+        TrackerCommon.ALBUM_ID[0]: 'VARCHAR(32)',
+        TrackerCommon.ARTIST_ID[0]: 'VARCHAR(32)',
+    }
@@ -7,6 +7,11 @@ class ArtisterCommon:
     ARTIST_GENRE = ('ARTIST_GENRE', str)
     ARTIST_POPULARITY = ('ARTIST_POPULARITY', int)
 
-    SCHEMA = [ARTIST_ID[0], ARTIST_NAME[0], ARTIST_GENRE[0], ARTIST_POPULARITY[0]]
+    TYPED_SCHEMA = [ARTIST_ID, ARTIST_NAME, ARTIST_GENRE, ARTIST_POPULARITY]
+
+    SCHEMA = list(map(lambda ts: ts[0], TYPED_SCHEMA))
+
+    # Fields that change over time and have to be refreshed periodically when cached
+    VOLATILE_SCHEMA = [ARTIST_POPULARITY[0]]
 
     FILE_PATH_PREFIX = 'history/artists/'
@@ -0,0 +1,91 @@
+from typing import Dict
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Registry of the AWS clients and resources shared by all the calls of a Lambda, and by its warm invocations, so that
+# endpoints are resolved and connections are opened once rather than on every call. Connections are pooled, with
+# enough connections for the concurrent requests of the stages, and reused by warm invocations.
+MAX_POOL_CONNECTIONS = int(os.environ.get('SOUNDPRINT_AWS_MAX_POOL_CONNECTIONS', 32))
+
+# Client config of particular clients, on top of the shared connection config. Clients are named after their AWS
+# service, unless they are variants of a service's client with their own config (see CLIENT_SERVICES).
+SERVICE_CONFIGS: Dict[str, dict] = {
+    # Retry the requests sent while the Aurora serverless cluster is waking up, rather than failing the archiver
+    'rds-data': {'retries': {'max_attempts': 10, 'mode': 'standard'}},
+    # Send the request that triggers the wake-up of the cluster once, without waiting for the cluster to answer
+    'rds-data-wakeup': {'connect_timeout': 2, 'read_timeout': 1, 'retries': {'total_max_attempts': 1}},
+}
+
+# AWS service of each variant client
+CLIENT_SERVICES: Dict[str, str] = {
+    'rds-data-wakeup': 'rds-data',
+}
+
+CLIENTS = {}
+REGISTRY_LOCK = threading.Lock()
+
+# Resources of each thread by service name, dropped with the thread. Resources created before the registry was last
+# cleared are from an older generation, and are created again on their thread's next call.
+THREAD_RESOURCES = threading.local()
+RESOURCES_GENERATION = 0
+
+
+def get_config(client_name: str) -> Config:
+    """
+    Returns the config of a client: the shared connection config, merged with the client's own
+    """
+    config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+    return config.merge(Config(**SERVICE_CONFIGS[client_name])) if client_name in SERVICE_CONFIGS else config
+
+
+def get_client(client_name: str):
+    """
+    Returns the shared boto3 client of an AWS service, or of a variant of it (see CLIENT_SERVICES), creating it on
+    first use. Clients are thread-safe, so a single client of each name is shared by all threads.
+    """
+    client = CLIENTS.get(client_name)
+    if client is None:
+        with REGISTRY_LOCK:
+            client = CLIENTS.get(client_name)
+            if client is None:
+                client = CLIENTS[client_name] = boto3.client(CLIENT_SERVICES.get(client_name, client_name),
+                                                             config=get_config(client_name))
+    return client
+
+
+def get_resource(service_name: str):
+    """
+    Returns the boto3 resource of an AWS service for the current thread, creating it on first use. Resources are not
+    thread-safe, so each thread has its own, reused by later calls on the thread.
+    """
+    if getattr(THREAD_RESOURCES, 'generation', None) != RESOURCES_GENERATION:
+        THREAD_RESOURCES.generation = RESOURCES_GENERATION
+        THREAD_RESOURCES.resources = {}
+    resource = THREAD_RESOURCES.resources.get(service_name)
+    if resource is None:
+        # boto3's default session is not thread-safe, so resources are created one at a time
+        with REGISTRY_LOCK:
+            resource = THREAD_RESOURCES.resources[service_name] = boto3.resource(service_name,
+                                                                                 config=get_config(service_name))
+    return resource
+
+
+def get_dynamodb_table(table_name: str):
+    """
+    Returns the DynamoDB table of the given name, of the current thread's DynamoDB resource
+    """
+    return get_resource('dynamodb').Table(table_name)
+
+
+def clear():
+    """
+    Drops all the registered clients and resources, so that the next calls create new ones, e.g. after boto3 has
+    been patched
+    """
+    global RESOURCES_GENERATION
+    with REGISTRY_LOCK:
+        CLIENTS.clear()
+        RESOURCES_GENERATION += 1
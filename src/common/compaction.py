@@ -0,0 +1,126 @@
+from typing import List
+from typing import Optional
+
+import json
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from src.common import soundprintutils
+from src.common.joiner import JoinerCommon
+
+
+class CompactionCommon:
+    # Compacted history is kept outside of history/, so it is not expired by the bucket's lifecycle policy. The rows
+    # of each day's plays are kept in one Parquet file, partitioned by the UTC date they were played at:
+    # compacted/data/[users/<user-id>/]year=<YYYY>/month=<MM>/day=<DD>/plays.parquet
+    FILE_PATH_PREFIX = 'compacted/data/'
+    PARTITION_FILE_NAME = 'plays.parquet'
+
+    # Each user's manifest lists their partitions, by partition date (YYYY-MM-DD), with the partition's file name,
+    # min/max play timestamps, and row and play counts
+    MANIFEST_FILE_NAME = 'manifest.json'
+    MANIFEST_PARTITIONS_KEY = 'partitions'
+    FILE_NAME_KEY = 'fileName'
+    MIN_TIMESTAMP_KEY = 'minTimestamp'
+    MAX_TIMESTAMP_KEY = 'maxTimestamp'
+    ROW_COUNT_KEY = 'rowCount'
+    PLAY_COUNT_KEY = 'playCount'
+
+    # Fields identifying a row of the wide layout, by which rows compacted more than once are de-duplicated
+    ROW_KEY = [JoinerCommon.LISTEN_TIMESTAMP, JoinerCommon.TRACK_ID, JoinerCommon.ALBUM_ID, JoinerCommon.ALBUM_GENRE,
+               JoinerCommon.ARTIST_ID, JoinerCommon.ARTIST_GENRE]
+
+    TYPED_SCHEMA = JoinerCommon.TYPED_SCHEMA
+    SCHEMA = JoinerCommon.SCHEMA
+
+
+def get_partition_file_name(partition_date: str, user_id: Optional[str] = None) -> str:
+    """
+    Returns the S3 file name of the partition of the given date (YYYY-MM-DD) of a user
+    """
+    year, month, day = partition_date.split('-')
+    file_path_prefix = soundprintutils.get_user_file_path_prefix(CompactionCommon.FILE_PATH_PREFIX, user_id)
+    return f"{file_path_prefix}year={year}/month={month}/day={day}/{CompactionCommon.PARTITION_FILE_NAME}"
+
+
+def get_manifest_file_name(user_id: Optional[str] = None) -> str:
+    """
+    Returns the S3 file name of the partition manifest of a user
+    """
+    file_path_prefix = soundprintutils.get_user_file_path_prefix(CompactionCommon.FILE_PATH_PREFIX, user_id)
+    return f"{file_path_prefix}{CompactionCommon.MANIFEST_FILE_NAME}"
+
+
+def get_partition_dates(timestamps: pd.Series) -> pd.Series:
+    """
+    Returns the partition date (YYYY-MM-DD) of each epoch timestamp in seconds, i.e. the UTC date it falls on
+    """
+    return pd.to_datetime(timestamps, unit='s', utc=True).dt.strftime('%Y-%m-%d')
+
+
+def load_manifest(user_id: Optional[str] = None) -> dict:
+    """
+    Returns the partition manifest of a user, which is empty if nothing has been compacted for the user yet
+    """
+    try:
+        manifest_body = soundprintutils.download_bytes_from_s3(get_manifest_file_name(user_id))
+    except ClientError as ce:
+        if ce.response.get('Error').get('Code') in ('NoSuchKey', '404'):
+            return {CompactionCommon.MANIFEST_PARTITIONS_KEY: {}}
+        raise ce
+    return json.loads(manifest_body)
+
+
+def save_manifest(manifest: dict, user_id: Optional[str] = None):
+    """
+    Writes the partition manifest of a user, with its partitions in order of date
+    """
+    partitions = manifest[CompactionCommon.MANIFEST_PARTITIONS_KEY]
+    manifest[CompactionCommon.MANIFEST_PARTITIONS_KEY] = dict(sorted(partitions.items()))
+    soundprintutils.upload_bytes_to_s3(bytes(json.dumps(manifest, indent=2), 'utf-8'), get_manifest_file_name(user_id))
+
+
+def describe_partition(partition_df: pd.DataFrame, partition_file_name: str) -> dict:
+    """
+    Returns the manifest entry of a partition holding the rows of the given DataFrame
+    """
+    timestamps = partition_df[JoinerCommon.LISTEN_TIMESTAMP[0]]
+    return {
+        CompactionCommon.FILE_NAME_KEY: partition_file_name,
+        CompactionCommon.MIN_TIMESTAMP_KEY: float(timestamps.min()),
+        CompactionCommon.MAX_TIMESTAMP_KEY: float(timestamps.max()),
+        CompactionCommon.ROW_COUNT_KEY: int(partition_df.shape[0]),
+        CompactionCommon.PLAY_COUNT_KEY: int(timestamps.nunique()),
+    }
+
+
+def get_overlapping_partitions(manifest: dict, start_timestamp: float, end_timestamp: float) -> List[dict]:
+    """
+    Returns the manifest entries of the partitions with plays in the time-range [start_timestamp, end_timestamp]
+    """
+    return [partition for partition in manifest[CompactionCommon.MANIFEST_PARTITIONS_KEY].values()
+            if partition[CompactionCommon.MIN_TIMESTAMP_KEY] <= end_timestamp
+            and partition[CompactionCommon.MAX_TIMESTAMP_KEY] >= start_timestamp]
+
+
+def read_history_range(start_timestamp: float, end_timestamp: float, user_id: Optional[str] = None,
+                       manifest: dict = None) -> pd.DataFrame:
+    """
+    Reads the compacted history of a user played in the time-range [start_timestamp, end_timestamp] (epoch seconds),
+    opening only the partitions the manifest lists as overlapping the range.
+    :return: DataFrame following JoinerCommon.SCHEMA, in ascending order of listened-timestamp
+    """
+    if manifest is None:
+        manifest = load_manifest(user_id)
+
+    partition_dfs = []
+    for partition in get_overlapping_partitions(manifest, start_timestamp, end_timestamp):
+        partition_df = soundprintutils.download_df_from_s3(partition[CompactionCommon.FILE_NAME_KEY],
+                                                           CompactionCommon.TYPED_SCHEMA)
+        timestamps = partition_df[JoinerCommon.LISTEN_TIMESTAMP[0]]
+        partition_dfs.append(partition_df[(timestamps >= start_timestamp) & (timestamps <= end_timestamp)])
+
+    if len(partition_dfs) == 0:
+        return pd.DataFrame([], columns=CompactionCommon.SCHEMA)
+    history_df = pd.concat(partition_dfs, ignore_index=True)
+    return history_df.sort_values(JoinerCommon.LISTEN_TIMESTAMP[0], kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,216 @@
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import os
+import time
+import tempfile
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from src.common import soundprintutils
+
+CACHE_FILE_PATH_PREFIX = 'cache/'
+
+# Time for which volatile fields (e.g. popularity) of a cached entity are served before being refreshed from Spotify.
+# All other fields of a cached entity never expire.
+VOLATILE_TTL_SECS = int(os.environ.get('SOUNDPRINT_CACHE_VOLATILE_TTL_SECS', 24 * 3600))
+
+# Time after which a cached entity that has not been refreshed is evicted from the cache when it is saved, so that the
+# cache only holds the entities heard lately rather than growing with every entity ever heard
+EVICTION_TTL_SECS = int(os.environ.get('SOUNDPRINT_CACHE_EVICTION_TTL_SECS', 30 * 24 * 3600))
+
+# Directory of a local file backend to use instead of S3, e.g. for running the stages in tests
+LOCAL_CACHE_DIR = os.environ.get('SOUNDPRINT_CACHE_DIR')
+
+# Directory S3 cache files are downloaded to when they are to be memory-mapped rather than read into memory
+DOWNLOAD_DIR = os.environ.get('SOUNDPRINT_CACHE_DOWNLOAD_DIR', os.path.join(tempfile.gettempdir(), 'soundprint-cache'))
+
+CACHED_AT = ('CACHED_AT', float)
+
+
+class S3CacheBackend:
+    """
+    Stores cache files in the soundprint S3 bucket under cache/, outside of the lifecycle policy for history/
+    """
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            return soundprintutils.download_bytes_from_s3(f"{CACHE_FILE_PATH_PREFIX}{name}")
+        except ClientError as ce:
+            if ce.response.get('Error').get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise ce
+
+    def write(self, name: str, body: bytes):
+        soundprintutils.upload_bytes_to_s3(body, f"{CACHE_FILE_PATH_PREFIX}{name}")
+
+    def read_to_file(self, name: str) -> Optional[str]:
+        """
+        Downloads a cache file to DOWNLOAD_DIR and returns its local path, or None if it does not exist
+        """
+        body = self.read(name)
+        if body is None:
+            return None
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        file_path = os.path.join(DOWNLOAD_DIR, name)
+        # Replace the file rather than overwriting it, so that earlier memory-maps of the file stay intact
+        with tempfile.NamedTemporaryFile(dir=DOWNLOAD_DIR, delete=False) as download_file:
+            download_file.write(body)
+        os.replace(download_file.name, file_path)
+        return file_path
+
+
+class LocalFileCacheBackend:
+    """
+    Stores cache files in a directory on the local file-system
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read(self, name: str) -> Optional[bytes]:
+        file_path = os.path.join(self.directory, name)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'rb') as cache_file:
+            return cache_file.read()
+
+    def write(self, name: str, body: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as cache_file:
+            cache_file.write(body)
+        os.replace(cache_file.name, os.path.join(self.directory, name))
+
+    def read_to_file(self, name: str) -> Optional[str]:
+        """
+        Returns the local path of a cache file, or None if it does not exist
+        """
+        file_path = os.path.join(self.directory, name)
+        return file_path if os.path.exists(file_path) else None
+
+
+def get_cache_backend():
+    """
+    Returns the local file backend if SOUNDPRINT_CACHE_DIR is set, else the S3 backend
+    """
+    return LocalFileCacheBackend(LOCAL_CACHE_DIR) if LOCAL_CACHE_DIR else S3CacheBackend()
+
+
+class EntityCache:
+    """
+    Persistent cache of Spotify entity metadata rows keyed by the entity's Spotify id.
+    An entity can have multiple rows (e.g. a track with multiple artists); all rows of an entity are cached and
+    replaced together. Rows are stored along with the time they were cached at, which is used to expire the
+    entity's volatile fields after volatile_ttl_secs, and to evict the entity after eviction_ttl_secs.
+    Saving merges the updated entities into the cache file as it is in the backend at that time, so that concurrent
+    runs updating the same cache keep each other's entities.
+    """
+    def __init__(self, name: str, typed_schema: List[Tuple[str, classmethod]], id_field: Tuple[str, classmethod],
+                 volatile_schema: List[str], backend=None, volatile_ttl_secs: int = VOLATILE_TTL_SECS,
+                 eviction_ttl_secs: int = EVICTION_TTL_SECS):
+        """
+        :param name: Name of the cache, used as the name of its file in the backend
+        :param typed_schema: (field_name, field_data_type) schema of the cached rows
+        :param id_field: Schema field holding the Spotify id of the entity
+        :param volatile_schema: Names of fields that expire after volatile_ttl_secs
+        :param backend: Storage backend for the cache file, defaults to get_cache_backend()
+        :param volatile_ttl_secs: Time in seconds after which volatile fields of a cached entity expire
+        :param eviction_ttl_secs: Time in seconds after which a cached entity is evicted on save
+        """
+        self.file_name = f"{name}.parquet"
+        self.typed_schema = typed_schema
+        self.schema = list(map(lambda ts: ts[0], typed_schema))
+        self.id_field = id_field
+        self.volatile_schema = volatile_schema
+        self.backend = backend if backend is not None else get_cache_backend()
+        self.volatile_ttl_secs = volatile_ttl_secs
+        self.eviction_ttl_secs = eviction_ttl_secs
+
+        self.cached_df = None
+        self.updated_ids = set()
+        self.is_dirty = False
+
+    def read(self) -> pd.DataFrame:
+        """
+        Reads all the cached rows from the backend
+        """
+        body = self.backend.read(self.file_name)
+        if body is None:
+            return pd.DataFrame([], columns=self.schema + [CACHED_AT[0]])
+        return soundprintutils.deserialize_df_parquet(body, self.typed_schema + [CACHED_AT])
+
+    def load(self) -> pd.DataFrame:
+        """
+        Returns all the cached rows, reading them from the backend on first use
+        """
+        if self.cached_df is None:
+            self.cached_df = self.read()
+        return self.cached_df
+
+    def lookup(self, entity_ids: List[str], now: float) -> Tuple[pd.DataFrame, pd.DataFrame, List[str]]:
+        """
+        Looks up the cached rows for the given entity-ids.
+        :param entity_ids: Spotify ids of the entities to look up
+        :param now: Current epoch time in seconds, against which volatile fields are expired
+        :return: Tuple of (fresh rows, stale rows, missing ids). Fresh rows can be used as-is. Stale rows are for
+        entities whose volatile fields have expired; their remaining fields are still valid. Missing ids are not cached.
+        """
+        cached_df = self.load()
+        cached_df = cached_df[cached_df[self.id_field[0]].isin(entity_ids)]
+
+        if len(self.volatile_schema) == 0:
+            is_fresh = pd.Series(True, index=cached_df.index)
+        else:
+            is_fresh = cached_df[CACHED_AT[0]] + self.volatile_ttl_secs > now
+
+        fresh_df = cached_df[is_fresh][self.schema].reset_index(drop=True)
+        stale_df = cached_df[~is_fresh][self.schema].reset_index(drop=True)
+
+        cached_ids = set(cached_df[self.id_field[0]])
+        missing_ids = [entity_id for entity_id in entity_ids if entity_id not in cached_ids]
+
+        return fresh_df, stale_df, missing_ids
+
+    def update(self, entities_df: pd.DataFrame, now: float):
+        """
+        Replaces all cached rows of the entities in the given dataframe with its rows, cached at the given time
+        """
+        if len(entities_df.index) == 0:
+            return
+
+        cached_df = self.load()
+        cached_df = cached_df[~cached_df[self.id_field[0]].isin(entities_df[self.id_field[0]])]
+
+        entities_df = entities_df[self.schema].copy()
+        entities_df[CACHED_AT[0]] = CACHED_AT[1](now)
+
+        self.cached_df = pd.concat([cached_df, entities_df], ignore_index=True)
+        self.updated_ids.update(entities_df[self.id_field[0]])
+        self.is_dirty = True
+
+    def merge(self, stored_df: pd.DataFrame, updated_df: pd.DataFrame, now: float) -> pd.DataFrame:
+        """
+        Merges updated rows into the stored rows, keeping the rows of each entity cached last, and drops the rows of
+        entities cached more than eviction_ttl_secs ago
+        """
+        merged_df = pd.concat([stored_df, updated_df], ignore_index=True)
+        last_cached_at = merged_df.groupby(self.id_field[0])[CACHED_AT[0]].transform('max')
+        merged_df = merged_df[merged_df[CACHED_AT[0]] == last_cached_at].drop_duplicates()
+        merged_df = merged_df[merged_df[CACHED_AT[0]] + self.eviction_ttl_secs > now]
+        return merged_df.reset_index(drop=True)
+
+    def save(self, now: float = None):
+        """
+        Writes the cached rows back to the backend if they have been updated. The updated entities are merged into the
+        cache file as it is now, rather than as it was loaded, and expired entities are evicted.
+        :param now: Current epoch time in seconds, against which entities are evicted, defaults to the current time
+        """
+        if not self.is_dirty:
+            return
+        if now is None:
+            now = time.time()
+        updated_df = self.cached_df[self.cached_df[self.id_field[0]].isin(self.updated_ids)]
+        self.cached_df = self.merge(self.read(), updated_df, now)
+        body = soundprintutils.serialize_df_parquet(self.cached_df, False, self.typed_schema + [CACHED_AT])
+        self.backend.write(self.file_name, body)
+        self.updated_ids = set()
+        self.is_dirty = False
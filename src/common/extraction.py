@@ -0,0 +1,59 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from operator import attrgetter
+import pandas as pd
+
+from src.common import schemaregistry
+
+# Columnar extraction of Spotify objects into dataframes. The fields of every object are pulled straight into a list
+# per column, rather than into a dict per object (and per value of a multi-valued field), and multi-valued fields are
+# expanded into a row per value with a single explode.
+# A field is extracted by its path in the object, e.g. 'album.id', from either tekore model objects or the raw JSON
+# dicts of the Web API responses, which have the same structure.
+
+
+def get_path_getter(path: str, raw_json: bool) -> Callable:
+    """
+    Returns the function that gets the value at a dotted path from a model object, or from a raw JSON dict
+    """
+    if not raw_json:
+        return attrgetter(path)
+
+    keys = path.split('.')
+
+    def get_json_value(json_object: dict):
+        for key in keys:
+            json_object = json_object[key]
+        return json_object
+    return get_json_value
+
+
+def extract_columns(objects: List, field_paths: List[Tuple[Tuple[str, classmethod], str]]) -> Dict[str, list]:
+    """
+    Extracts the fields at the given paths of every object into a list of values per field
+    :param objects: tekore model objects, or raw JSON dicts, of the same kind
+    :param field_paths: List of (schema field, path of the field's value in an object)
+    :return: Map of field name to the list of the field's values, in the order of the objects
+    """
+    raw_json = len(objects) > 0 and isinstance(objects[0], dict)
+    return {ts[0]: list(map(get_path_getter(path, raw_json), objects)) for ts, path in field_paths}
+
+
+def build_df(columns: Dict[str, list], typed_schema: List[Tuple[str, classmethod]],
+             list_field: Tuple[str, classmethod] = None) -> pd.DataFrame:
+    """
+    Builds a dataframe following the typed schema from extracted columns, with the dtypes registered for its fields.
+    :param list_field: Field whose column holds a list of values per object, which is expanded into a row per value.
+    Objects with an empty list have a single row with the field missing.
+    """
+    field_names = list(map(lambda ts: ts[0], typed_schema))
+    if all(len(values) == 0 for values in columns.values()):
+        # Columns of empty lists would otherwise be inferred as float, rather than left as object like empty rows
+        return pd.DataFrame(columns=field_names)
+    df = pd.DataFrame(columns, columns=field_names)
+    if list_field is not None:
+        df = df.explode(list_field[0], ignore_index=True)
+    return schemaregistry.apply_dtypes(df, typed_schema)
@@ -0,0 +1,225 @@
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import io
+import numpy as np
+import pandas as pd
+
+from src.common.entitycache import get_cache_backend
+from src.common.tracker import TrackerCommon
+
+INDEX_FEATURES = TrackerCommon.CONTINUOUS_AUDIO_FEATURES_SCHEMA
+
+# Spotify ids are 22 base-62 characters, so the ids are stored as fixed-width ASCII bytes rather than 4-byte unicode
+IDS_DTYPE = np.dtype('S22')
+
+
+def serialize_arrays(arrays: List[np.ndarray]) -> bytes:
+    """
+    Serializes arrays into a single body, as their .npy serializations one after the other
+    """
+    arrays_buffer = io.BytesIO()
+    for array in arrays:
+        np.save(arrays_buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return arrays_buffer.getvalue()
+
+
+def deserialize_arrays(body: bytes, num_arrays: int) -> List[np.ndarray]:
+    """
+    Deserializes the arrays of a body written by serialize_arrays
+    """
+    arrays_buffer = io.BytesIO(body)
+    return [np.load(arrays_buffer, allow_pickle=False) for _ in range(num_arrays)]
+
+
+def memmap_arrays(file_path: str, num_arrays: int) -> List[np.memmap]:
+    """
+    Memory-maps the arrays of a file written by serialize_arrays, read-only
+    """
+    arrays = []
+    with open(file_path, 'rb') as arrays_file:
+        for _ in range(num_arrays):
+            version = np.lib.format.read_magic(arrays_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(arrays_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(arrays_file)
+            offset = arrays_file.tell()
+            array = np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                              order='F' if fortran_order else 'C')
+            arrays_file.seek(offset + array.nbytes)
+            arrays.append(array)
+    return arrays
+
+
+class AudioFeatureIndex:
+    """
+    Index of the audio-features of all known tracks for nearest-neighbour queries, as a float32 matrix with a row of
+    raw features per track along with an array of the tracks' ids (see IDS_DTYPE). Similarity is the cosine similarity
+    of the features after normalizing each feature to zero mean and unit variance over all the indexed tracks, so that
+    features on larger scales (e.g. tempo and loudness) do not dominate.
+    The matrix and ids are persisted together as a single file in the cache backend, so that a reader never sees the
+    matrix of one save with the ids of another, and are memory-mapped when loaded. Saving merges the added tracks
+    into the index file as it is then, so that concurrent runs do not drop each other's tracks.
+    """
+    def __init__(self, name: str = 'featureindex', backend=None, features: List[str] = None):
+        """
+        :param name: Name of the index, used as the name of its file in the backend
+        :param backend: Storage backend for the index file, defaults to entitycache.get_cache_backend()
+        :param features: Names of the track fields indexed, defaults to INDEX_FEATURES
+        """
+        self.file_name = f"{name}.npys"
+        self.backend = backend if backend is not None else get_cache_backend()
+        self.features = features if features is not None else INDEX_FEATURES
+
+        self.matrix = None
+        self.ids = None
+        self.id_rows = None
+        self.normalized_matrix = None
+        self.num_loaded = 0
+        self.is_dirty = False
+
+    def load(self) -> 'AudioFeatureIndex':
+        """
+        Memory-maps the index file from the backend on first use, or starts an empty index if there is none
+        """
+        if self.matrix is not None:
+            return self
+
+        file_path = self.backend.read_to_file(self.file_name)
+        if file_path is None:
+            self.matrix = np.empty((0, len(self.features)), dtype=np.float32)
+            self.ids = np.empty(0, dtype=IDS_DTYPE)
+        else:
+            self.matrix, self.ids = memmap_arrays(file_path, 2)
+        self.num_loaded = len(self.ids)
+        return self
+
+    def __len__(self) -> int:
+        return self.load().matrix.shape[0]
+
+    def get_id_rows(self) -> Dict[str, int]:
+        """
+        Returns the map of track-id to its row in the matrix, building it on first use
+        """
+        if self.id_rows is None:
+            self.id_rows = {track_id.decode('ascii'): row for row, track_id in enumerate(self.load().ids.tolist())}
+        return self.id_rows
+
+    def add(self, tracks_df: pd.DataFrame) -> int:
+        """
+        Adds the tracks of a dataframe with the TrackerCommon.SCHEMA fields to the index. Tracks already indexed and
+        tracks missing any of the audio-features are skipped, as the audio-features of a track never change.
+        :return: Number of tracks added
+        :raises ValueError: If a track-id is longer than the ids stored in the index
+        """
+        id_rows = self.get_id_rows()
+        tracks_df = tracks_df.drop_duplicates(TrackerCommon.TRACK_ID[0])
+        tracks_df = tracks_df[~tracks_df[TrackerCommon.TRACK_ID[0]].isin(id_rows)]
+        tracks_df = tracks_df.dropna(subset=self.features)
+        if tracks_df.shape[0] == 0:
+            return 0
+
+        new_track_ids = tracks_df[TrackerCommon.TRACK_ID[0]].tolist()
+        if any(len(track_id) > IDS_DTYPE.itemsize for track_id in new_track_ids):
+            raise ValueError(f"Track-ids of the index are at most {IDS_DTYPE.itemsize} characters long")
+        new_ids = np.array(new_track_ids, dtype=IDS_DTYPE)
+        new_matrix = tracks_df[self.features].to_numpy(dtype=np.float32)
+        for row, track_id in enumerate(new_track_ids, start=len(self.ids)):
+            id_rows[track_id] = row
+        self.matrix = np.concatenate([self.matrix, new_matrix])
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.normalized_matrix = None
+        self.is_dirty = True
+        return len(new_ids)
+
+    def save(self):
+        """
+        Writes the index file back to the backend if tracks have been added, with the matrix and the ids in one write.
+        The added tracks are merged into the index file as it is now, rather than as it was loaded, skipping the tracks
+        another run has indexed since.
+        """
+        if not self.is_dirty:
+            return
+        body = self.backend.read(self.file_name)
+        if body is None:
+            stored_matrix, stored_ids = self.matrix[:0], self.ids[:0]
+        else:
+            stored_matrix, stored_ids = deserialize_arrays(body, 2)
+        added_matrix, added_ids = self.matrix[self.num_loaded:], self.ids[self.num_loaded:]
+        is_new = ~np.isin(added_ids, stored_ids)
+
+        self.matrix = np.concatenate([stored_matrix, added_matrix[is_new]])
+        self.ids = np.concatenate([stored_ids, added_ids[is_new]])
+        self.backend.write(self.file_name, serialize_arrays([self.matrix, self.ids]))
+        self.num_loaded = len(self.ids)
+        self.id_rows = None
+        self.normalized_matrix = None
+        self.is_dirty = False
+
+    def normalize(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Normalizes raw feature vectors by the mean and standard deviation of each feature over all indexed tracks
+        """
+        mean = self.matrix.mean(axis=0, dtype=np.float64)
+        std = self.matrix.std(axis=0, dtype=np.float64)
+        std[std == 0] = 1.0
+        return ((vectors - mean) / std).astype(np.float32)
+
+    def get_normalized_matrix(self) -> np.ndarray:
+        """
+        Returns the matrix of normalized features scaled to unit length, computing it on first use after any addition
+        """
+        if self.normalized_matrix is None:
+            normalized_matrix = self.normalize(self.load().matrix)
+            norms = np.linalg.norm(normalized_matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self.normalized_matrix = normalized_matrix / norms
+        return self.normalized_matrix
+
+    def search(self, query_vector: np.ndarray, k: int, excluded_rows: List[int] = ()) -> List[Tuple[str, float]]:
+        """
+        Returns the k indexed tracks most similar to a normalized query vector, other than the excluded rows.
+        :return: List of (track-id, cosine similarity) in descending order of similarity
+        """
+        query_norm = np.linalg.norm(query_vector)
+        if len(self) == 0 or query_norm == 0:
+            return []
+        similarities = self.get_normalized_matrix() @ (query_vector / query_norm).astype(np.float32)
+        similarities[list(excluded_rows)] = -np.inf
+
+        k = min(k, similarities.shape[0] - len(set(excluded_rows)))
+        if k <= 0:
+            return []
+        top_rows = np.argpartition(-similarities, k - 1)[:k]
+        top_rows = top_rows[np.argsort(-similarities[top_rows], kind='stable')]
+        return [(self.ids[row].decode('ascii'), float(similarities[row])) for row in top_rows]
+
+    def most_similar(self, track_id: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Returns the k indexed tracks whose audio-features are most similar to those of the given indexed track
+        """
+        row = self.get_id_rows()[track_id]
+        return self.search(self.get_normalized_matrix()[row], k, [row])
+
+    def most_similar_to_tracks(self, track_ids: List[str], k: int = 10, weights: Optional[List[float]] = None,
+                               exclude_tracks: bool = True) -> List[Tuple[str, float]]:
+        """
+        Returns the k indexed tracks closest to the centroid of the given tracks, e.g. the plays of a listening window,
+        by the similarity of their audio-features. Tracks that are not indexed are left out of the centroid.
+        :param track_ids: Ids of the tracks whose centroid is queried, repeated for tracks played more than once
+        :param weights: Weight of each track in the centroid, e.g. its listened time, by default equal
+        :param exclude_tracks: If true, the given tracks themselves are left out of the results
+        """
+        id_rows = self.get_id_rows()
+        if weights is None:
+            weights = [1.0] * len(track_ids)
+        indexed = [(id_rows[track_id], weight) for track_id, weight in zip(track_ids, weights) if track_id in id_rows]
+        if len(indexed) == 0:
+            return []
+
+        rows, row_weights = map(np.asarray, zip(*indexed))
+        centroid = np.average(self.get_normalized_matrix()[rows], axis=0, weights=row_weights)
+        return self.search(centroid, k, sorted(set(rows.tolist())) if exclude_tracks else [])
@@ -1,3 +1,5 @@
+from typing import List
+
 from src.common.listener import ListenerCommon
 from src.common.tracker import TrackerCommon
 from src.common.albumer import AlbumerCommon
@@ -88,3 +90,59 @@ class JoinerCommon:
     SCHEMA = list(map(lambda ts: ts[0], TYPED_SCHEMA))
 
     FILE_PATH_PREFIX = 'history/data/'
+
+    # Compact join output has exactly one row per play. The multi-valued artist and genre attributes are list-valued,
+    # with the artist lists aligned by position and ARTIST_GENRES holding the list of genres of each artist.
+    ALBUM_GENRES = ('ALBUM_GENRES', List[str])
+    ARTIST_IDS = ('ARTIST_IDS', List[str])
+    ARTIST_NAMES = ('ARTIST_NAMES', List[str])
+    ARTIST_GENRES = ('ARTIST_GENRES', List[List[str]])
+    ARTIST_POPULARITIES = ('ARTIST_POPULARITIES', List[int])
+
+    COMPACT_TYPED_SCHEMA = [
+        # Listening fields
+        LISTEN_TIMESTAMP,
+        LISTENED_TIME,
+
+        # Track attributes
+        TRACK_ID,
+        TRACK_NAME,
+        TRACK_DURATION_MS,
+        TRACK_POPULARITY,
+        TRACK_EXPLICIT,
+        TRACK_ACOUSTICNESS,
+        TRACK_DANCEABILITY,
+        TRACK_ENERGY,
+        TRACK_LIVENESS,
+        TRACK_LOUDNESS,
+        TRACK_INSTRUMENTALNESS,
+        TRACK_SPEECHINESS,
+        TRACK_VALENCE,
+        TRACK_KEY,
+        TRACK_MODE,
+        TRACK_TEMPO,
+        TRACK_TIME_SIGNATURE,
+
+        # Album attributes
+        ALBUM_ID,
+        ALBUM_TYPE,
+        ALBUM_GENRES,
+        ALBUM_LABEL,
+        ALBUM_NAME,
+        ALBUM_POPULARITY,
+        ALBUM_RELEASE_DATE,
+        ALBUM_TOTAL_TRACKS,
+
+        # Artist attributes
+        ARTIST_IDS,
+        ARTIST_NAMES,
+        ARTIST_GENRES,
+        ARTIST_POPULARITIES
+    ]
+
+    COMPACT_SCHEMA = list(map(lambda ts: ts[0], COMPACT_TYPED_SCHEMA))
+
+    # String fields of the compact output with values repeated across plays, stored as categoricals
+    COMPACT_CATEGORICAL_SCHEMA = [TRACK_ID[0], TRACK_NAME[0], ALBUM_ID[0], ALBUM_TYPE[0], ALBUM_LABEL[0], ALBUM_NAME[0]]
+
+    COMPACT_FILE_PATH_PREFIX = 'history/compact/'
@@ -0,0 +1,28 @@
+import sys
+import types
+import importlib
+
+# Deferred imports of heavy modules (e.g. pandas, pyarrow and tekore), so that a Lambda only pays for the import of a
+# module on its cold start if it actually uses the module. Modules that use a lazily imported module in their
+# annotations need `from __future__ import annotations`, so that the annotations do not import it at definition time.
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that imports the module on the first access of one of its attributes. Every attribute is
+    looked up on the imported module in sys.modules, so that attributes patched on the module (e.g. by the offline
+    harness) are seen through the stand-in. Imports go through importlib, which makes them thread-safe.
+    """
+    def __getattr__(self, name: str):
+        return getattr(importlib.import_module(self.__name__), name)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(module_name: str) -> types.ModuleType:
+    """
+    Returns the module if it has already been imported, else a LazyModule that imports it on first use
+    """
+    module = sys.modules.get(module_name)
+    return module if module is not None else LazyModule(module_name)
@@ -2,7 +2,13 @@ class ListenerCommon:
     TIMESTAMP = ('PLAYED_AT', float)
     TRACK_ID = ('TRACK_ID', str)
     LISTENED_TIME = ('LISTENED_MS', int)
+    TRACK_DURATION = ('TRACK_DURATION_MS', int)
 
-    SCHEMA = [TIMESTAMP[0], TRACK_ID[0], LISTENED_TIME[0]]
+    TYPED_SCHEMA = [TIMESTAMP, TRACK_ID, LISTENED_TIME]
+
+    SCHEMA = list(map(lambda ts: ts[0], TYPED_SCHEMA))
+
+    # Schema of extracted playback records, which carry the track's duration for calculating the listened time
+    PLAYBACK_SCHEMA = SCHEMA + [TRACK_DURATION[0]]
 
     FILE_PATH_PREFIX = 'history/listening/'
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+from src.common import awsclients
+from src.common import soundprintutils
+from src.common.lazyimport import lazy_import
+from src.common.joiner import JoinerCommon
+from src.common.tracker import TrackerCommon
+
+# Imported on first use, as queries of the rollups do not need it
+pd = lazy_import('pandas')
+
+# Listening rollups are pre-aggregated per user, time granularity and grouping, and kept in the DynamoDB table
+# soundprintutils.ROLLUPS_TABLE. Each item aggregates the plays of one group (e.g. an artist) in one time bucket:
+# rollup (partition key): <granularity>/<group-by>, suffixed with /<user-id> for listeners other than the original
+# bucket (sort key): <start of the time bucket in UTC>#<group-id>, where the start of hourly buckets is formatted as
+#                    YYYY-MM-DDTHH, and of daily and weekly (starting on Monday) buckets as YYYY-MM-DD
+# The items are updated incrementally with ADD, so the plays of each hour only have to be aggregated once.
+# Increments are made idempotent by each item's appliedThroughMs: the epoch time in milliseconds of the most recent
+# play of the last batch of plays added to the item. A batch is only added to items it is more recent than, so a batch
+# added again, e.g. by an archiver retried before it advanced the listening cursor, leaves the items unchanged.
+ROLLUP_DDB_KEY = 'rollup'
+BUCKET_DDB_KEY = 'bucket'
+GROUP_NAME_DDB_KEY = 'groupName'
+LISTENED_MS_DDB_KEY = 'listenedMs'
+PLAY_COUNT_DDB_KEY = 'playCount'
+# Number of plays with audio-features, which the sums of the audio-features are over
+FEATURE_COUNT_DDB_KEY = 'featureCount'
+APPLIED_THROUGH_MS_DDB_KEY = 'appliedThroughMs'
+
+GRANULARITY_HOUR = 'hour'
+GRANULARITY_DAY = 'day'
+GRANULARITY_WEEK = 'week'
+GRANULARITIES = [GRANULARITY_HOUR, GRANULARITY_DAY, GRANULARITY_WEEK]
+
+GROUP_BY_TOTAL = 'total'
+GROUP_BY_TRACK = 'track'
+GROUP_BY_ALBUM = 'album'
+GROUP_BY_ARTIST = 'artist'
+GROUP_BY_GENRE = 'genre'
+GROUP_BYS = [GROUP_BY_TOTAL, GROUP_BY_TRACK, GROUP_BY_ALBUM, GROUP_BY_ARTIST, GROUP_BY_GENRE]
+TOTAL_GROUP_ID = 'all'
+
+# Audio-features averaged over the plays of every group. Each item holds the sum of every feature, under the name
+# of its field, over the featureCount plays with audio-features.
+AVERAGED_FEATURES = TrackerCommon.CONTINUOUS_AUDIO_FEATURES_SCHEMA
+
+# Maximum number of rollup items updated at once
+MAX_UPDATE_CONCURRENCY = int(os.environ.get('SOUNDPRINT_ROLLUPS_MAX_CONCURRENCY', 8))
+
+GROUP_ID = 'GROUP_ID'
+GROUP_NAME = 'GROUP_NAME'
+BUCKET_FORMATS = {GRANULARITY_HOUR: '%Y-%m-%dT%H', GRANULARITY_DAY: '%Y-%m-%d', GRANULARITY_WEEK: '%Y-%m-%d'}
+
+
+def get_rollup_key(granularity: str, group_by: str, user_id: Optional[str] = None) -> str:
+    """
+    Returns the partition key of the rollup items of a user for the given granularity and grouping
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown rollup granularity: {granularity}")
+    if group_by not in GROUP_BYS:
+        raise ValueError(f"Unknown rollup grouping: {group_by}")
+    rollup_key = f"{granularity}/{group_by}"
+    if user_id is None:
+        return rollup_key
+    return f"{rollup_key}/{soundprintutils.validate_user_id(user_id)}"
+
+
+def get_bucket_starts(timestamps: pd.Series, granularity: str) -> pd.Series:
+    """
+    Returns the formatted start of the time bucket of the given granularity that each epoch timestamp (seconds) is in
+    """
+    dts = pd.to_datetime(timestamps, unit='s', utc=True)
+    if granularity == GRANULARITY_WEEK:
+        dts = dts.dt.normalize() - pd.to_timedelta(dts.dt.weekday, unit='D')
+    return dts.dt.strftime(BUCKET_FORMATS[granularity])
+
+
+def get_bucket_start(dt: datetime, granularity: str) -> str:
+    """
+    Returns the formatted start of the time bucket of the given granularity that a datetime in UTC falls in
+    """
+    if granularity == GRANULARITY_WEEK:
+        dt = dt - timedelta(days=dt.weekday())
+    return dt.strftime(BUCKET_FORMATS[granularity])
+
+
+def get_group_rows(joined_df: pd.DataFrame, plays_df: pd.DataFrame, group_by: str) -> pd.DataFrame:
+    """
+    Returns the groups of the given grouping that each play belongs to, as rows of listened-timestamp, group-id and
+    group-name. A play belongs to every artist of its track, and to every genre of its album and artists.
+    """
+    timestamp_field = JoinerCommon.LISTEN_TIMESTAMP[0]
+    if group_by == GROUP_BY_TOTAL:
+        return pd.DataFrame({timestamp_field: plays_df[timestamp_field], GROUP_ID: TOTAL_GROUP_ID,
+                             GROUP_NAME: TOTAL_GROUP_ID})
+    if group_by == GROUP_BY_GENRE:
+        genres_df = pd.concat([
+            joined_df[[timestamp_field, genre_field]].astype({genre_field: object}).set_axis(
+                [timestamp_field, GROUP_ID], axis=1)
+            for genre_field in (JoinerCommon.ALBUM_GENRE[0], JoinerCommon.ARTIST_GENRE[0])
+        ], ignore_index=True)
+        genres_df = genres_df[genres_df[GROUP_ID].notna() & (genres_df[GROUP_ID] != '')]
+        return genres_df.drop_duplicates().assign(**{GROUP_NAME: lambda df: df[GROUP_ID]})
+
+    id_field, name_field = {
+        GROUP_BY_TRACK: (JoinerCommon.TRACK_ID[0], JoinerCommon.TRACK_NAME[0]),
+        GROUP_BY_ALBUM: (JoinerCommon.ALBUM_ID[0], JoinerCommon.ALBUM_NAME[0]),
+        GROUP_BY_ARTIST: (JoinerCommon.ARTIST_ID[0], JoinerCommon.ARTIST_NAME[0]),
+    }[group_by]
+    groups_df = joined_df[[timestamp_field, id_field, name_field]].drop_duplicates([timestamp_field, id_field])
+    return groups_df.set_axis([timestamp_field, GROUP_ID, GROUP_NAME], axis=1)
+
+
+def aggregate_rollups(joined_df: pd.DataFrame) -> Dict[tuple, pd.DataFrame]:
+    """
+    Aggregates the plays of a wide joined dataframe (see JoinerCommon.SCHEMA) into rollup increments.
+    :return: Map of (granularity, group-by) to a DataFrame with a row per time bucket and group, holding the bucket's
+    start, group id and name, and the listened time, play count, feature count and feature sums of the group's plays
+    """
+    timestamp_field = JoinerCommon.LISTEN_TIMESTAMP[0]
+    plays_df = joined_df.drop_duplicates(timestamp_field)
+    plays_df = plays_df[[timestamp_field, JoinerCommon.LISTENED_TIME[0]] + AVERAGED_FEATURES]
+    plays_df = plays_df.assign(**{FEATURE_COUNT_DDB_KEY: plays_df[AVERAGED_FEATURES].notna().all(axis=1).astype(int)})
+    plays_df = plays_df.assign(**{granularity: get_bucket_starts(plays_df[timestamp_field], granularity)
+                                  for granularity in GRANULARITIES})
+
+    rollup_dfs = {}
+    for group_by in GROUP_BYS:
+        group_plays_df = get_group_rows(joined_df, plays_df, group_by).merge(plays_df, on=timestamp_field)
+        featured_plays = group_plays_df[FEATURE_COUNT_DDB_KEY] == 1
+        group_plays_df.loc[~featured_plays, AVERAGED_FEATURES] = 0.0
+        for granularity in GRANULARITIES:
+            grouped = group_plays_df.groupby([granularity, GROUP_ID], sort=True)
+            rollup_df = grouped[[JoinerCommon.LISTENED_TIME[0], FEATURE_COUNT_DDB_KEY] + AVERAGED_FEATURES].sum()
+            rollup_df[GROUP_NAME] = grouped[GROUP_NAME].first()
+            rollup_df[PLAY_COUNT_DDB_KEY] = grouped.size()
+            rollup_df = rollup_df.reset_index().rename(columns={granularity: BUCKET_DDB_KEY})
+            rollup_dfs[(granularity, group_by)] = rollup_df.assign(
+                **{GROUP_NAME: rollup_df[GROUP_NAME].fillna(rollup_df[GROUP_ID])})
+    return rollup_dfs
+
+
+def to_decimal(value: float) -> Decimal:
+    """
+    Returns a number as a Decimal, the number type of the boto3 DynamoDB resource API
+    """
+    return Decimal(str(round(float(value), 6)))
+
+
+def update_rollup_item(ddb_table, rollup_key: str, rollup_row: dict, applied_through_ms: int) -> bool:
+    """
+    Adds the increments of a rollup row to its item, creating the item if it does not exist yet, unless the item
+    already holds the plays up to applied_through_ms
+    :return: True if the item was updated
+    """
+    increments = {LISTENED_MS_DDB_KEY: rollup_row[JoinerCommon.LISTENED_TIME[0]],
+                  PLAY_COUNT_DDB_KEY: rollup_row[PLAY_COUNT_DDB_KEY],
+                  FEATURE_COUNT_DDB_KEY: rollup_row[FEATURE_COUNT_DDB_KEY]}
+    increments.update({feature: rollup_row[feature] for feature in AVERAGED_FEATURES})
+    value_names = {attribute: f":v{i}" for i, attribute in enumerate(increments)}
+
+    expression_values = {value_names[attribute]: to_decimal(value) for attribute, value in increments.items()}
+    expression_values[':name'] = rollup_row[GROUP_NAME]
+    expression_values[':applied'] = int(applied_through_ms)
+    add_expression = ', '.join(f"{attribute} {value_names[attribute]}" for attribute in increments)
+    try:
+        ddb_table.update_item(
+            Key={ROLLUP_DDB_KEY: rollup_key, BUCKET_DDB_KEY: f"{rollup_row[BUCKET_DDB_KEY]}#{rollup_row[GROUP_ID]}"},
+            UpdateExpression=f"SET {GROUP_NAME_DDB_KEY} = :name, {APPLIED_THROUGH_MS_DDB_KEY} = :applied "
+                             f"ADD {add_expression}",
+            ConditionExpression=f"attribute_not_exists({APPLIED_THROUGH_MS_DDB_KEY}) "
+                                f"OR {APPLIED_THROUGH_MS_DDB_KEY} < :applied",
+            ExpressionAttributeValues=expression_values
+        )
+        return True
+    except ClientError as ce:
+        if ce.response.get('Error').get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise ce
+
+
+def update_rollups(joined_df: pd.DataFrame, user_id: Optional[str] = None,
+                   max_concurrency: int = MAX_UPDATE_CONCURRENCY) -> int:
+    """
+    Adds the plays of a wide joined dataframe to the rollups of a user. The plays are added as a batch identified by
+    its most recent play, which is skipped by the items it has already been added to (see APPLIED_THROUGH_MS_DDB_KEY),
+    so the batch must be more recent than the batches added before it: the archiver adds only the plays after the
+    user's listening cursor.
+    :return: Number of rollup items updated
+    """
+    if joined_df.shape[0] == 0:
+        return 0
+
+    applied_through_ms = int(round(joined_df[JoinerCommon.LISTEN_TIMESTAMP[0]].max() * 1000))
+    ddb_table = awsclients.get_dynamodb_table(soundprintutils.ROLLUPS_TABLE)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(update_rollup_item, ddb_table, get_rollup_key(granularity, group_by, user_id),
+                                   rollup_row, applied_through_ms)
+                   for (granularity, group_by), rollup_df in aggregate_rollups(joined_df).items()
+                   for rollup_row in rollup_df.to_dict('records')]
+        return sum(future.result() for future in futures)
+
+
+def query_rollup_items(rollup_key: str, start_bucket: str, end_bucket: str) -> List[dict]:
+    """
+    Returns the rollup items of the given partition key (see get_rollup_key), of the time buckets starting from
+    start_bucket up to end_bucket (inclusive), following the pagination of the query
+    """
+    ddb_table = awsclients.get_dynamodb_table(soundprintutils.ROLLUPS_TABLE)
+    query_kwargs = {
+        'KeyConditionExpression': f"{ROLLUP_DDB_KEY} = :rollup AND {BUCKET_DDB_KEY} BETWEEN :start AND :end",
+        'ExpressionAttributeValues': {':rollup': rollup_key,
+                                      ':start': start_bucket, ':end': f"{end_bucket}#~"},
+    }
+    items = []
+    while True:
+        query_response = ddb_table.query(**query_kwargs)
+        items += query_response.get('Items', [])
+        if 'LastEvaluatedKey' not in query_response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = query_response['LastEvaluatedKey']
+
+
+def query_rollups(granularity: str, group_by: str, start_dt: datetime, end_dt: datetime,
+                  user_id: Optional[str] = None, limit: int = None) -> List[dict]:
+    """
+    Returns the listening stats of a user in the time buckets of the given granularity from start_dt to end_dt (UTC),
+    grouped by the given grouping.
+    :param limit: Maximum number of groups returned per time bucket, those listened to the longest
+    :return: List of time buckets in order, each with its start and its groups in descending order of listened time,
+    along with their listened minutes, play counts and average audio-features
+    """
+    rollup_key = get_rollup_key(granularity, group_by, user_id)
+    start_bucket, end_bucket = get_bucket_start(start_dt, granularity), get_bucket_start(end_dt, granularity)
+    items = query_rollup_items(rollup_key, start_bucket, end_bucket)
+
+    buckets = {}
+    for item in items:
+        bucket_start, group_id = item[BUCKET_DDB_KEY].split('#', 1)
+        feature_count = int(item.get(FEATURE_COUNT_DDB_KEY, 0))
+        buckets.setdefault(bucket_start, []).append({
+            'id': group_id,
+            'name': item.get(GROUP_NAME_DDB_KEY),
+            'listenedMinutes': round(float(item[LISTENED_MS_DDB_KEY]) / 60000, 3),
+            'playCount': int(item[PLAY_COUNT_DDB_KEY]),
+            'averageFeatures': {feature: round(float(item[feature]) / feature_count, 6) if feature_count > 0 else None
+                                for feature in AVERAGED_FEATURES},
+        })
+
+    return [{'bucket': bucket_start,
+             'groups': sorted(groups, key=lambda group: group['listenedMinutes'], reverse=True)[:limit]}
+            for bucket_start, groups in sorted(buckets.items())]
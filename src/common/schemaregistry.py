@@ -0,0 +1,96 @@
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+
+# Registry of the pandas dtypes of the fields of all the stage schemas. Each (field_name, field_data_type) field has
+# the default dtype of its Python type, unless the field is registered with a more compact dtype below. Fields of list
+# types have no dtype, and are left as they are read.
+DEFAULT_DTYPES = {
+    int: np.dtype('int64'),
+    float: np.dtype('float64'),
+    bool: np.dtype('bool'),
+    str: np.dtype('object'),
+}
+
+CATEGORY_DTYPE = 'category'
+
+COMPACT_DTYPES = {
+    # Small integer codes
+    TrackerCommon.KEY[0]: np.dtype('int8'),
+    TrackerCommon.MODE[0]: np.dtype('int8'),
+    TrackerCommon.TIME_SIGNATURE[0]: np.dtype('int8'),
+
+    # Audio-features, which Spotify reports to no more than float32 precision
+    **{field: np.dtype('float32') for field in TrackerCommon.CONTINUOUS_AUDIO_FEATURES_SCHEMA},
+
+    # Strings with few distinct values, repeated across many rows
+    AlbumerCommon.TYPE[0]: CATEGORY_DTYPE,
+    AlbumerCommon.GENRE[0]: CATEGORY_DTYPE,
+    AlbumerCommon.LABEL[0]: CATEGORY_DTYPE,
+    ArtisterCommon.ARTIST_GENRE[0]: CATEGORY_DTYPE,
+}
+
+
+def get_dtype(typed_field: Tuple[str, classmethod]):
+    """
+    Returns the registered dtype of a (field_name, field_data_type) field, or None if it has none
+    """
+    return COMPACT_DTYPES.get(typed_field[0], DEFAULT_DTYPES.get(typed_field[1]))
+
+
+def get_dtypes(typed_schema: List[Tuple[str, classmethod]]) -> Dict[str, object]:
+    """
+    Returns the map of field name to registered dtype of the fields of a typed schema that have one
+    """
+    dtypes = {ts[0]: get_dtype(ts) for ts in typed_schema}
+    return {field: dtype for field, dtype in dtypes.items() if dtype is not None}
+
+
+def is_missing_value_free(dtype) -> bool:
+    """
+    Returns true if the dtype has no representation for missing values, i.e. for integer and boolean dtypes
+    """
+    return not isinstance(dtype, str) and dtype.kind in 'iub'
+
+
+def apply_dtypes(df: pd.DataFrame, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Converts the columns of a dataframe to the registered dtypes of their fields. Columns that already have their dtype
+    are left as they are, as are string columns, and integer or boolean columns with missing values.
+    """
+    conversions = {}
+    for field, dtype in get_dtypes(typed_schema).items():
+        if field not in df.columns or df[field].dtype == dtype or dtype == DEFAULT_DTYPES[str]:
+            continue
+        if is_missing_value_free(dtype) and df[field].isna().any():
+            continue
+        conversions[field] = dtype
+    return df.astype(conversions) if len(conversions) > 0 else df
+
+
+def get_csv_dtypes(typed_schema: List[Tuple[str, classmethod]]) -> Dict[str, object]:
+    """
+    Returns the dtypes to parse the fields of a typed schema from CSV with. Integer and boolean fields are parsed by
+    inference instead, as they cannot be parsed with missing values, and converted afterwards by apply_dtypes.
+    """
+    return {field: dtype for field, dtype in get_dtypes(typed_schema).items() if not is_missing_value_free(dtype)}
+
+
+def get_arrow_type(typed_field: Tuple[str, classmethod], python_arrow_types: Dict[object, pa.DataType]) -> pa.DataType:
+    """
+    Returns the Arrow type a (field_name, field_data_type) field is stored with: the type of its compact dtype if it
+    is registered with one, else the type of its Python type in python_arrow_types
+    """
+    dtype = COMPACT_DTYPES.get(typed_field[0])
+    if dtype is None or dtype == CATEGORY_DTYPE:
+        return python_arrow_types[typed_field[1]]
+    return pa.from_numpy_dtype(dtype)
@@ -1,59 +1,403 @@
+from __future__ import annotations
+
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Tuple
 
-import boto3
+import os
+import re
+import time
+import shutil
+import tempfile
+import logging
+import functools
+import threading
+import contextlib
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
 from datetime import datetime
-import tekore as tk
-import pandas as pd
 import io
 
+from src.common import awsclients
+from src.common import spotifyscheduler
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, as not every Lambda needs them
+tk = lazy_import('tekore')
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+schemaregistry = lazy_import('src.common.schemaregistry')
+
+LOGGER = logging.getLogger()
+
 S3_BUCKET = 'soundprint-bucket'
 SECRET_ID = 'soundprint-db-secret'
 AURORA_DB = 'soundprintdb'
 AURORA_HISTORY_TABLE = 'soundprinthistory'
 
+TOKEN_STATE_TABLE = 'SpotifyTokenState'
+DDB_TOKEN_ITEM_KEY = {'spotify': 'prod'}
+DDB_CREDENTIALS_ITEM_KEY = {'spotify': 'Soundprint'}
+
+# DynamoDB table of listening rollups, pre-aggregated by the archiver for the stats API, see src/common/rollups.py
+ROLLUPS_TABLE = 'SoundprintListeningRollups'
+
+# Listeners other than the original account are identified by a user-id. Their token and credentials items are keyed
+# by the original keys suffixed with /<user-id>, and the item keyed by DDB_USERS_ITEM_KEY lists all their user-ids.
+# A user's credentials item holds their refresh token, and falls back to the original credentials item for the
+# client id and secret of the app.
+DDB_USERS_ITEM_KEY = {'spotify': 'users'}
+USER_IDS_DDB_KEY = 'userIds'
+
+# The listening cursor of an account is the epoch time in milliseconds of its most recent archived play. It is stored
+# in the token state table, keyed by DDB_CURSOR_ITEM_KEY suffixed with /<user-id> for users other than the original
+# account, and only ever moves forward.
+DDB_CURSOR_ITEM_KEY = {'spotify': 'cursor'}
+LISTENING_CURSOR_DDB_KEY = 'playedAtMs'
+
+# Spotify throttles the requests of the app as a whole, so the time until which Spotify asked the app to wait after
+# throttling a request is stored in the token state table, for the request schedulers of all stages (see
+# spotifyscheduler). It only ever moves forward.
+DDB_THROTTLE_ITEM_KEY = {'spotify': 'throttle'}
+THROTTLED_UNTIL_DDB_KEY = 'throttledUntilMs'
+
+ACCESS_TOKEN_DDB_KEY = 'accessToken'
+EXPIRES_AT_DDB_KEY = 'expiresAt'
+REFRESH_LOCKED_UNTIL_DDB_KEY = 'refreshLockedUntil'
+
+CLIENT_ID_DDB_KEY = 'clientId'
+CLIENT_SECRET_DDB_KEY = 'clientSecret'
+REFRESH_TOKEN_DDB_KEY = 'refreshToken'
+
+# Refreshed access tokens are stored as expiring after ACCESS_TOKEN_LIFETIME_SECS, and are treated as expired
+# ACCESS_TOKEN_EXPIRY_MARGIN_SECS before that so that a token does not expire while a stage is using it
+ACCESS_TOKEN_LIFETIME_SECS = 3200
+ACCESS_TOKEN_EXPIRY_MARGIN_SECS = 60
+
+# A stage refreshing the access token holds the refresh lock for at most TOKEN_REFRESH_LOCK_SECS, while other stages
+# poll for the refreshed token every TOKEN_REFRESH_POLL_SECS
+TOKEN_REFRESH_LOCK_SECS = 30
+TOKEN_REFRESH_POLL_SECS = 0.5
+
+# In-memory cache of access tokens that survives warm invocations: token item key -> (access_token, expires_at).
+# Each token item has its own lock, so tokens of different users are refreshed concurrently.
+ACCESS_TOKEN_CACHE = {}
+ACCESS_TOKEN_LOCKS = {}
+ACCESS_TOKEN_LOCK = threading.Lock()
+
+# S3 files and archive tables of a user other than the original account are kept under users/<user-id>/ and in
+# tables suffixed with _<user-id> respectively
+USER_FILE_PATH_INFIX = 'users/'
+USER_ID_REGEX = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
 
-def get_access_token():
+# Environment variables overriding the lookup of the DB secret and Aurora cluster ARNs
+DB_SECRET_ARN_ENV = 'SOUNDPRINT_DB_SECRET_ARN'
+AURORA_CLUSTER_ARN_ENV = 'SOUNDPRINT_AURORA_CLUSTER_ARN'
+
+# Stages querying Spotify trigger the wake-up of the Aurora serverless cluster as soon as they find plays to archive,
+# so that the cluster resumes while they fetch metadata rather than when the archiver needs it. The trigger is a cheap
+# statement sent with a short timeout and a single attempt, whose outcome is not waited for.
+AURORA_EARLY_WAKEUP = os.environ.get('SOUNDPRINT_AURORA_EARLY_WAKEUP', 'true').lower() == 'true'
+AURORA_WAKEUP_SQL = 'SELECT 1'
+
+# Storage format of all stage files written under history/. Files are read according to their own extension,
+# so files written in another format (e.g. legacy CSV files) remain readable
+STORAGE_FORMAT = os.environ.get('SOUNDPRINT_STORAGE_FORMAT', 'parquet')
+PARQUET_COMPRESSION = 'zstd'
+
+# Compression codec of files whose name ends with one of these extensions after the storage format's, e.g.
+# history/data/1-1-1-2021.csv.gz. Files are compressed and decompressed as they are streamed to and from S3.
+FILE_COMPRESSIONS = {
+    'gz': 'gzip',
+    'zst': 'zstd',
+}
+
+# Files written to (or, when random access is needed, read from) S3 are spooled in memory up to this size and on disk
+# beyond it, and files larger than the multipart threshold are uploaded in parts of the multipart chunk size
+S3_SPOOL_MAX_BYTES = int(os.environ.get('SOUNDPRINT_S3_SPOOL_MAX_BYTES', 8 * 2**20))
+S3_MULTIPART_THRESHOLD_BYTES = int(os.environ.get('SOUNDPRINT_S3_MULTIPART_THRESHOLD_BYTES', 16 * 2**20))
+S3_MULTIPART_CHUNK_BYTES = int(os.environ.get('SOUNDPRINT_S3_MULTIPART_CHUNK_BYTES', 8 * 2**20))
+S3_STREAM_COPY_BYTES = 2**20
+
+# Number of rows per dataframe chunk read by iter_df_chunks_from_s3
+DF_CHUNK_ROWS = int(os.environ.get('SOUNDPRINT_DF_CHUNK_ROWS', 100000))
+
+# Maximum number of Spotify Web API requests in flight at once when fetching in concurrent mode
+SPOTIFY_MAX_CONCURRENCY = int(os.environ.get('SOUNDPRINT_SPOTIFY_MAX_CONCURRENCY', 4))
+
+
+@functools.lru_cache(maxsize=None)
+def get_arrow_types() -> dict:
+    """
+    Returns the map of Python type to the Arrow type fields of the type are stored with, built on first use so that
+    pyarrow is only imported when needed
+    """
+    return {
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        bool: pa.bool_(),
+        List[str]: pa.list_(pa.string()),
+        List[int]: pa.list_(pa.int64()),
+        List[List[str]]: pa.list_(pa.list_(pa.string())),
+    }
+
+
+def get_token_item_key(user_id: Optional[str] = None) -> dict:
+    """
+    Returns the key of the token item of the given user, or of the original account if user_id is None
     """
-    Returns an access token for interfacing with Spotify Web API. Refreshes it if needed.
+    if user_id is None:
+        return DDB_TOKEN_ITEM_KEY
+    return {'spotify': f"{DDB_TOKEN_ITEM_KEY['spotify']}/{validate_user_id(user_id)}"}
+
+
+def get_credentials_item_key(user_id: Optional[str] = None) -> dict:
+    """
+    Returns the key of the credentials item of the given user, or of the original account if user_id is None
+    """
+    if user_id is None:
+        return DDB_CREDENTIALS_ITEM_KEY
+    return {'spotify': f"{DDB_CREDENTIALS_ITEM_KEY['spotify']}/{validate_user_id(user_id)}"}
+
+
+def validate_user_id(user_id: str) -> str:
+    """
+    Returns the user-id if it is safe to use in item keys, S3 keys and table names, else raises ValueError
+    """
+    if not USER_ID_REGEX.match(user_id):
+        raise ValueError(f"Invalid user-id: {user_id}; expected up to 64 letters, digits, '_' or '-'")
+    return user_id
+
+
+def get_cursor_item_key(user_id: Optional[str] = None) -> dict:
+    """
+    Returns the key of the listening cursor item of the given user, or of the original account if user_id is None
+    """
+    if user_id is None:
+        return DDB_CURSOR_ITEM_KEY
+    return {'spotify': f"{DDB_CURSOR_ITEM_KEY['spotify']}/{validate_user_id(user_id)}"}
+
+
+def get_listening_cursor(user_id: Optional[str] = None) -> Optional[int]:
+    """
+    Returns the epoch time in milliseconds of the most recent archived play of the given user, or None if nothing has
+    been archived for the user yet
+    """
+    ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+    cursor_item = ddb_table.get_item(Key=get_cursor_item_key(user_id), ConsistentRead=True).get('Item', {})
+    cursor_ms = cursor_item.get(LISTENING_CURSOR_DDB_KEY)
+    return int(cursor_ms) if cursor_ms is not None else None
+
+
+def advance_listening_cursor(cursor_ms: int, user_id: Optional[str] = None) -> bool:
+    """
+    Advances the listening cursor of the given user to the epoch time in milliseconds of its most recent archived play,
+    with a conditional write that only succeeds if the cursor is behind it, so that a late or retried run never moves
+    the cursor back
+    :return: True if the cursor was advanced
+    """
+    ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+    try:
+        ddb_table.update_item(
+            Key=get_cursor_item_key(user_id),
+            UpdateExpression=f"SET {LISTENING_CURSOR_DDB_KEY} = :cursor",
+            ConditionExpression=f"attribute_not_exists({LISTENING_CURSOR_DDB_KEY}) "
+                                f"OR {LISTENING_CURSOR_DDB_KEY} < :cursor",
+            ExpressionAttributeValues={':cursor': int(cursor_ms)}
+        )
+        return True
+    except ClientError as ce:
+        if ce.response.get('Error').get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise ce
+
+
+def get_spotify_throttled_until_ms() -> int:
+    """
+    Returns the epoch time in milliseconds until which Spotify last asked the app to wait, 0 if it never throttled it
+    """
+    ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+    throttle_item = ddb_table.get_item(Key=DDB_THROTTLE_ITEM_KEY).get('Item', {})
+    return int(throttle_item.get(THROTTLED_UNTIL_DDB_KEY, 0))
+
+
+def record_spotify_throttle(throttled_until_ms: int) -> bool:
+    """
+    Stores the epoch time in milliseconds until which Spotify asked the app to wait, with a conditional write that only
+    succeeds if it is later than the stored time
+    :return: True if the time was stored
+    """
+    ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+    try:
+        ddb_table.update_item(
+            Key=DDB_THROTTLE_ITEM_KEY,
+            UpdateExpression=f"SET {THROTTLED_UNTIL_DDB_KEY} = :throttled_until",
+            ConditionExpression=f"attribute_not_exists({THROTTLED_UNTIL_DDB_KEY}) "
+                                f"OR {THROTTLED_UNTIL_DDB_KEY} < :throttled_until",
+            ExpressionAttributeValues={':throttled_until': int(throttled_until_ms)}
+        )
+        return True
+    except ClientError as ce:
+        if ce.response.get('Error').get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise ce
+
+
+def get_user_ids() -> List[str]:
+    """
+    Returns the user-ids of all the listeners registered in the token store, other than the original account
+    """
+    ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+    users_item = ddb_table.get_item(Key=DDB_USERS_ITEM_KEY).get('Item', {})
+    return list(users_item.get(USER_IDS_DDB_KEY, []))
+
+
+def get_user_file_path_prefix(file_path_prefix: str, user_id: Optional[str] = None) -> str:
+    """
+    Returns the S3 file path prefix of the given user for a stage's prefix, e.g. history/listening/users/<user-id>/
+    """
+    if user_id is None:
+        return file_path_prefix
+    return f"{file_path_prefix}{USER_FILE_PATH_INFIX}{validate_user_id(user_id)}/"
+
+
+def get_user_id_from_file_name(file_name: str) -> Optional[str]:
+    """
+    Returns the user-id of the user a stage file belongs to, or None if it belongs to the original account
+    """
+    user_match = re.search(rf"/{USER_FILE_PATH_INFIX}([^/]+)/", file_name)
+    return user_match.group(1) if user_match is not None else None
+
+
+def get_user_table_name(table_name: str, user_id: Optional[str] = None) -> str:
+    """
+    Returns the name of the given user's archive table, e.g. soundprinthistory_<user-id>. User-ids may contain '-',
+    which is replaced with '_' to keep the table name unquoted.
+    """
+    if user_id is None:
+        return table_name
+    return f"{table_name}_{validate_user_id(user_id).replace('-', '_')}"
+
+
+def get_access_token_lock(token_cache_key: str) -> threading.Lock:
+    """
+    Returns the in-process lock for refreshing the token of the given token item key
+    """
+    with ACCESS_TOKEN_LOCK:
+        return ACCESS_TOKEN_LOCKS.setdefault(token_cache_key, threading.Lock())
+
+
+def get_access_token(user_id: Optional[str] = None):
+    """
+    Returns an access token for interfacing with Spotify Web API on behalf of the given user, or of the original account
+    if user_id is None. Refreshes it if needed.
+    The token is cached in memory until shortly before it expires, so warm invocations don't read the token store.
+    Refreshing is single-flight: across threads by an in-process lock, and across concurrently running stages by a
+    conditional lock on the stored token, so that only one of them calls Spotify's refresh endpoint while the others
+    wait for the refreshed token to be stored.
     :return: String access token
     """
-    ddb_token_item_key = {'spotify': 'prod'}
-    ddb_credentials_item_key = {'spotify': 'Soundprint'}
+    token_item_key = get_token_item_key(user_id)
+    token_cache_key = token_item_key['spotify']
+
+    with get_access_token_lock(token_cache_key):
+        cached_token = ACCESS_TOKEN_CACHE.get(token_cache_key)
+        if cached_token is not None and is_token_valid(cached_token[1]):
+            return cached_token[0]
+
+        ddb_table = awsclients.get_dynamodb_table(TOKEN_STATE_TABLE)
+
+        wait_deadline = datetime.now().timestamp() + 2 * TOKEN_REFRESH_LOCK_SECS
+        while datetime.now().timestamp() < wait_deadline:
+            # Get currently stored access token, and return it if it has not expired yet
+            current_token_item = ddb_table.get_item(Key=token_item_key, ConsistentRead=True).get('Item', {})
+            if is_token_valid(current_token_item.get(EXPIRES_AT_DDB_KEY, 0)):
+                access_token = current_token_item[ACCESS_TOKEN_DDB_KEY]
+                expires_at = float(current_token_item[EXPIRES_AT_DDB_KEY])
+                break
+
+            # If current token has expired, refresh it unless another stage is refreshing it already, in which case
+            # wait for the refreshed token to be stored
+            if acquire_token_refresh_lock(ddb_table, user_id):
+                access_token, expires_at = refresh_access_token(ddb_table, user_id)
+                break
+            time.sleep(TOKEN_REFRESH_POLL_SECS)
+        else:
+            raise Exception(f"Timed out waiting for access token to be refreshed in {TOKEN_STATE_TABLE}")
+
+        ACCESS_TOKEN_CACHE[token_cache_key] = (access_token, expires_at)
+        return access_token
+
+
+def get_spotify_client(user_id: Optional[str] = None) -> spotifyscheduler.ScheduledSpotify:
+    """
+    Returns a Spotify client of the given user, or of the original account if user_id is None, whose requests are
+    paced and retried by the process-wide Spotify request scheduler (see spotifyscheduler)
+    """
+    return spotifyscheduler.ScheduledSpotify(tk.Spotify(get_access_token(user_id)))
+
 
-    access_token_ddb_key = 'accessToken'
-    expires_at_ddb_key = 'expiresAt'
+def is_token_valid(expires_at) -> bool:
+    """
+    Returns true if a token expiring at the given epoch time in seconds is still valid for long enough to be used
+    """
+    return expires_at - ACCESS_TOKEN_EXPIRY_MARGIN_SECS > datetime.now().timestamp()
 
-    client_id_ddb_key = 'clientId'
-    client_secret_ddb_key = 'clientSecret'
-    refresh_token_ddb_key = 'refreshToken'
 
-    ddb_table = boto3.resource('dynamodb').Table('SpotifyTokenState')
+def acquire_token_refresh_lock(ddb_table, user_id: Optional[str] = None) -> bool:
+    """
+    Attempts to lock the stored access token for refreshing it, with a conditional write that only succeeds if no other
+    stage holds an unexpired lock on it. The lock is released when the refreshed token item is stored.
+    :return: True if the lock was acquired
+    """
+    now = int(datetime.now().timestamp())
+    try:
+        ddb_table.update_item(
+            Key=get_token_item_key(user_id),
+            UpdateExpression=f"SET {REFRESH_LOCKED_UNTIL_DDB_KEY} = :locked_until",
+            ConditionExpression=f"attribute_not_exists({REFRESH_LOCKED_UNTIL_DDB_KEY}) "
+                                f"OR {REFRESH_LOCKED_UNTIL_DDB_KEY} < :now",
+            ExpressionAttributeValues={':locked_until': now + TOKEN_REFRESH_LOCK_SECS, ':now': now}
+        )
+        return True
+    except ClientError as ce:
+        if ce.response.get('Error').get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise ce
 
-    # Get currently stored access token
-    current_token_item = ddb_table.get_item(Key=ddb_token_item_key)['Item']
 
-    if current_token_item[expires_at_ddb_key] > datetime.now().timestamp():
-        # If current token has not expired yet, return it
-        return current_token_item[access_token_ddb_key]
-    else:
-        # If current token has expired, refresh it and update token store,
-        # then attempt getting stored token again
-        credentials_item = ddb_table.get_item(Key=ddb_credentials_item_key)['Item']
-        client_id = credentials_item[client_id_ddb_key]
-        client_secret = credentials_item[client_secret_ddb_key]
-        refresh_token = credentials_item[refresh_token_ddb_key]
+def refresh_access_token(ddb_table, user_id: Optional[str] = None) -> Tuple[str, int]:
+    """
+    Refreshes the access token of the given user with Spotify and stores it in the token store, releasing the refresh
+    lock
+    :return: Tuple of the refreshed access token and the epoch time in seconds at which it expires
+    """
+    credentials_item = ddb_table.get_item(Key=DDB_CREDENTIALS_ITEM_KEY)['Item']
+    if user_id is not None:
+        credentials_item = dict(credentials_item)
+        credentials_item.update(ddb_table.get_item(Key=get_credentials_item_key(user_id))['Item'])
+    client_id = credentials_item[CLIENT_ID_DDB_KEY]
+    client_secret = credentials_item[CLIENT_SECRET_DDB_KEY]
+    refresh_token = credentials_item[REFRESH_TOKEN_DDB_KEY]
 
-        refreshing_token = tk.refresh_user_token(client_id, client_secret, refresh_token)
+    refreshing_token = tk.refresh_user_token(client_id, client_secret, refresh_token)
 
-        new_token_item = {
-            access_token_ddb_key: refreshing_token.access_token,
-            expires_at_ddb_key: int(datetime.now().timestamp()) + 3200
-        }
-        new_token_item.update(ddb_token_item_key)
+    new_token_item = {
+        ACCESS_TOKEN_DDB_KEY: refreshing_token.access_token,
+        EXPIRES_AT_DDB_KEY: int(datetime.now().timestamp()) + ACCESS_TOKEN_LIFETIME_SECS
+    }
+    new_token_item.update(get_token_item_key(user_id))
 
-        ddb_table.put_item(Item=new_token_item)
-        return get_access_token()
+    ddb_table.put_item(Item=new_token_item)
+    return new_token_item[ACCESS_TOKEN_DDB_KEY], new_token_item[EXPIRES_AT_DDB_KEY]
 
 
 def update_dict_by_schema(dictt: dict, schema_field: Tuple[str, classmethod], value):
@@ -64,83 +408,418 @@ def update_dict_by_schema(dictt: dict, schema_field: Tuple[str, classmethod], va
     dictt[schema_field[0]] = schema_field[1](value)
 
 
-def upload_df_to_s3_csv(df: pd.DataFrame, include_index: bool, file_name: str):
+def typed_schema_to_arrow_schema(typed_schema: List[Tuple[str, classmethod]],
+                                 dictionary_fields: List[str] = None) -> pa.Schema:
     """
-    Uploads a pandas dataframe to S3 bucket spotify-listener-bucket as a CSV file
-    :param df: dataframe to upload
-    :param include_index: if true, includes index values of dataframe into the csv file as a column
-    :param file_name: s3 file path for CSV file in the bucket
+    Converts a typed schema of (field_name, field_data_type) tuples into the equivalent Arrow schema, with the compact
+    types of the fields registered with compact dtypes in the schema registry.
+    Fields named in dictionary_fields are dictionary-encoded, which is how pandas categoricals are stored.
     """
-    assert file_name.endswith('.csv'), f"{file_name} does not end with .csv"
+    if dictionary_fields is None:
+        dictionary_fields = []
 
-    csv_string_buffer = io.StringIO()
-    df.to_csv(csv_string_buffer, index=include_index)
-    csv_string = csv_string_buffer.getvalue()
-    csv_string_buffer.close()
+    arrow_fields = []
+    for ts in typed_schema:
+        arrow_type = schemaregistry.get_arrow_type(ts, get_arrow_types())
+        if ts[0] in dictionary_fields:
+            arrow_type = pa.dictionary(pa.int32(), arrow_type)
+        arrow_fields.append((ts[0], arrow_type))
+    return pa.schema(arrow_fields)
 
-    s3 = boto3.client('s3')
-    s3.put_object(Bucket=S3_BUCKET, Key=file_name, Body=bytes(csv_string, 'utf-8'))
+
+def write_df_chunks_csv(df_chunks: Iterable[pd.DataFrame], stream, include_index: bool,
+                        typed_schema: List[Tuple[str, classmethod]]):
+    """
+    Writes pandas dataframe chunks one after the other to a binary stream as a single CSV file, with the header of the
+    first chunk. CSV carries no types, so typed_schema is unused.
+    """
+    for chunk_index, df in enumerate(df_chunks):
+        df.to_csv(stream, index=include_index, header=chunk_index == 0)
 
 
-def download_df_from_s3_csv(file_name: str, expected_schema: List[str]) -> pd.DataFrame:
+def get_csv_read_kwargs(typed_schema: List[Tuple[str, classmethod]]) -> dict:
     """
-    Downloads a CSV file from S3 and creates a pandas dataframe with the contents
-    :param file_name: bucket key name for the file to be downloaded
-    :param expected_schema: Expected schema of the dataframe
-    :return: pandas DataFrame object populated with the file's contents
+    Returns the read_csv arguments that parse only the columns of the typed schema, with the dtypes registered for
+    them in the schema registry rather than by inference
+    """
+    if typed_schema is None:
+        return {}
+    return {'usecols': list(map(lambda ts: ts[0], typed_schema)), 'dtype': schemaregistry.get_csv_dtypes(typed_schema)}
+
+
+def read_df_csv(stream, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Parses a CSV file from a binary stream into a pandas dataframe. If a typed schema is given, only its columns are
+    parsed, with the dtypes registered for them in the schema registry rather than by inference.
     """
-    assert file_name.endswith('.csv'), f"{file_name} does not end with .csv"
+    df = pd.read_csv(stream, **get_csv_read_kwargs(typed_schema))
+    if typed_schema is None:
+        return df
+    return schemaregistry.apply_dtypes(df[list(map(lambda ts: ts[0], typed_schema))], typed_schema)
+
 
-    s3 = boto3.client('s3')
+def iter_df_chunks_csv(stream, typed_schema: List[Tuple[str, classmethod]], chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """
+    Parses a CSV file from a binary stream into pandas dataframes of at most chunk_rows rows each, as read_df_csv does
+    """
+    with pd.read_csv(stream, chunksize=chunk_rows, **get_csv_read_kwargs(typed_schema)) as reader:
+        for df in reader:
+            if typed_schema is None:
+                yield df
+            else:
+                yield schemaregistry.apply_dtypes(df[list(map(lambda ts: ts[0], typed_schema))], typed_schema)
+
+
+def df_to_arrow_table(df: pd.DataFrame, include_index: bool, typed_schema: List[Tuple[str, classmethod]]) -> pa.Table:
+    """
+    Converts a pandas dataframe into an Arrow table. If a typed schema is provided, the columns are converted to the
+    corresponding Arrow types so that they are read back with the same dtypes. Categorical columns are
+    dictionary-encoded and read back as categoricals.
+    """
+    if include_index or typed_schema is None:
+        return pa.Table.from_pandas(df, preserve_index=include_index)
+
+    categorical_fields = [ts[0] for ts in typed_schema if isinstance(df[ts[0]].dtype, pd.CategoricalDtype)]
+    arrow_schema = typed_schema_to_arrow_schema(typed_schema, categorical_fields)
+    return pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False)
+
+
+def write_df_chunks_parquet(df_chunks: Iterable[pd.DataFrame], stream, include_index: bool,
+                            typed_schema: List[Tuple[str, classmethod]]):
+    """
+    Writes pandas dataframe chunks to a binary stream as a single compressed Parquet file, with a row group per chunk.
+    The chunks are converted as df_to_arrow_table does, and must all convert to the same Arrow schema.
+    """
+    parquet_writer = None
+    try:
+        for df in df_chunks:
+            table = df_to_arrow_table(df, include_index, typed_schema)
+            if parquet_writer is None:
+                parquet_writer = pq.ParquetWriter(stream, table.schema, compression=PARQUET_COMPRESSION)
+            parquet_writer.write_table(table)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+
+def read_df_parquet(seekable_file, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Parses a Parquet file into a pandas dataframe, reading only the columns of the typed schema if given. Columns of
+    files written before their fields were registered with compact dtypes are converted to those dtypes.
+    """
+    columns = list(map(lambda ts: ts[0], typed_schema)) if typed_schema is not None else None
+    df = pq.read_table(seekable_file, columns=columns).to_pandas()
+    if typed_schema is None:
+        return df
+    return schemaregistry.apply_dtypes(df, typed_schema)
+
+
+def iter_df_chunks_parquet(seekable_file, typed_schema: List[Tuple[str, classmethod]],
+                           chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """
+    Parses a Parquet file into pandas dataframes of at most chunk_rows rows each, as read_df_parquet does. Chunks do
+    not span the file's row groups, so they may have fewer rows.
+    """
+    columns = list(map(lambda ts: ts[0], typed_schema)) if typed_schema is not None else None
+    for record_batch in pq.ParquetFile(seekable_file).iter_batches(batch_size=chunk_rows, columns=columns):
+        df = pa.Table.from_batches([record_batch]).to_pandas()
+        yield df if typed_schema is None else schemaregistry.apply_dtypes(df, typed_schema)
+
+
+def serialize_df_csv(df: pd.DataFrame, include_index: bool, typed_schema: List[Tuple[str, classmethod]]) -> bytes:
+    """
+    Serializes a pandas dataframe into the bytes of a CSV file
+    """
+    csv_bytes_buffer = io.BytesIO()
+    write_df_chunks_csv([df], csv_bytes_buffer, include_index, typed_schema)
+    return csv_bytes_buffer.getvalue()
+
+
+def deserialize_df_csv(body: bytes, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Parses the bytes of a CSV file into a pandas dataframe, see read_df_csv
+    """
+    return read_df_csv(io.BytesIO(body), typed_schema)
+
+
+def serialize_df_parquet(df: pd.DataFrame, include_index: bool,
+                         typed_schema: List[Tuple[str, classmethod]]) -> bytes:
+    """
+    Serializes a pandas dataframe into the bytes of a compressed Parquet file, see write_df_chunks_parquet
+    """
+    parquet_bytes_buffer = io.BytesIO()
+    write_df_chunks_parquet([df], parquet_bytes_buffer, include_index, typed_schema)
+    return parquet_bytes_buffer.getvalue()
+
+
+def deserialize_df_parquet(body: bytes, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Parses the bytes of a Parquet file into a pandas dataframe, see read_df_parquet
+    """
+    return read_df_parquet(io.BytesIO(body), typed_schema)
+
+
+# Storage format name -> (chunks writer, reader, chunks reader, whether reading needs random access). The format of a
+# file is identified by its extension. Writers and readers stream the file; Parquet files are read from their footer
+# first, so they are spooled before they are read.
+STORAGE_FORMATS = {
+    'csv': (write_df_chunks_csv, read_df_csv, iter_df_chunks_csv, False),
+    'parquet': (write_df_chunks_parquet, read_df_parquet, iter_df_chunks_parquet, True),
+}
+
+
+def split_compression_extension(file_name: str) -> Tuple[str, Optional[str]]:
+    """
+    Splits the compression extension off a file name, e.g. history/data/1-1-1-2021.csv.gz into
+    (history/data/1-1-1-2021.csv, 'gzip'), or returns (file_name, None) if it has none
+    """
+    base_name, _, extension = file_name.rpartition('.')
+    if extension in FILE_COMPRESSIONS and base_name:
+        return base_name, FILE_COMPRESSIONS[extension]
+    return file_name, None
+
+
+def get_storage_format(file_name: str) -> str:
+    """
+    Returns the storage format of a file by its extension, e.g. 'parquet' for history/data/1-1-1-2021.parquet or
+    'csv' for history/data/1-1-1-2021.csv.gz
+    """
+    storage_format = split_compression_extension(file_name)[0].rsplit('.', 1)[-1]
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"{file_name} does not have a supported storage format: {list(STORAGE_FORMATS)}")
+    return storage_format
+
+
+def get_file_extension() -> str:
+    """
+    Returns the file extension, including the leading dot, for files written in the configured STORAGE_FORMAT
+    """
+    return f".{STORAGE_FORMAT}"
+
+
+def upload_bytes_to_s3(body: bytes, file_name: str):
+    """
+    Uploads raw bytes to the S3 bucket under the given file name
+    """
+    s3 = awsclients.get_client('s3')
+    s3.put_object(Bucket=S3_BUCKET, Key=file_name, Body=body)
+
+
+def download_bytes_from_s3(file_name: str) -> bytes:
+    """
+    Downloads the raw bytes of a file in the S3 bucket
+    """
+    s3 = awsclients.get_client('s3')
     s3_response = s3.get_object(Bucket=S3_BUCKET, Key=file_name)
+    return s3_response.get('Body').read()
+
+
+def list_s3_keys(prefix: str) -> List[str]:
+    """
+    Returns the keys of all the files in the S3 bucket under the given prefix, following the listing's pagination
+    """
+    s3 = awsclients.get_client('s3')
+    keys = []
+    list_kwargs = {'Bucket': S3_BUCKET, 'Prefix': prefix}
+    while True:
+        s3_response = s3.list_objects_v2(**list_kwargs)
+        keys += [content['Key'] for content in s3_response.get('Contents', [])]
+        if not s3_response.get('IsTruncated'):
+            return keys
+        list_kwargs['ContinuationToken'] = s3_response['NextContinuationToken']
+
+
+class UnclosedFile:
+    """
+    Proxy of a file-object that leaves the file open when closed, for streams that close the file they wrap
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def open_s3_read_stream(file_name: str, seekable: bool = False):
+    """
+    Opens a binary stream of the contents of a file in the S3 bucket, decompressed as it is read if the file name has
+    a compression extension (see FILE_COMPRESSIONS), without holding the whole file in memory.
+    :param seekable: if true, the stream is first spooled into a file supporting random access, in memory up to
+    S3_SPOOL_MAX_BYTES and on disk beyond it
+    """
+    s3 = awsclients.get_client('s3')
+    body = s3.get_object(Bucket=S3_BUCKET, Key=file_name)['Body']
+    compression = split_compression_extension(file_name)[1]
+    try:
+        with contextlib.ExitStack() as exit_stack:
+            stream = body
+            if compression is not None:
+                stream = exit_stack.enter_context(pa.CompressedInputStream(pa.PythonFile(body, mode='r'), compression))
+            if seekable:
+                spool_file = exit_stack.enter_context(tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_BYTES))
+                shutil.copyfileobj(stream, spool_file, S3_STREAM_COPY_BYTES)
+                spool_file.seek(0)
+                stream = spool_file
+            yield stream
+    finally:
+        body.close()
+
+
+@contextlib.contextmanager
+def open_s3_write_stream(file_name: str):
+    """
+    Opens a binary stream to write a file to the S3 bucket, compressed as it is written if the file name has a
+    compression extension (see FILE_COMPRESSIONS). The written contents are spooled in memory up to
+    S3_SPOOL_MAX_BYTES and on disk beyond it, and uploaded when the stream is closed without an error, in parts if
+    they are larger than S3_MULTIPART_THRESHOLD_BYTES.
+    """
+    compression = split_compression_extension(file_name)[1]
+    with tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_BYTES) as spool_file:
+        if compression is None:
+            yield spool_file
+        else:
+            with pa.CompressedOutputStream(pa.PythonFile(UnclosedFile(spool_file), mode='w'), compression) as stream:
+                yield stream
+
+        spool_file.seek(0)
+        s3 = awsclients.get_client('s3')
+        transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD_BYTES,
+                                         multipart_chunksize=S3_MULTIPART_CHUNK_BYTES)
+        s3.upload_fileobj(spool_file, S3_BUCKET, file_name, Config=transfer_config)
+
+
+def upload_df_chunks_to_s3(df_chunks: Iterable[pd.DataFrame], include_index: bool, file_name: str,
+                           typed_schema: List[Tuple[str, classmethod]] = None):
+    """
+    Uploads pandas dataframe chunks with the same columns to the S3 bucket as a single file, streaming each chunk into
+    the file as it is produced, so that only one chunk needs to be held in memory at a time. See upload_df_to_s3.
+    """
+    chunks_writer, _, _, _ = STORAGE_FORMATS[get_storage_format(file_name)]
+    with open_s3_write_stream(file_name) as stream:
+        chunks_writer(df_chunks, stream, include_index, typed_schema)
+
+
+def upload_df_to_s3(df: pd.DataFrame, include_index: bool, file_name: str,
+                    typed_schema: List[Tuple[str, classmethod]] = None):
+    """
+    Uploads a pandas dataframe to the S3 bucket, serialized in the storage format identified by the file's extension
+    and streamed into the file, compressed if the file name ends with a compression extension (see FILE_COMPRESSIONS)
+    :param df: dataframe to upload
+    :param include_index: if true, includes index values of dataframe into the file as a column
+    :param file_name: s3 file path for the file in the bucket, ending with .parquet or .csv, optionally followed by
+    .gz or .zst
+    :param typed_schema: (field_name, field_data_type) schema of the dataframe, written along with the data by
+    formats that carry types
+    """
+    upload_df_chunks_to_s3([df], include_index, file_name, typed_schema)
 
-    csv_string = str(s3_response.get('Body').read(), encoding='utf-8')
-    csv_string_buffer = io.StringIO(csv_string)
-    df = pd.read_csv(csv_string_buffer)
-    csv_string_buffer.close()
 
+def download_df_from_s3(file_name: str, typed_schema: List[Tuple[str, classmethod]]) -> pd.DataFrame:
+    """
+    Downloads a file from S3 and creates a pandas dataframe with the contents. The file is parsed as it is streamed,
+    according to the storage format identified by its extension, so legacy CSV files can still be read.
+    :param file_name: bucket key name for the file to be downloaded
+    :param typed_schema: Expected (field_name, field_data_type) schema of the dataframe
+    :return: pandas DataFrame object populated with the file's contents
+    """
+    _, reader, _, needs_random_access = STORAGE_FORMATS[get_storage_format(file_name)]
+    with open_s3_read_stream(file_name, seekable=needs_random_access) as stream:
+        df = reader(stream, typed_schema)
+
+    expected_schema = list(map(lambda ts: ts[0], typed_schema))
     assert list(df.columns) == expected_schema, \
         f"{file_name} does not match expected schema; expected: {expected_schema}, actual: {df.columns}"
 
     return df
 
 
-def normalize_dict_field_list(dictt: dict, field_values: List, schema_field: Tuple[str, classmethod]) -> List[dict]:
+def iter_df_chunks_from_s3(file_name: str, typed_schema: List[Tuple[str, classmethod]],
+                           chunk_rows: int = DF_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
     """
-    Given a dictionary, a field-key and a list of values for the field, returns a list of dictionaries where each
-    dictionary has a mapping of field-key to one of the values in the list of field-values
-    :param dictt: Common dictionary that will feature in the list of normalized dictionaries
-    :param field_values: List of field-values to normalize the common dictionary by
-    :param schema_field: The field's schema key: (field_name, field_data_type)
-    :return: List of normalized dictionaries where each dictionary contains a unique field-value mapped to the field-key
+    Downloads a file from S3 as pandas dataframes of at most chunk_rows rows each, parsed as the file is streamed, so
+    that files too large to be held in memory as a single dataframe can be processed chunk by chunk. Chunks of
+    categorical columns may have different categories. See download_df_from_s3.
     """
-    if len(field_values) == 0:
-        return [dictt]
-    else:
-        normalized_list = []
-        for value in field_values:
-            normalized_dict = {schema_field[0]: schema_field[1](value)}
-            normalized_dict.update(dictt)
-            normalized_list.append(normalized_dict)
-        return normalized_list
+    expected_schema = list(map(lambda ts: ts[0], typed_schema))
+    _, _, chunks_reader, needs_random_access = STORAGE_FORMATS[get_storage_format(file_name)]
+    with open_s3_read_stream(file_name, seekable=needs_random_access) as stream:
+        for df in chunks_reader(stream, typed_schema, chunk_rows):
+            assert list(df.columns) == expected_schema, \
+                f"{file_name} does not match expected schema; expected: {expected_schema}, actual: {df.columns}"
+            yield df
 
 
+@functools.lru_cache(maxsize=None)
 def get_db_secrets_arn() -> str:
     """
-    Returns the arn for the AWS Secrets Manager holding the secrets for DB operations
+    Returns the arn for the AWS Secrets Manager holding the secrets for DB operations.
+    Uses the SOUNDPRINT_DB_SECRET_ARN environment variable if set, else looks it up. The arn is resolved on first use
+    and cached for the lifetime of the container.
     """
-    secrets_client = boto3.client('secretsmanager')
+    if os.environ.get(DB_SECRET_ARN_ENV):
+        return os.environ[DB_SECRET_ARN_ENV]
+
+    secrets_client = awsclients.get_client('secretsmanager')
     return secrets_client.describe_secret(SecretId=SECRET_ID)['ARN']
 
 
+@functools.lru_cache(maxsize=None)
 def get_rds_cluster_arn() -> str:
     """
-    Returns the Aurora Cluster ARN for the Aurora DB
+    Returns the Aurora Cluster ARN for the Aurora DB.
+    Uses the SOUNDPRINT_AURORA_CLUSTER_ARN environment variable if set, else looks it up by the database name among all
+    clusters. The arn is resolved on first use and cached for the lifetime of the container.
     :return:
     """
-    rds_client = boto3.client('rds')
+    if os.environ.get(AURORA_CLUSTER_ARN_ENV):
+        return os.environ[AURORA_CLUSTER_ARN_ENV]
+
+    rds_client = awsclients.get_client('rds')
     db_clusters = rds_client.describe_db_clusters()['DBClusters']
     for db_cluster in db_clusters:
         if db_cluster['DatabaseName'] == AURORA_DB:
             return db_cluster['DBClusterArn']
     raise ValueError(f"Found no RDS Cluster matching expected database-name: {AURORA_DB}")
+
+
+def trigger_aurora_wakeup() -> bool:
+    """
+    Sends a statement to the Aurora serverless cluster without waiting for the cluster to be ready, which starts
+    resuming the cluster if it is paused. Failures are logged and ignored, as the archiver waits for the cluster anyway.
+    Does nothing unless SOUNDPRINT_AURORA_EARLY_WAKEUP is enabled.
+    :return: True if the cluster answered, i.e. it was already awake
+    """
+    if not AURORA_EARLY_WAKEUP:
+        return False
+    try:
+        awsclients.get_client('rds-data-wakeup').execute_statement(secretArn=get_db_secrets_arn(), database=AURORA_DB,
+                                                                   resourceArn=get_rds_cluster_arn(),
+                                                                   sql=AURORA_WAKEUP_SQL)
+        return True
+    except (ClientError, BotoCoreError) as error:
+        LOGGER.info(f"Triggered wake-up of Aurora Serverless Cluster: {AURORA_DB} ({type(error).__name__})")
+        return False
+
+
+def submit_chunked(executor: Executor, fetch_function: Callable[[List], List], ids: List,
+                   chunk_size: int) -> List[Future]:
+    """
+    Splits the list of ids into chunks of at most chunk_size ids and submits a call of fetch_function for each chunk
+    to the executor. Returns the futures of the calls in the order of the chunks.
+    """
+    return [executor.submit(fetch_function, ids[start:start + chunk_size]) for start in range(0, len(ids), chunk_size)]
+
+
+def gather_chunked(futures: List[Future]) -> List:
+    """
+    Waits for the futures returned by submit_chunked and concatenates their results in the order of the chunks,
+    so that the results stay aligned with the ids they were fetched for
+    """
+    results = []
+    for future in futures:
+        results += future.result()
+    return results
@@ -0,0 +1,391 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+
+from src.common.lazyimport import lazy_import
+
+tk = lazy_import('tekore')
+soundprintutils = lazy_import('src.common.soundprintutils')
+
+LOGGER = logging.getLogger()
+
+# Spotify rate-limits the requests of an app over a rolling window, answering with HTTP 429 and a Retry-After header
+# once the limit is hit. All the Spotify clients of a process make their requests through a shared scheduler, whose
+# token bucket paces the requests of every concurrent worker. The rate starts at the maximum and is halved whenever
+# Spotify throttles a request, then grows back by a small step with every request that succeeds, so that it settles
+# just below the rate Spotify sustains.
+# The limit is shared by every process making requests for the app, e.g. stage lambdas running at the same time, so a
+# throttled request is also recorded in the token state table, as the time until which Spotify asked the app to wait.
+# The process-wide scheduler reads that record at most every SHARED_THROTTLE_SYNC_SECS, and a throttle recorded by
+# another process since its last read pauses its token bucket and halves its rate as its own throttled requests do.
+# The token bucket's rate and the coalescing of lookups in flight (see COALESCED_METHODS) stay per process.
+MAX_REQUESTS_PER_SEC = float(os.environ.get('SOUNDPRINT_SPOTIFY_MAX_REQUESTS_PER_SEC', 10))
+MIN_REQUESTS_PER_SEC = float(os.environ.get('SOUNDPRINT_SPOTIFY_MIN_REQUESTS_PER_SEC', 0.5))
+BURST_REQUESTS = int(os.environ.get('SOUNDPRINT_SPOTIFY_BURST_REQUESTS', 10))
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_PER_REQUEST = 0.1
+
+# Throttled requests and requests failing with a server error are retried up to MAX_RETRIES times. Throttled requests
+# pause every worker until the Retry-After has passed, plus a random jitter so that the workers do not all resume at
+# once. A Retry-After longer than MAX_RETRY_AFTER_SECS, or than the time left in the Lambda invocation less
+# DEADLINE_RESERVE_SECS, could not be waited out and still leave time to finish the invocation, so it is raised.
+# Server errors are retried after an exponential backoff with full jitter.
+MAX_RETRIES = int(os.environ.get('SOUNDPRINT_SPOTIFY_MAX_RETRIES', 8))
+DEFAULT_RETRY_AFTER_SECS = 1.0
+MAX_RETRY_AFTER_SECS = float(os.environ.get('SOUNDPRINT_SPOTIFY_MAX_RETRY_AFTER_SECS', 60))
+DEADLINE_RESERVE_SECS = float(os.environ.get('SOUNDPRINT_SPOTIFY_DEADLINE_RESERVE_SECS', 30))
+RETRY_JITTER_SECS = 1.0
+BACKOFF_BASE_SECS = 0.5
+BACKOFF_MAX_SECS = 30.0
+SHARED_THROTTLE_SYNC_SECS = float(os.environ.get('SOUNDPRINT_SPOTIFY_SHARED_THROTTLE_SYNC_SECS', 2))
+
+# Methods looking up catalog entities by id, one or a list of them, by the method looking up a list of the same
+# entities. Concurrent lookups of the same id are coalesced into one request, whichever client and method they are made
+# with, and a lookup of many ids only requests the ids not already being looked up.
+COALESCED_METHODS = {
+    'track': 'tracks', 'tracks': 'tracks',
+    'track_audio_features': 'tracks_audio_features', 'tracks_audio_features': 'tracks_audio_features',
+    'album': 'albums', 'albums': 'albums', 'artist': 'artists', 'artists': 'artists',
+}
+
+SCHEDULER = None
+SCHEDULER_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket holding up to capacity tokens, refilled at an adjustable rate per second, which can be
+    paused for all its takers at once
+    """
+    def __init__(self, rate: float, capacity: int, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.refilled_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        if now > self.refilled_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+
+    def acquire(self) -> float:
+        """
+        Takes a token, waiting until one is available
+        :return: Seconds waited
+        """
+        waited_secs = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited_secs
+                wait_secs = max(self.refilled_at - now, 0) + (1 - self.tokens) / self.rate
+            time.sleep(wait_secs)
+            waited_secs += wait_secs
+
+    def pause(self, pause_secs: float):
+        """
+        Empties the bucket and stops refilling it for the given time, and lowers the refill rate
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens = 0.0
+            self.refilled_at = max(self.refilled_at, now + pause_secs)
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE_FACTOR)
+
+    def increase_rate(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE_PER_REQUEST)
+
+
+def get_retry_after_secs(error: Exception) -> float:
+    """
+    Returns the seconds to wait before retrying a throttled request, from the Retry-After header of its response
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    for header, value in headers.items():
+        if header.lower() == 'retry-after':
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                break
+    return DEFAULT_RETRY_AFTER_SECS
+
+
+def get_remaining_secs(context) -> Optional[float]:
+    """
+    Returns the seconds left in a Lambda invocation from its context, None if there is no context
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return context.get_remaining_time_in_millis() / 1000
+
+
+def freeze_arguments(args: tuple, kwargs: dict) -> tuple:
+    """
+    Returns a hashable key of the arguments of a call, with lists of ids converted to tuples
+    """
+    def freeze(value):
+        return tuple(value) if isinstance(value, list) else value
+    return tuple(map(freeze, args)), tuple(sorted((name, freeze(value)) for name, value in kwargs.items()))
+
+
+class SpotifyScheduler:
+    """
+    Scheduler of the Spotify Web API requests of a process, pacing them through a shared token bucket, retrying
+    throttled and failed requests, and coalescing concurrent lookups of the same ids. If share_throttles is true,
+    throttled requests are recorded in the token state table and the throttles recorded by other processes pause its
+    requests too. Counts its calls, retries and the time spent throttled in its counters.
+    """
+    def __init__(self, requests_per_sec: float = MAX_REQUESTS_PER_SEC, burst_requests: int = BURST_REQUESTS,
+                 max_retries: int = MAX_RETRIES, retry_jitter_secs: float = RETRY_JITTER_SECS,
+                 share_throttles: bool = False, sync_secs: float = SHARED_THROTTLE_SYNC_SECS):
+        self.token_bucket = TokenBucket(requests_per_sec, burst_requests, MIN_REQUESTS_PER_SEC)
+        self.max_retries = max_retries
+        self.retry_jitter_secs = retry_jitter_secs
+        self.share_throttles = share_throttles
+        self.sync_secs = sync_secs
+        self.synced_at = None
+        self.throttled_until_ms = 0
+        self.counters = Counter()
+        self.in_flight = {}
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    def set_deadline(self, remaining_secs: Optional[float]):
+        """
+        Sets the time left for the requests of the current invocation, bounding the Retry-After that is waited out.
+        None removes the bound, leaving only MAX_RETRY_AFTER_SECS.
+        """
+        self.deadline = time.monotonic() + remaining_secs if remaining_secs is not None else None
+
+    def get_max_retry_after_secs(self) -> float:
+        """
+        Returns the longest Retry-After that can be waited out, keeping DEADLINE_RESERVE_SECS before the deadline
+        """
+        if self.deadline is None:
+            return MAX_RETRY_AFTER_SECS
+        return min(MAX_RETRY_AFTER_SECS, self.deadline - time.monotonic() - DEADLINE_RESERVE_SECS)
+
+    def sync_throttle(self):
+        """
+        Reads the throttle recorded in the token state table, at most every sync_secs and by one thread at a time, and
+        pauses the token bucket until the recorded time if another process was throttled since the last read
+        """
+        if not self.share_throttles:
+            return
+        now = time.monotonic()
+        if (self.synced_at is not None and now - self.synced_at < self.sync_secs) or \
+                not self.sync_lock.acquire(blocking=False):
+            return
+        try:
+            self.synced_at = now
+            throttled_until_ms = soundprintutils.get_spotify_throttled_until_ms()
+        except (BotoCoreError, ClientError) as error:
+            LOGGER.warning(f"Could not read the shared Spotify throttle: {error}")
+            return
+        finally:
+            self.sync_lock.release()
+
+        with self.lock:
+            if throttled_until_ms <= self.throttled_until_ms:
+                return
+            self.throttled_until_ms = throttled_until_ms
+        # Throttles that have already passed are only remembered, so that they are not applied later
+        pause_secs = throttled_until_ms / 1000 - time.time()
+        if pause_secs > 0:
+            pause_secs += random.uniform(0, self.retry_jitter_secs)
+            LOGGER.warning(f"Spotify throttled another stage, pausing requests for {pause_secs:.2f}s")
+            self.count('shared_throttled')
+            self.count('throttled_secs', pause_secs)
+            self.token_bucket.pause(pause_secs)
+
+    def record_throttle(self, retry_after_secs: float):
+        """
+        Records the time until which Spotify asked the app to wait in the token state table, for other processes
+        """
+        if not self.share_throttles:
+            return
+        throttled_until_ms = int((time.time() + retry_after_secs) * 1000)
+        with self.lock:
+            self.throttled_until_ms = max(self.throttled_until_ms, throttled_until_ms)
+        try:
+            soundprintutils.record_spotify_throttle(throttled_until_ms)
+        except (BotoCoreError, ClientError) as error:
+            LOGGER.warning(f"Could not record the Spotify throttle: {error}")
+
+    def count(self, counter_name: str, value: float = 1):
+        with self.lock:
+            self.counters[counter_name] += value
+
+    def get_counters(self) -> Dict[str, float]:
+        """
+        Returns a copy of the counters: calls, coalesced ids, requests, throttled requests, throttles of other processes
+        (shared_throttled), retries, and the seconds waited for the token bucket (waited_secs), imposed by Retry-After
+        (throttled_secs) and backed off after server errors (backoff_secs)
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def call(self, function: Callable, *args, **kwargs):
+        """
+        Calls a Spotify client method through the scheduler
+        """
+        self.count('calls')
+        return self.request(function, args, kwargs)
+
+    def call_by_ids(self, function: Callable, lookup_name: str, ids: List[str], *args, **kwargs) -> list:
+        """
+        Calls a Spotify client method looking up entities by a list of ids, given as its first argument, through the
+        scheduler. Ids already being looked up by this scheduler's calls in flight, with the same arguments and a method
+        of the same lookup_name, wait for the result of that lookup, and only the other ids are requested.
+        :return: The entities looked up, in the order of the ids
+        """
+        self.count('calls')
+        arguments_key = freeze_arguments(args, kwargs)
+        futures = {}
+        owned_ids = []
+        with self.lock:
+            for entity_id in ids:
+                if entity_id in futures:
+                    continue
+                future = self.in_flight.get((lookup_name, entity_id) + arguments_key)
+                if future is None:
+                    future = self.in_flight[(lookup_name, entity_id) + arguments_key] = Future()
+                    owned_ids.append(entity_id)
+                futures[entity_id] = future
+            self.counters['coalesced'] += len(futures) - len(owned_ids)
+
+        if len(owned_ids) > 0:
+            try:
+                entities = self.request(function, (owned_ids,) + args, kwargs)
+                for entity_id, entity in zip(owned_ids, entities):
+                    futures[entity_id].set_result(entity)
+            except BaseException as error:
+                for entity_id in owned_ids:
+                    if not futures[entity_id].done():
+                        futures[entity_id].set_exception(error)
+                raise
+            finally:
+                with self.lock:
+                    for entity_id in owned_ids:
+                        del self.in_flight[(lookup_name, entity_id) + arguments_key]
+
+        return [futures[entity_id].result() for entity_id in ids]
+
+    def request(self, function: Callable, args: tuple, kwargs: dict):
+        """
+        Makes the request of a call once a token is available, retrying it if it is throttled or fails with a server
+        error
+        """
+        for attempt in range(self.max_retries + 1):
+            self.sync_throttle()
+            self.count('waited_secs', self.token_bucket.acquire())
+            self.count('requests')
+            try:
+                result = function(*args, **kwargs)
+            except tk.TooManyRequests as error:
+                retry_after_secs = get_retry_after_secs(error)
+                self.record_throttle(retry_after_secs)
+                pause_secs = retry_after_secs + random.uniform(0, self.retry_jitter_secs)
+                if attempt == self.max_retries or pause_secs > self.get_max_retry_after_secs():
+                    raise
+                LOGGER.warning(f"Spotify throttled {getattr(function, '__name__', function)}, pausing requests for "
+                               f"{pause_secs:.2f}s (attempt {attempt + 1})")
+                self.count('throttled')
+                self.count('throttled_secs', pause_secs)
+                self.token_bucket.pause(pause_secs)
+            except tk.ServerError:
+                if attempt == self.max_retries:
+                    raise
+                backoff_secs = random.uniform(0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** attempt))
+                self.count('backoff_secs', backoff_secs)
+                time.sleep(backoff_secs)
+            else:
+                self.token_bucket.increase_rate()
+                return result
+            self.count('retries')
+
+
+class ScheduledSpotify:
+    """
+    Proxy of a tk.Spotify client whose method calls are made through a SpotifyScheduler, by default the process-wide
+    one. Lookups of the same ids by the COALESCED_METHODS in flight at the same time are requested once.
+    """
+    def __init__(self, spotify, scheduler: SpotifyScheduler = None):
+        self.spotify = spotify
+        self.scheduler = scheduler if scheduler is not None else get_scheduler()
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.spotify, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def lookup_one(ids: List[str], *args, **kwargs) -> list:
+            return [attribute(ids[0], *args, **kwargs)]
+        lookup_one.__name__ = name
+
+        def scheduled_call(*args, **kwargs):
+            if name not in COALESCED_METHODS or len(args) == 0:
+                return self.scheduler.call(attribute, *args, **kwargs)
+            if isinstance(args[0], (list, tuple)):
+                return self.scheduler.call_by_ids(attribute, COALESCED_METHODS[name], list(args[0]), *args[1:],
+                                                  **kwargs)
+            return self.scheduler.call_by_ids(lookup_one, COALESCED_METHODS[name], [args[0]], *args[1:], **kwargs)[0]
+        scheduled_call.__name__ = name
+        return scheduled_call
+
+
+def get_scheduler() -> SpotifyScheduler:
+    """
+    Returns the process-wide Spotify request scheduler, creating it on first use. It outlives invocations, so that a
+    warm Lambda keeps the rate it has settled at. Its throttles are shared with the schedulers of other processes.
+    """
+    global SCHEDULER
+    with SCHEDULER_LOCK:
+        if SCHEDULER is None:
+            SCHEDULER = SpotifyScheduler(share_throttles=True)
+        return SCHEDULER
+
+
+def reset_scheduler():
+    """
+    Drops the process-wide scheduler, so that the next client starts with a new one at the maximum rate
+    """
+    global SCHEDULER
+    with SCHEDULER_LOCK:
+        SCHEDULER = None
+
+
+def set_deadline(context):
+    """
+    Bounds the Retry-After waited out by the process-wide scheduler by the time left in a Lambda invocation, from its
+    context. Called at the start of every invocation, as the scheduler outlives them.
+    """
+    get_scheduler().set_deadline(get_remaining_secs(context))
+
+
+def log_counters():
+    """
+    Logs the counters of the process-wide scheduler, accumulated since the Lambda's cold start
+    """
+    LOGGER.info(f"Spotify request counters: {get_scheduler().get_counters()}")
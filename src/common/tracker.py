@@ -5,7 +5,7 @@ class TrackerCommon:
     TRACK_ID = ListenerCommon.TRACK_ID
     ALBUM_ID = ('ALBUM_ID', str)
     ARTIST_ID = ('ARTIST_ID', str)
-    DURATION_MS = ('TRACK_DURATION_MS', int)
+    DURATION_MS = ListenerCommon.TRACK_DURATION
     NAME = ('TRACK_NAME', str)
     POPULARITY = ('TRACK_POPULARITY', int)
     EXPLICIT = ('TRACK_EXPLICIT', bool)
@@ -23,9 +23,23 @@ class TrackerCommon:
     TIME_SIGNATURE = ('TRACK_TIME_SIGNATURE', int)
     VALENCE = ('TRACK_VALENCE', float)
 
-    SCHEMA = [TRACK_ID[0], NAME[0], DURATION_MS[0], ALBUM_ID[0], ARTIST_ID[0], POPULARITY[0], EXPLICIT[0],
-              ACOUSTICNESS[0], DANCEABILITY[0], ENERGY[0], LIVENESS[0], LOUDNESS[0],
-              INSTRUMENTALNESS[0], SPEECHINESS[0], VALENCE[0],
-              KEY[0], MODE[0], TEMPO[0], TIME_SIGNATURE[0]]
+    TYPED_SCHEMA = [TRACK_ID, NAME, DURATION_MS, ALBUM_ID, ARTIST_ID, POPULARITY, EXPLICIT,
+                    ACOUSTICNESS, DANCEABILITY, ENERGY, LIVENESS, LOUDNESS,
+                    INSTRUMENTALNESS, SPEECHINESS, VALENCE,
+                    KEY, MODE, TEMPO, TIME_SIGNATURE]
+
+    SCHEMA = list(map(lambda ts: ts[0], TYPED_SCHEMA))
+
+    # Fields populated from the track's audio-features, which never change for a track
+    AUDIO_FEATURES_SCHEMA = [ACOUSTICNESS[0], DANCEABILITY[0], ENERGY[0], LIVENESS[0], LOUDNESS[0],
+                             INSTRUMENTALNESS[0], SPEECHINESS[0], VALENCE[0],
+                             KEY[0], MODE[0], TEMPO[0], TIME_SIGNATURE[0]]
+
+    # Audio-features measured on a continuous scale, as opposed to the categorical key, mode and time-signature
+    CONTINUOUS_AUDIO_FEATURES_SCHEMA = [ACOUSTICNESS[0], DANCEABILITY[0], ENERGY[0], LIVENESS[0], LOUDNESS[0],
+                                        INSTRUMENTALNESS[0], SPEECHINESS[0], VALENCE[0], TEMPO[0]]
+
+    # Fields that change over time and have to be refreshed periodically when cached
+    VOLATILE_SCHEMA = [POPULARITY[0]]
 
     FILE_PATH_PREFIX = 'history/tracks/'
@@ -1,70 +1,319 @@
+import os
+import json
 import time
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import logging
 
-import boto3
-from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from src.common import awsclients
 from src.common import soundprintutils
 from src.common.joiner import JoinerCommon
-
-SECRETS_ARN = soundprintutils.get_db_secrets_arn()
-AURORA_CLUSTER_ARN = soundprintutils.get_rds_cluster_arn()
+from src.common.archiver import ArchiverCommon
+from src.common import rollups
+from .. import spotifyjoiner
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.DEBUG)
 
+# Limits for a single batch_execute_statement request, kept below the RDS Data API request-size limit
+MAX_BATCH_ROWS = int(os.environ.get('SOUNDPRINT_ARCHIVE_MAX_BATCH_ROWS', 1000))
+MAX_BATCH_BYTES = int(os.environ.get('SOUNDPRINT_ARCHIVE_MAX_BATCH_BYTES', 2 * 1024 * 1024))
+
+# Maximum number of batch requests in flight at once, and attempts per batch on transient errors
+MAX_BATCH_CONCURRENCY = int(os.environ.get('SOUNDPRINT_ARCHIVE_MAX_CONCURRENCY', 4))
+MAX_BATCH_ATTEMPTS = 3
+RETRYABLE_ERROR_CODES = ('StatementTimeoutException', 'ServiceUnavailableError', 'InternalServerErrorException',
+                         'ThrottlingException')
+
+# Error codes of Data API requests to an Aurora serverless cluster that is resuming from a pause, besides the
+# communications link failure of a BadRequestException
+RESUMING_ERROR_CODES = ('DatabaseResumingException',)
+
+# Write modes for archiving rows:
+# insert - plain INSERT, which fails the batch if any of its rows is already archived
+# upsert - INSERT ... ON DUPLICATE KEY UPDATE, which overwrites already archived rows, so that re-archiving is safe
+WRITE_MODE_INSERT = 'insert'
+WRITE_MODE_UPSERT = 'upsert'
+WRITE_MODE = os.environ.get('SOUNDPRINT_ARCHIVE_WRITE_MODE', WRITE_MODE_UPSERT)
+
+# If true, rows whose primary key is already archived are dropped before writing, by querying the archived keys in
+# the time-range of the rows to be archived
+PREFILTER_EXISTING_ROWS = os.environ.get('SOUNDPRINT_ARCHIVE_PREFILTER_EXISTING_ROWS', 'false').lower() == 'true'
+
+# Layout of the archive: either the wide soundprinthistory table with a row for every combination of play, artist and
+# genres (see JoinerCommon.TYPED_SCHEMA), or normalized star-schema tables (see ArchiverCommon.STAR_TABLES)
+ARCHIVE_LAYOUT = os.environ.get('SOUNDPRINT_ARCHIVE_LAYOUT', ArchiverCommon.LAYOUT_WIDE)
+
+# Maximum number of ids per SELECT when looking up archived dimension rows
+SELECT_CHUNK_SIZE = 500
+
+# Number of plays of a compact joined file that are expanded to the wide layout and archived at a time, so that the
+# archiver never holds the whole file in the wide layout, which has a row per combination of a play's artists and genres
+COMPACT_CHUNK_PLAYS = int(os.environ.get('SOUNDPRINT_ARCHIVE_COMPACT_CHUNK_PLAYS', 1000))
 
-def create_table_if_not_exists(rds_client):
+HISTORY_PRIMARY_KEY = [JoinerCommon.LISTEN_TIMESTAMP, JoinerCommon.TRACK_ID, JoinerCommon.ALBUM_ID,
+                       JoinerCommon.ALBUM_GENRE, JoinerCommon.ARTIST_ID, JoinerCommon.ARTIST_GENRE]
+
+
+def create_table_if_not_exists(rds_client, table_name: str = soundprintutils.AURORA_HISTORY_TABLE):
     """
     CREATE Aurora Table for Soundprint if it doesn't already exist. Returns the CREATE call response.
     """
+    create_table_sql = build_create_table_sql(table_name, JoinerCommon.TYPED_SCHEMA, HISTORY_PRIMARY_KEY)
+
+    return execute_sql(rds_client, create_table_sql)
+
+
+def get_star_table_name(table, user_id: str = None) -> str:
+    """
+    Returns the name of a star-schema table for the given user. Fact tables are kept per user, while the dimension
+    and bridge tables are shared by all users.
+    """
+    if table in ArchiverCommon.FACT_TABLES:
+        return soundprintutils.get_user_table_name(table.NAME, user_id)
+    return table.NAME
+
+
+def create_star_tables_if_not_exist(rds_client, user_id: str = None) -> List[dict]:
+    """
+    CREATE the Aurora Tables of the star-schema layout (ArchiverCommon.STAR_TABLES) for the given user that don't
+    already exist. Returns the CREATE call responses.
+    """
+    create_responses = []
+    for table in ArchiverCommon.STAR_TABLES:
+        create_table_sql = build_create_table_sql(get_star_table_name(table, user_id), table.TYPED_SCHEMA,
+                                                  table.PRIMARY_KEY, table.INDEXES, ArchiverCommon.COLUMN_SQL_TYPES)
+        create_responses.append(execute_sql(rds_client, create_table_sql))
+    return create_responses
+
+
+def build_create_table_sql(table_name: str, typed_schema: List[Tuple[str, classmethod]],
+                           primary_key: List[Tuple[str, classmethod]],
+                           indexes: Dict[str, List[Tuple[str, classmethod]]] = None,
+                           column_sql_types: Dict[str, str] = None) -> str:
+    """
+    Builds the SQL statement for creating a table with the typed schema, primary key and secondary indexes if the table
+    doesn't already exist. Column types are derived from the schema data-types unless overridden by column_sql_types.
+    """
+    if indexes is None:
+        indexes = {}
+    if column_sql_types is None:
+        column_sql_types = {}
+
     schema_str = ""
-    for ts in JoinerCommon.TYPED_SCHEMA:
-        schema_str += f"{ts[0]} {data_type_to_sql_type(ts[1], schema_type=True)},\n"
+    for ts in typed_schema:
+        sql_type = column_sql_types.get(ts[0], data_type_to_sql_type(ts[1], schema_type=True))
+        schema_str += f"{ts[0]} {sql_type},\n"
 
-    primary_key_str = f"PRIMARY KEY ({JoinerCommon.LISTEN_TIMESTAMP[0]}, {JoinerCommon.TRACK_ID[0]}, " \
-                      f"{JoinerCommon.ALBUM_ID[0]}, {JoinerCommon.ALBUM_GENRE[0]}, " \
-                      f"{JoinerCommon.ARTIST_ID[0]}, {JoinerCommon.ARTIST_GENRE[0]})"
+    keys_str = f"PRIMARY KEY ({', '.join(map(lambda ts: ts[0], primary_key))})"
+    for index_name, index_fields in indexes.items():
+        keys_str += f",\nINDEX {index_name} ({', '.join(map(lambda ts: ts[0], index_fields))})"
 
-    create_table_sql = f"CREATE TABLE IF NOT EXISTS {soundprintutils.AURORA_HISTORY_TABLE}(\n" \
-                       f"{schema_str}\n" \
-                       f"{primary_key_str}\n" \
-                       f")"
+    return f"CREATE TABLE IF NOT EXISTS {table_name}(\n" \
+           f"{schema_str}\n" \
+           f"{keys_str}\n" \
+           f")"
 
-    return execute_sql(rds_client, create_table_sql)
 
+def insert_data_rows(joined_df: pd.DataFrame, rds_client, write_mode: str = WRITE_MODE,
+                     table_name: str = soundprintutils.AURORA_HISTORY_TABLE) -> List[dict]:
+    """
+    Inserts rows from the DataFrame following JoinerCommon.TYPED_SCHEMA into the Aurora Table, according to the
+    write-mode (see WRITE_MODE). Rows are inserted in batches bounded by size, see execute_batched_sql.
+    Returns the insertion batch request responses
+    """
+    sql_statement = build_insert_sql(table_name, JoinerCommon.TYPED_SCHEMA, HISTORY_PRIMARY_KEY, write_mode)
+
+    sql_parameter_sets = build_sql_parameter_sets(joined_df, JoinerCommon.TYPED_SCHEMA)
+
+    return execute_batched_sql(rds_client, sql_statement, sql_parameter_sets)
 
-def insert_data_rows(joined_df: pd.DataFrame, rds_client):
+
+def build_insert_sql(table_name: str, typed_schema: List[Tuple[str, classmethod]],
+                     primary_key: List[Tuple[str, classmethod]], write_mode: str) -> str:
     """
-    Inserts rows from the DataFrame following JoinerCommon.TYPED_SCHEMA into the Aurora Table.
-    Returns the insertion batch request response
+    Builds the SQL statement for inserting a row with named parameters for all fields of the typed schema.
+    In upsert write-mode, a row whose primary key already exists has its other fields updated instead.
     """
     insert_columns_str = ""
     insert_values_str = ""
-    for col_num, col_name in enumerate(JoinerCommon.SCHEMA):
-        insert_columns_str += col_name
-        insert_values_str += f":{col_name}"
-        if col_num != len(JoinerCommon.SCHEMA) - 1:
+    for col_num, ts in enumerate(typed_schema):
+        insert_columns_str += ts[0]
+        insert_values_str += f":{ts[0]}"
+        if col_num != len(typed_schema) - 1:
             insert_columns_str += ', '
             insert_values_str += ', '
 
-    sql_statement = \
-        f"INSERT INTO {soundprintutils.AURORA_HISTORY_TABLE} ({insert_columns_str}) values ({insert_values_str})"
+    sql_statement = f"INSERT INTO {table_name} ({insert_columns_str}) values ({insert_values_str})"
+
+    if write_mode == WRITE_MODE_UPSERT:
+        update_columns = [ts[0] for ts in typed_schema if ts not in primary_key]
+        # A table with only key columns has nothing to update, so the key is assigned to itself to ignore the row
+        if len(update_columns) == 0:
+            update_columns = [primary_key[0][0]]
+        update_str = ', '.join(map(lambda col_name: f"{col_name} = VALUES({col_name})", update_columns))
+        sql_statement += f" ON DUPLICATE KEY UPDATE {update_str}"
+    elif write_mode != WRITE_MODE_INSERT:
+        raise ValueError(f"Unexpected write-mode: {write_mode}")
+
+    return sql_statement
+
+
+def filter_archived_rows(joined_df: pd.DataFrame, rds_client,
+                         table_name: str = soundprintutils.AURORA_HISTORY_TABLE) -> pd.DataFrame:
+    """
+    Returns the rows of the DataFrame following JoinerCommon.TYPED_SCHEMA whose primary key has not been archived yet.
+    Only the keys archived in the DataFrame's listening time-range are queried.
+    """
+    if len(joined_df.index) == 0:
+        return joined_df
+
+    timestamp_field = JoinerCommon.LISTEN_TIMESTAMP
+    key_columns_str = ', '.join(map(lambda ts: ts[0], HISTORY_PRIMARY_KEY))
+    select_sql = f"SELECT {key_columns_str} FROM {table_name} " \
+                 f"WHERE {timestamp_field[0]} BETWEEN :min_timestamp AND :max_timestamp"
+    select_response = execute_sql(rds_client, select_sql, [
+        {'name': 'min_timestamp', 'value': {'doubleValue': float(joined_df[timestamp_field[0]].min())}},
+        {'name': 'max_timestamp', 'value': {'doubleValue': float(joined_df[timestamp_field[0]].max())}},
+    ])
+
+    archived_keys = set()
+    for record in select_response.get('records', []):
+        archived_keys.add(tuple(ts[1](next(iter(field.values()))) for ts, field in zip(HISTORY_PRIMARY_KEY, record)))
+
+    # Keys are compared as the values they are archived as, e.g. a missing genre is archived as 'nan'
+    row_keys = zip(*[column_to_sql_values(joined_df[ts[0]], ts[1]) for ts in HISTORY_PRIMARY_KEY])
+    is_archived = [row_key in archived_keys for row_key in row_keys]
+
+    return joined_df[[not archived for archived in is_archived]]
+
+
+def decompose_joined_rows(joined_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Decomposes the rows of a DataFrame following JoinerCommon.TYPED_SCHEMA into the distinct rows of each table of
+    the star-schema layout. Rows without a genre are not part of the genre bridge tables.
+    :return: Map of table name -> DataFrame with the table's rows
+    """
+    table_rows = {}
+    for table in ArchiverCommon.STAR_TABLES:
+        table_schema = list(map(lambda ts: ts[0], table.TYPED_SCHEMA))
+        table_df = joined_df[table_schema].dropna(subset=list(map(lambda ts: ts[0], table.PRIMARY_KEY)))
+        table_rows[table.NAME] = table_df.drop_duplicates(list(map(lambda ts: ts[0], table.PRIMARY_KEY)))
+    return table_rows
+
+
+def filter_unchanged_rows(table_df: pd.DataFrame, table, rds_client) -> pd.DataFrame:
+    """
+    Returns the rows of a star-schema table's DataFrame that are not archived in the table with the exact same values,
+    i.e. rows that are new or changed. Archived rows are looked up by the first field of the table's primary key.
+    """
+    id_field = table.PRIMARY_KEY[0]
+    columns_str = ', '.join(map(lambda ts: ts[0], table.TYPED_SCHEMA))
+    ids = list(table_df[id_field[0]].drop_duplicates())
+
+    archived_rows = set()
+    for start in range(0, len(ids), SELECT_CHUNK_SIZE):
+        chunk_ids = ids[start:start + SELECT_CHUNK_SIZE]
+        ids_str = ', '.join(map(lambda id_num: f":id{id_num}", range(len(chunk_ids))))
+        select_sql = f"SELECT {columns_str} FROM {table.NAME} WHERE {id_field[0]} IN ({ids_str})"
+        select_response = execute_sql(rds_client, select_sql, [
+            {'name': f"id{id_num}", 'value': {'stringValue': str(chunk_id)}}
+            for id_num, chunk_id in enumerate(chunk_ids)
+        ])
+        for record in select_response.get('records', []):
+            archived_rows.add(tuple(ts[1](next(iter(field.values()))) for ts, field in zip(table.TYPED_SCHEMA, record)))
+
+    rows = zip(*[column_to_sql_values(table_df[ts[0]], ts[1]) for ts in table.TYPED_SCHEMA])
+    is_unchanged = [row in archived_rows for row in rows]
+
+    return table_df[[not unchanged for unchanged in is_unchanged]]
+
+
+def insert_star_rows(joined_df: pd.DataFrame, rds_client, user_id: str = None) -> List[dict]:
+    """
+    Archives rows from the DataFrame following JoinerCommon.TYPED_SCHEMA into the star-schema tables of the given user.
+    Plays are upserted; tracks, albums, artists and their bridge tables are upserted only for rows that changed.
+    Returns the insertion batch request responses of all tables
+    """
+    table_rows = decompose_joined_rows(joined_df)
+
+    insert_responses = []
+    for table in ArchiverCommon.STAR_TABLES:
+        table_df = table_rows[table.NAME]
+        if table in ArchiverCommon.DIMENSION_TABLES:
+            table_df = filter_unchanged_rows(table_df, table, rds_client)
+        table_name = get_star_table_name(table, user_id)
+        LOGGER.debug(f"Upserting {table_df.shape[0]} rows into {table_name}")
+        if len(table_df.index) == 0:
+            continue
+
+        sql_statement = build_insert_sql(table_name, table.TYPED_SCHEMA, table.PRIMARY_KEY, WRITE_MODE_UPSERT)
+        sql_parameter_sets = build_sql_parameter_sets(table_df, table.TYPED_SCHEMA)
+        insert_responses += execute_batched_sql(rds_client, sql_statement, sql_parameter_sets)
+
+    return insert_responses
+
+
+def build_sql_parameter_sets(df: pd.DataFrame, typed_schema: List[Tuple[str, classmethod]]) -> List[List[dict]]:
+    """
+    Builds the SQL parameter-set for each row of the DataFrame following the typed schema.
+    Each column is converted to its schema data-type as a whole, and the SQL value-type of each column is resolved
+    once, instead of once per value.
+    """
+    value_types = [data_type_to_sql_type(ts[1], schema_type=False) for ts in typed_schema]
+    column_values = [column_to_sql_values(df[ts[0]], ts[1]) for ts in typed_schema]
 
     sql_parameter_sets = []
-    for index, row in joined_df.iterrows():
-        row_entry = []
-        for ts in JoinerCommon.TYPED_SCHEMA:
-            row_entry.append({
-                'name': ts[0],
-                'value': {data_type_to_sql_type(ts[1], schema_type=False): ts[1](row[ts[0]])}
-            })
-        sql_parameter_sets.append(row_entry)
+    for row_values in zip(*column_values):
+        sql_parameter_sets.append([
+            {'name': ts[0], 'value': {value_type: value}}
+            for ts, value_type, value in zip(typed_schema, value_types, row_values)
+        ])
+    return sql_parameter_sets
+
 
-    return execute_batch_sql(rds_client, sql_statement, sql_parameter_sets)
+def column_to_sql_values(column: pd.Series, dtype: classmethod) -> list:
+    """
+    Converts a column to a list of native Python values of the given data-type, as accepted by the Data API.
+    Missing values in string columns, including categorical ones, are converted like str() would, i.e. to 'nan'.
+    float32 columns are converted through their shortest decimal representation, so that a feature read as 0.123 is
+    archived as 0.123 rather than as 0.12300000339746475.
+    """
+    if dtype == str:
+        return column.astype(object).map(str).tolist()
+    if column.dtype == np.float32:
+        return column.astype(str).astype(float).tolist()
+    return column.astype(dtype).tolist()
+
+
+def split_sql_parameter_sets(sql_parameter_sets: List[List[dict]], max_rows: int = MAX_BATCH_ROWS,
+                             max_bytes: int = MAX_BATCH_BYTES) -> List[List[List[dict]]]:
+    """
+    Splits the SQL parameter-sets into consecutive batches of at most max_rows parameter-sets each, and of at most
+    max_bytes of serialized parameters each (unless a single parameter-set is larger by itself)
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for sql_parameter_set in sql_parameter_sets:
+        parameter_set_bytes = len(json.dumps(sql_parameter_set))
+        if len(batch) > 0 and (len(batch) >= max_rows or batch_bytes + parameter_set_bytes > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(sql_parameter_set)
+        batch_bytes += parameter_set_bytes
+
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
 
 def data_type_to_sql_type(dtype: classmethod, schema_type=False) -> str:
@@ -85,25 +334,42 @@ def data_type_to_sql_type(dtype: classmethod, schema_type=False) -> str:
         raise ValueError(f"Unexpected schema data-type: {dtype}")
 
 
-def wakeup_serverless(rds_client):
+def create_rds_data_client():
+    """
+    Returns the shared RDSDataService client, retrying throttled and transient errors (see awsclients.SERVICE_CONFIGS)
+    """
+    return awsclients.get_client('rds-data')
+
+
+def wakeup_serverless(rds_client) -> float:
     """
     Wait for Aurora Serverless cluster to wake up with arithmetic backoff of 5 seconds.
-    Starts with 1 second, waits for a max of 4 minutes
+    Starts with 1 second, waits for a max of 4 minutes. Returns at once if the cluster is awake, e.g. if an earlier
+    stage has triggered its wake-up (see soundprintutils.trigger_aurora_wakeup) and it has resumed since.
+    :return: Seconds waited for the cluster to wake up
     """
+    start = time.monotonic()
     delay_secs = 1
     for attempt in range(10):
         try:
             execute_sql(rds_client, 'show tables')
-            return
+            return time.monotonic() - start
         except ClientError as ce:
-            error_code = ce.response.get('Error').get('Code')
-            error_msg = ce.response.get('Error').get('Message')
-            if error_code == 'BadRequestException' and 'Communications link failure' in error_msg:
-                time.sleep(delay_secs)
-                delay_secs += 5
-            else:
+            if not is_cluster_resuming(ce):
                 raise ce
-    raise Exception(f"Aurora RDS did not wake up for {delay_secs * 2} seconds")
+            time.sleep(delay_secs)
+            delay_secs += 5
+    raise Exception(f"Aurora RDS did not wake up for {time.monotonic() - start:.0f} seconds")
+
+
+def is_cluster_resuming(ce: ClientError) -> bool:
+    """
+    Returns true if a Data API request failed because the Aurora serverless cluster is paused or still resuming
+    """
+    error_code = ce.response.get('Error').get('Code')
+    error_msg = ce.response.get('Error').get('Message', '')
+    return error_code in RESUMING_ERROR_CODES or \
+        (error_code == 'BadRequestException' and 'Communications link failure' in error_msg)
 
 
 def execute_sql(rds_client, sql: str, sql_parameters: List[dict] = None) -> dict:
@@ -114,9 +380,9 @@ def execute_sql(rds_client, sql: str, sql_parameters: List[dict] = None) -> dict
     if sql_parameters is None:
         sql_parameters = []
     return rds_client.execute_statement(
-        secretArn=SECRETS_ARN,
+        secretArn=soundprintutils.get_db_secrets_arn(),
         database=soundprintutils.AURORA_DB,
-        resourceArn=AURORA_CLUSTER_ARN,
+        resourceArn=soundprintutils.get_rds_cluster_arn(),
         sql=sql,
         parameters=sql_parameters
     )
@@ -130,53 +396,175 @@ def execute_batch_sql(rds_client, sql: str, sql_parameter_sets: List[List[dict]]
     if sql_parameter_sets is None:
         sql_parameter_sets = [[]]
     return rds_client.batch_execute_statement(
-        secretArn=SECRETS_ARN,
+        secretArn=soundprintutils.get_db_secrets_arn(),
         database=soundprintutils.AURORA_DB,
-        resourceArn=AURORA_CLUSTER_ARN,
+        resourceArn=soundprintutils.get_rds_cluster_arn(),
         sql=sql,
         parameterSets=sql_parameter_sets
     )
 
 
+def execute_batch_sql_with_retries(rds_client, sql: str, sql_parameter_sets: List[List[dict]],
+                                   max_attempts: int = MAX_BATCH_ATTEMPTS) -> dict:
+    """
+    Executes a batch SQL statement with execute_batch_sql, retrying only this batch if it fails with a transient
+    error, or because the Aurora serverless cluster has paused again, with a backoff of 1 second times the attempt
+    number
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return execute_batch_sql(rds_client, sql, sql_parameter_sets)
+        except ClientError as ce:
+            error_code = ce.response.get('Error').get('Code')
+            is_retryable = error_code in RETRYABLE_ERROR_CODES or is_cluster_resuming(ce)
+            if attempt == max_attempts or not is_retryable:
+                raise ce
+            LOGGER.warning(f"Batch of {len(sql_parameter_sets)} rows failed with {error_code} on attempt {attempt}; "
+                           f"retrying")
+            time.sleep(attempt)
+
+
+def execute_batched_sql(rds_client, sql: str, sql_parameter_sets: List[List[dict]],
+                        max_concurrency: int = MAX_BATCH_CONCURRENCY) -> List[dict]:
+    """
+    Given an RDSDataService Client, and SQL string and a list of SQL parameter-sets, splits the parameter-sets into
+    batches within the Data API request limits and executes the batch SQL statements on the Aurora cluster with at
+    most max_concurrency batches in flight at once. Each batch is retried independently on transient errors.
+    Returns the responses of all batches, in order of the batches
+    """
+    batches = split_sql_parameter_sets(sql_parameter_sets)
+    LOGGER.debug(f"Split {len(sql_parameter_sets)} parameter-sets into {len(batches)} batches")
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(lambda batch: execute_batch_sql_with_retries(rds_client, sql, batch), batches))
+
+
+def archive_joined_rows(joined_df: pd.DataFrame, rds_client, layout: str = ARCHIVE_LAYOUT, user_id: str = None):
+    """
+    Archives rows from the DataFrame following JoinerCommon.TYPED_SCHEMA into the Aurora DB tables of the given user
+    (see soundprintutils.get_user_table_name) in the given layout (see ARCHIVE_LAYOUT), creating the tables if they
+    don't exist. The Aurora serverless cluster must be awake.
+    """
+    history_table_name = soundprintutils.get_user_table_name(soundprintutils.AURORA_HISTORY_TABLE, user_id)
+
+    # Create tables if not exists
+    if layout == ArchiverCommon.LAYOUT_STAR:
+        create_responses = create_star_tables_if_not_exist(rds_client, user_id)
+    elif layout == ArchiverCommon.LAYOUT_WIDE:
+        create_responses = [create_table_if_not_exists(rds_client, history_table_name)]
+    else:
+        raise ValueError(f"Unexpected archive layout: {layout}")
+
+    LOGGER.debug(f"Executed CREATE-TABLE-IF-NOT-EXISTS. Responses: {create_responses}")
+    for create_response in create_responses:
+        if create_response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            LOGGER.error(f"Table creation failed")
+            raise Exception(f"Table creation-if-exists failed: {create_response}")
+
+    # Drop records that have already been archived, e.g. by a previous attempt of this run
+    if PREFILTER_EXISTING_ROWS and layout == ArchiverCommon.LAYOUT_WIDE:
+        joined_df = filter_archived_rows(joined_df, rds_client, history_table_name)
+        LOGGER.info(f"{joined_df.shape[0]} records have not been archived yet")
+        if len(joined_df.index) == 0:
+            return
+
+    # Insert soundprint records into tables
+    if layout == ArchiverCommon.LAYOUT_STAR:
+        insert_responses = insert_star_rows(joined_df, rds_client, user_id)
+    else:
+        insert_responses = insert_data_rows(joined_df, rds_client, table_name=history_table_name)
+    LOGGER.debug(f"Executed data insertion for {joined_df.shape[0]} rows in {len(insert_responses)} batches")
+    for insert_response in insert_responses:
+        if insert_response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            LOGGER.error(f"Insertion failed: {insert_response}")
+            raise Exception(f"Record(s) insertion failed: {insert_response}")
+
+
+def update_listening_rollups(joined_df: pd.DataFrame, user_id: str = None) -> int:
+    """
+    Adds the archived rows played after the listening cursor of the given user to their listening rollups, so that
+    rows archived again, e.g. when reprocessing a time-window, are never counted twice. Must be called before the
+    cursor is advanced past the rows; rows added again before the cursor is advanced, e.g. by a retried archiver, are
+    skipped by the rollups they were added to. Returns the number of rollup items updated.
+    Plays are compared with the cursor in whole milliseconds, rounded as the cursor is when it is advanced.
+    """
+    cursor_ms = soundprintutils.get_listening_cursor(user_id)
+    if cursor_ms is not None:
+        played_at_ms = (joined_df[JoinerCommon.LISTEN_TIMESTAMP[0]] * 1000).round().astype('int64')
+        joined_df = joined_df[played_at_ms > cursor_ms]
+    return rollups.update_rollups(joined_df, user_id)
+
+
+def iter_joined_rows(data_file_name: str, compact_chunk_plays: int = COMPACT_CHUNK_PLAYS) -> Iterator[pd.DataFrame]:
+    """
+    Generates the rows of a joined file in the wide layout (see JoinerCommon.SCHEMA), in ascending order of
+    listened-timestamp. A wide file is read as a whole, as the rows of a play may be anywhere in it, while a compact
+    file has one row per play, so it is streamed from S3 and expanded in chunks of compact_chunk_plays plays.
+    """
+    if data_file_name.startswith(JoinerCommon.COMPACT_FILE_PATH_PREFIX):
+        for compact_df in soundprintutils.iter_df_chunks_from_s3(data_file_name, JoinerCommon.COMPACT_TYPED_SCHEMA,
+                                                                 compact_chunk_plays):
+            yield spotifyjoiner.expand_compact_rows(compact_df)
+    else:
+        yield soundprintutils.download_df_from_s3(data_file_name, JoinerCommon.TYPED_SCHEMA)
+
+
+def advance_listening_cursor(joined_df: pd.DataFrame, user_id: str = None) -> bool:
+    """
+    Advances the listening cursor of the given user to the most recent play of the archived rows, so that the next
+    run of the listener queries only the plays after it. Returns True if the cursor was advanced.
+    """
+    cursor_ms = int(round(joined_df[JoinerCommon.LISTEN_TIMESTAMP[0]].max() * 1000))
+    return soundprintutils.advance_listening_cursor(cursor_ms, user_id)
+
+
 def lambda_handler(data_file_name, context):
     """
     Lambda handler for the action of taking the recently generated Spotify-history data and archiving the records
     into Aurora DB. Gets triggered after joining multiple types of metadata is complete and the joined file name
     is provided.
-    If the Aurora table does not exist, it creates the table. If there are records to be inserted, the Aurora serverless
+    If the Aurora tables do not exist, it creates the tables. If there are records to be inserted, the Aurora serverless
     cluster is first woken up with an arithmetic backoff until it is ready to receive SQL requests.
+    Records are archived in the layout configured by SOUNDPRINT_ARCHIVE_LAYOUT, see ARCHIVE_LAYOUT. Files joined in
+    compact mode are archived in chunks of COMPACT_CHUNK_PLAYS plays.
+    Once archived, the records are added to the listening rollups of the user and their listening cursor is advanced
+    past the archived records.
     :param data_file_name: S3-key containing the file-name for the joined dataframe
     :param context:
     """
-    # Download historical snapshot file from S3
-    df = soundprintutils.download_df_from_s3_csv(data_file_name, JoinerCommon.SCHEMA)
-    LOGGER.info(f"Downloaded joined data file from S3: {data_file_name}")
-    LOGGER.debug(f"DataFrame dimensions: {df.shape}")
+    rds_data_client = None
+    user_id = soundprintutils.get_user_id_from_file_name(data_file_name)
+    last_df = None
+    archived_count = 0
+    rollup_count = 0
 
-    # Return if there is no data to update table
-    if len(df.index) == 0:
-        LOGGER.info(f"No records in dataframe downloaded - returning")
-        return
+    # Archive soundprint records into the tables of the user the file belongs to, and then roll them up. Compact files
+    # are archived a chunk of plays at a time, in order of their plays, see iter_joined_rows.
+    for df in iter_joined_rows(data_file_name):
+        LOGGER.debug(f"DataFrame dimensions: {df.shape}")
+        if len(df.index) == 0:
+            continue
 
-    # Get the RDSDataService client and wake up the cluster
-    rds_data_client = boto3.client('rds-data', config=Config(retries={'max_attempts': 10, 'mode': 'standard'}))
-    LOGGER.debug(f"Created RDS DataService Client")
+        # Get the RDSDataService client and wake up the cluster once there are records to archive
+        if rds_data_client is None:
+            rds_data_client = create_rds_data_client()
+            LOGGER.debug(f"Created RDS DataService Client")
+            wakeup_secs = wakeup_serverless(rds_data_client)
+            LOGGER.info(f"Woken up Aurora Serverless Cluster: {soundprintutils.AURORA_DB}, waited {wakeup_secs:.1f}s")
 
-    wakeup_serverless(rds_data_client)
-    LOGGER.info(f"Woken up Aurora Serverless Cluster: {soundprintutils.AURORA_DB}")
+        archive_joined_rows(df, rds_data_client, user_id=user_id)
+        rollup_count += update_listening_rollups(df, user_id)
+        archived_count += df.shape[0]
+        last_df = df
 
-    # Create table if not exists
-    create_response = create_table_if_not_exists(rds_data_client)
-    LOGGER.debug(f"Executed CREATE-TABLE-IF-NOT-EXISTS. Response: {create_response}")
-    if create_response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        LOGGER.error(f"Table creation failed")
-        raise Exception(f"Table creation-if-exists failed: {create_response}")
+    # Return if there was no data to update table
+    if last_df is None:
+        LOGGER.info(f"No records in data file {data_file_name} - returning")
+        return
 
-    # Insert soundprint records into table
-    insert_response = insert_data_rows(df, rds_data_client)
-    LOGGER.debug(f"Executed data insertion for {df.shape[0]} rows. Response: {insert_response}")
-    if insert_response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        LOGGER.error(f"Insertion failed: {insert_response}")
-        raise Exception(f"Record(s) insertion failed: {insert_response}")
+    # Advance the cursor of the user past the archived records, the last chunk holding the most recent plays
+    LOGGER.info(f"Archived {archived_count} records from data file {data_file_name}, updated {rollup_count} "
+                f"listening rollups")
+    advance_listening_cursor(last_df, user_id)
 
-    return 
+    return
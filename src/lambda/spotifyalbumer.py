@@ -1,13 +1,71 @@
+from __future__ import annotations
+
 from typing import List
-import tekore as tk
-import pandas as pd
+from datetime import datetime
 
 from src.common import soundprintutils
+from src.common import spotifyscheduler
 from src.common.tracker import TrackerCommon
 from src.common.albumer import AlbumerCommon
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, so that modules importing this one only pay for them once they run the stage
+tk = lazy_import('tekore')
+pd = lazy_import('pandas')
+extraction = lazy_import('src.common.extraction')
+entitycache = lazy_import('src.common.entitycache')
+
+
+# Paths of the fields of album-objects, with the genres of each album as its genre
+ALBUM_PATHS = [
+    (AlbumerCommon.ALBUM_ID, 'id'),
+    (AlbumerCommon.TYPE, 'album_type'),
+    (AlbumerCommon.LABEL, 'label'),
+    (AlbumerCommon.NAME, 'name'),
+    (AlbumerCommon.POPULARITY, 'popularity'),
+    (AlbumerCommon.RELEASE_DATE, 'release_date'),
+    (AlbumerCommon.TOTAL_TRACKS, 'total_tracks'),
+    (AlbumerCommon.GENRE, 'genres'),
+]
+
+# Formats of the release dates of albums, by the length of the date at each precision
+RELEASE_DATE_FORMATS = {
+    len('1999'): '%Y',
+    len('1999-05'): '%Y-%m',
+    len('1999-05-01'): '%Y-%m-%d',
+}
+
+
+def get_release_timestamps(release_dates: List[str]) -> pd.Series:
+    """
+    Converts the release dates of albums, given to the precision of a year, month or day (e.g. 1999, 1999-05 or
+    1999-05-01), into epoch timestamps in seconds of the start of the year, month or day. The dates of each precision
+    are parsed with its own format.
+    """
+    release_dates = pd.Series(release_dates, dtype=object)
+    date_lengths = release_dates.str.len()
+    release_datetimes = pd.concat([pd.to_datetime(release_dates[date_lengths == date_length], format=date_format)
+                                   for date_length, date_format in RELEASE_DATE_FORMATS.items()])
+    release_datetimes = release_datetimes.reindex(release_dates.index)
+    return (release_datetimes - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+
 
+def fetch_albums_data(spotify_client: tk.Spotify, album_ids: List[str]) -> pd.DataFrame:
+    """
+    Queries Spotify for the album-objects of all the albums and compiles them into a data-frame with schema according
+    to AlbumerCommon.SCHEMA
+    """
+    # Query Spotify for albums metadata
+    albums_metadata = spotify_client.albums(album_ids) if len(album_ids) > 0 else []
+
+    album_columns = extraction.extract_columns(albums_metadata, ALBUM_PATHS)
+    album_columns[AlbumerCommon.RELEASE_DATE[0]] = get_release_timestamps(album_columns[AlbumerCommon.RELEASE_DATE[0]])
 
-def get_albums_data(spotify_client: tk.Spotify, album_ids: List[str]) -> pd.DataFrame:
+    return extraction.build_df(album_columns, AlbumerCommon.TYPED_SCHEMA, AlbumerCommon.GENRE)
+
+
+def get_albums_data(spotify_client: tk.Spotify, album_ids: List[str],
+                    album_cache: entitycache.EntityCache = None) -> pd.DataFrame:
     """
     Given a spotify-client and list of album-ids, compiles a dataframe with metadata for all the albums.
     The compiled metadata contains the following fields for each album:
@@ -19,52 +77,54 @@ def get_albums_data(spotify_client: tk.Spotify, album_ids: List[str]) -> pd.Data
     6. label - Music label for releasing the album
     7. album-track-count - total number of tracks in album
     8. album-popularity - (0-100) number signifying album's popularity
+    If an album-cache is provided, only albums missing from the cache, or whose popularity has expired in the cache,
+    are queried from Spotify. The cache is updated with the queried albums but not saved.
     """
-    # Query Spotify for albums metadata
-    albums_metadata = spotify_client.albums(album_ids) if len(album_ids) > 0 else []
+    if album_cache is None:
+        return fetch_albums_data(spotify_client, album_ids)
 
-    album_dict_list = []
-    for album in albums_metadata:
-        album_dict = {}
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.ALBUM_ID, album.id)
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.TYPE, album.album_type)
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.LABEL, album.label)
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.NAME, album.name)
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.POPULARITY, album.popularity)
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.RELEASE_DATE,
-                                              pd.to_datetime(album.release_date).timestamp())
-        soundprintutils.update_dict_by_schema(album_dict, AlbumerCommon.TOTAL_TRACKS, album.total_tracks)
+    now = datetime.now().timestamp()
+    cached_albums_df, stale_albums_df, missing_album_ids = album_cache.lookup(album_ids, now)
 
-        genres = album.genres
-        album_dict_list += soundprintutils.normalize_dict_field_list(album_dict, genres, AlbumerCommon.GENRE)
+    # Volatile fields can only be refreshed by querying the entire album-object, so stale albums are queried again
+    stale_album_ids = list(stale_albums_df[AlbumerCommon.ALBUM_ID[0]].drop_duplicates())
+    fetched_albums_df = fetch_albums_data(spotify_client, missing_album_ids + stale_album_ids)
+    album_cache.update(fetched_albums_df, now)
 
-    return pd.DataFrame(album_dict_list, columns=AlbumerCommon.SCHEMA)
+    return pd.concat([cached_albums_df, fetched_albums_df], ignore_index=True)
 
 
 def lambda_handler(tracks_file_name, context):
     """
     Lambda handler for the action of querying spotify for all information related to spotify-albums by album-id.
-    This function reads the S3 object CSV file containing the album-ids for the tracks and queries Spotify to get
-    the metadata about all those albums. This metadata is compiled into a CSV file as a table with primary key being
-    album-id. This CSV is uploaded to S3.
+    This function reads the S3 object file containing the album-ids for the tracks and queries Spotify to get
+    the metadata about all those albums. This metadata is compiled into a file as a table with primary key being
+    album-id. This file is uploaded to S3.
     :param tracks_file_name: S3 file containing track-metadata with album-ids for tracks recently listened to
     :param context:
     :return: uploaded S3 file name for file containing album-metadata
     """
-    # Read S3 Event to get the created csv file containing track-ids to query
-    tracks_df = soundprintutils.download_df_from_s3_csv(tracks_file_name, TrackerCommon.SCHEMA)
+    # Read S3 Event to get the created file containing track-ids to query
+    tracks_df = soundprintutils.download_df_from_s3(tracks_file_name, TrackerCommon.TYPED_SCHEMA)
 
     album_ids = list(set(tracks_df[TrackerCommon.ALBUM_ID[0]].dropna()))
 
+    # Bound the Retry-After of throttled Spotify requests by the time left in this invocation
+    spotifyscheduler.set_deadline(context)
+
     # Get Spotify access token and initialize Spotify client
-    access_token = soundprintutils.get_access_token()
-    spotify = tk.Spotify(access_token)
+    spotify = soundprintutils.get_spotify_client(soundprintutils.get_user_id_from_file_name(tracks_file_name))
 
-    # Extract all data related to the albums
-    albums_df = get_albums_data(spotify, album_ids)
+    # Extract all data related to the albums, querying Spotify only for albums not cached
+    album_cache = entitycache.EntityCache('albums', AlbumerCommon.TYPED_SCHEMA, AlbumerCommon.ALBUM_ID,
+                                          AlbumerCommon.VOLATILE_SCHEMA)
+    albums_df = get_albums_data(spotify, album_ids, album_cache)
+    spotifyscheduler.log_counters()
+    album_cache.save()
 
-    # Upload dataframe to S3 as CSV
+    # Upload dataframe to S3
     albums_file_name = f"{AlbumerCommon.FILE_PATH_PREFIX}{tracks_file_name.split(TrackerCommon.FILE_PATH_PREFIX)[1]}"
-    soundprintutils.upload_df_to_s3_csv(df=albums_df, include_index=False, file_name=albums_file_name)
+    soundprintutils.upload_df_to_s3(df=albums_df, include_index=False, file_name=albums_file_name,
+                                    typed_schema=AlbumerCommon.TYPED_SCHEMA)
 
     return albums_file_name
@@ -1,13 +1,44 @@
+from __future__ import annotations
+
 from typing import List
-import tekore as tk
-import pandas as pd
+from datetime import datetime
 
 from src.common import soundprintutils
+from src.common import spotifyscheduler
 from src.common.tracker import TrackerCommon
 from src.common.artister import ArtisterCommon
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, so that modules importing this one only pay for them once they run the stage
+tk = lazy_import('tekore')
+pd = lazy_import('pandas')
+extraction = lazy_import('src.common.extraction')
+entitycache = lazy_import('src.common.entitycache')
+
+
+# Paths of the fields of artist-objects, with the genres of each artist as its genre
+ARTIST_PATHS = [
+    (ArtisterCommon.ARTIST_ID, 'id'),
+    (ArtisterCommon.ARTIST_NAME, 'name'),
+    (ArtisterCommon.ARTIST_POPULARITY, 'popularity'),
+    (ArtisterCommon.ARTIST_GENRE, 'genres'),
+]
+
+
+def fetch_artists_data(spotify_client: tk.Spotify, artist_ids: List[str]) -> pd.DataFrame:
+    """
+    Queries Spotify for the artist-objects of all the artists and compiles them into a data-frame with schema according
+    to ArtisterCommon.SCHEMA
+    """
+    # Query Spotify for artists metadata
+    artists_metadata = spotify_client.artists(artist_ids) if len(artist_ids) > 0 else []
+
+    artist_columns = extraction.extract_columns(artists_metadata, ARTIST_PATHS)
+    return extraction.build_df(artist_columns, ArtisterCommon.TYPED_SCHEMA, ArtisterCommon.ARTIST_GENRE)
 
 
-def get_artists_data(spotify_client: tk.Spotify, artist_ids: List[str]) -> pd.DataFrame:
+def get_artists_data(spotify_client: tk.Spotify, artist_ids: List[str],
+                     artist_cache: entitycache.EntityCache = None) -> pd.DataFrame:
     """
     Given a spotify-client and list of artist-ids, compiles a dataframe with metadata for all the artists.
     The compiled metadata contains the following fields for each artist:
@@ -15,47 +46,54 @@ def get_artists_data(spotify_client: tk.Spotify, artist_ids: List[str]) -> pd.Da
     2. artist-name
     3. artist-genre - if artist has multiple generes, there will a row for the artist for each genre
     4. artist-popularity - (0-100) measure of artist's popularity
+    If an artist-cache is provided, only artists missing from the cache, or whose popularity has expired in the cache,
+    are queried from Spotify. The cache is updated with the queried artists but not saved.
     """
-    # Query Spotify for artists metadata
-    artists_metadata = spotify_client.artists(artist_ids) if len(artist_ids) > 0 else []
+    if artist_cache is None:
+        return fetch_artists_data(spotify_client, artist_ids)
 
-    artist_dict_list = []
-    for artist in artists_metadata:
-        artist_dict = {}
-        soundprintutils.update_dict_by_schema(artist_dict, ArtisterCommon.ARTIST_ID, artist.id)
-        soundprintutils.update_dict_by_schema(artist_dict, ArtisterCommon.ARTIST_NAME, artist.name)
-        soundprintutils.update_dict_by_schema(artist_dict, ArtisterCommon.ARTIST_POPULARITY, artist.popularity)
+    now = datetime.now().timestamp()
+    cached_artists_df, stale_artists_df, missing_artist_ids = artist_cache.lookup(artist_ids, now)
 
-        genres = artist.genres
-        artist_dict_list += soundprintutils.normalize_dict_field_list(artist_dict, genres, ArtisterCommon.ARTIST_GENRE)
+    # Volatile fields can only be refreshed by querying the entire artist-object, so stale artists are queried again
+    stale_artist_ids = list(stale_artists_df[ArtisterCommon.ARTIST_ID[0]].drop_duplicates())
+    fetched_artists_df = fetch_artists_data(spotify_client, missing_artist_ids + stale_artist_ids)
+    artist_cache.update(fetched_artists_df, now)
 
-    return pd.DataFrame(artist_dict_list, columns=ArtisterCommon.SCHEMA)
+    return pd.concat([cached_artists_df, fetched_artists_df], ignore_index=True)
 
 
 def lambda_handler(tracks_file_name, context):
     """
     Lambda handler for the action of querying spotify for all information related to spotify-artists by artist-id.
-    This function reads the S3 object CSV file containing the artist-ids for the tracks and queries Spotify to get
-    the metadata about all those artists. This metadata is compiled into a CSV file as a table with primary key being
-    album-id. This CSV is uploaded to S3.
+    This function reads the S3 object file containing the artist-ids for the tracks and queries Spotify to get
+    the metadata about all those artists. This metadata is compiled into a file as a table with primary key being
+    album-id. This file is uploaded to S3.
     :param tracks_file_name: S3 file containing track-metadata with album-ids for tracks recently listened to
     :param context:
     :return: uploaded S3 file name for file containing artist-metadata
     """
-    # Read S3 Event to get the created csv file containing track-ids to query
-    tracks_df = soundprintutils.download_df_from_s3_csv(tracks_file_name, TrackerCommon.SCHEMA)
+    # Read S3 Event to get the created file containing track-ids to query
+    tracks_df = soundprintutils.download_df_from_s3(tracks_file_name, TrackerCommon.TYPED_SCHEMA)
 
     artist_ids = list(set(tracks_df[TrackerCommon.ARTIST_ID[0]].dropna()))
 
+    # Bound the Retry-After of throttled Spotify requests by the time left in this invocation
+    spotifyscheduler.set_deadline(context)
+
     # Get Spotify access token and initialize Spotify client
-    access_token = soundprintutils.get_access_token()
-    spotify = tk.Spotify(access_token)
+    spotify = soundprintutils.get_spotify_client(soundprintutils.get_user_id_from_file_name(tracks_file_name))
 
-    # Extract all data related to the artists
-    artists_df = get_artists_data(spotify, artist_ids)
+    # Extract all data related to the artists, querying Spotify only for artists not cached
+    artist_cache = entitycache.EntityCache('artists', ArtisterCommon.TYPED_SCHEMA, ArtisterCommon.ARTIST_ID,
+                                           ArtisterCommon.VOLATILE_SCHEMA)
+    artists_df = get_artists_data(spotify, artist_ids, artist_cache)
+    spotifyscheduler.log_counters()
+    artist_cache.save()
 
-    # Upload dataframe to S3 as CSV
+    # Upload dataframe to S3
     artists_file_name = f"{ArtisterCommon.FILE_PATH_PREFIX}{tracks_file_name.split(TrackerCommon.FILE_PATH_PREFIX)[1]}"
-    soundprintutils.upload_df_to_s3_csv(df=artists_df, include_index=False, file_name=artists_file_name)
+    soundprintutils.upload_df_to_s3(df=artists_df, include_index=False, file_name=artists_file_name,
+                                    typed_schema=ArtisterCommon.TYPED_SCHEMA)
 
     return artists_file_name
@@ -0,0 +1,106 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+from typing import List
+from typing import Optional
+import pandas as pd
+
+from src.common import soundprintutils
+from src.common import compaction
+from src.common.compaction import CompactionCommon
+from src.common.joiner import JoinerCommon
+from . import spotifyjoiner
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.DEBUG)
+
+
+def get_history_file_path_prefixes(compaction_date: str, user_id: Optional[str] = None) -> List[str]:
+    """
+    Returns the S3 file path prefixes of the hourly joined files of a user written on the given date (YYYY-MM-DD),
+    in both the wide and the compact join modes
+    """
+    year, month, day = map(int, compaction_date.split('-'))
+    return [f"{soundprintutils.get_user_file_path_prefix(file_path_prefix, user_id)}{year}/{month}/{day}/"
+            for file_path_prefix in (JoinerCommon.FILE_PATH_PREFIX, JoinerCommon.COMPACT_FILE_PATH_PREFIX)]
+
+
+def download_history_rows(file_name: str) -> pd.DataFrame:
+    """
+    Downloads an hourly joined file, expanding it to the wide layout if it was joined in compact mode
+    """
+    if file_name.startswith(JoinerCommon.COMPACT_FILE_PATH_PREFIX):
+        compact_df = soundprintutils.download_df_from_s3(file_name, JoinerCommon.COMPACT_TYPED_SCHEMA)
+        return spotifyjoiner.expand_compact_rows(compact_df)
+    return soundprintutils.download_df_from_s3(file_name, JoinerCommon.TYPED_SCHEMA)
+
+
+def merge_partition_rows(partition_dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Merges the rows of a partition, dropping rows compacted more than once, in ascending order of listened-timestamp
+    """
+    partition_df = pd.concat(partition_dfs, ignore_index=True)
+    partition_df = partition_df.drop_duplicates([ts[0] for ts in CompactionCommon.ROW_KEY], keep='last')
+    partition_df = partition_df.sort_values(JoinerCommon.LISTEN_TIMESTAMP[0], kind='mergesort')
+    return partition_df[CompactionCommon.SCHEMA].reset_index(drop=True)
+
+
+def compact_user_history(compaction_date: str, user_id: Optional[str] = None) -> Dict[str, int]:
+    """
+    Compacts the hourly joined files of a user written on the given date into the daily partitions of the dates their
+    plays fall on, merging with rows already compacted into those partitions, and records the partitions in the
+    user's manifest. Compacting the same date again leaves the partitions unchanged.
+    :return: map of partition date to the number of rows in the partition after compaction
+    """
+    file_names = [file_name for file_path_prefix in get_history_file_path_prefixes(compaction_date, user_id)
+                  for file_name in soundprintutils.list_s3_keys(file_path_prefix)]
+    LOGGER.info(f"Compacting {len(file_names)} files of {compaction_date} for user: {user_id}")
+    if len(file_names) == 0:
+        return {}
+
+    history_df = pd.concat([download_history_rows(file_name) for file_name in file_names], ignore_index=True)
+    if history_df.shape[0] == 0:
+        return {}
+
+    # A file written shortly after midnight can hold plays of the previous day, so rows are partitioned by the date
+    # they were played at rather than the date of their file
+    manifest = compaction.load_manifest(user_id)
+    partitions = manifest[CompactionCommon.MANIFEST_PARTITIONS_KEY]
+    partition_row_counts = {}
+    partition_dates = compaction.get_partition_dates(history_df[JoinerCommon.LISTEN_TIMESTAMP[0]])
+    for partition_date, partition_rows_df in history_df.groupby(partition_dates, sort=True):
+        partition_file_name = compaction.get_partition_file_name(partition_date, user_id)
+        partition_dfs = [partition_rows_df]
+        if partition_date in partitions:
+            compacted_df = soundprintutils.download_df_from_s3(partition_file_name, CompactionCommon.TYPED_SCHEMA)
+            partition_dfs.insert(0, compacted_df)
+        partition_df = merge_partition_rows(partition_dfs)
+
+        soundprintutils.upload_df_to_s3(partition_df, False, partition_file_name, CompactionCommon.TYPED_SCHEMA)
+        partitions[partition_date] = compaction.describe_partition(partition_df, partition_file_name)
+        partition_row_counts[partition_date] = partition_df.shape[0]
+        LOGGER.debug(f"Compacted {partition_df.shape[0]} rows into partition: {partition_file_name}")
+
+    compaction.save_manifest(manifest, user_id)
+    return partition_row_counts
+
+
+def lambda_handler(event, context):
+    """
+    Lambda handler for the action of compacting a day of hourly joined files into daily partitions that are kept
+    beyond the lifecycle policy of history/.
+    :param event: Optional map with the following values:
+    date: <date (YYYY-MM-DD) of the hourly files to compact, by default yesterday in UTC>
+    user_ids: <list of the users to compact the files of, by default the original account and all registered users>
+    :param context:
+    :return: map of user-id to a map of partition date to the number of rows in the partition after compaction
+    """
+    event = event or {}
+    compaction_date = event.get('date')
+    if compaction_date is None:
+        compaction_date = (datetime.now(tz=timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%d')
+    user_ids = event.get('user_ids')
+    if user_ids is None:
+        user_ids = [None] + soundprintutils.get_user_ids()
+
+    return {str(user_id): compact_user_history(compaction_date, user_id) for user_id in user_ids}
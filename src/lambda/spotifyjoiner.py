@@ -1,9 +1,142 @@
+from __future__ import annotations
+
+import os
+
 from src.common import soundprintutils
 from src.common.listener import ListenerCommon
 from src.common.tracker import TrackerCommon
 from src.common.albumer import AlbumerCommon
 from src.common.artister import ArtisterCommon
 from src.common.joiner import JoinerCommon
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, so that modules importing this one only pay for them once they join or expand rows
+pd = lazy_import('pandas')
+schemaregistry = lazy_import('src.common.schemaregistry')
+
+# Join modes:
+# wide - a row for every combination of play, track-artist, album-genre and artist-genre (JoinerCommon.TYPED_SCHEMA),
+#        uploaded under JoinerCommon.FILE_PATH_PREFIX
+# compact - exactly one row per play with list-valued artists and genres (JoinerCommon.COMPACT_TYPED_SCHEMA),
+#           uploaded under JoinerCommon.COMPACT_FILE_PATH_PREFIX. Requires the parquet storage format.
+JOIN_MODE_WIDE = 'wide'
+JOIN_MODE_COMPACT = 'compact'
+JOIN_MODE = os.environ.get('SOUNDPRINT_JOIN_MODE', JOIN_MODE_WIDE)
+
+
+def join_dataframes(listening_df: pd.DataFrame, tracks_df: pd.DataFrame, albums_df: pd.DataFrame,
+                    artists_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins the listening, track, album and artist dataframes into a wide dataframe following JoinerCommon.SCHEMA,
+    in ascending order of listened-timestamp
+    """
+    # Join all the dataframes together
+    joined_df = listening_df.merge(
+        tracks_df, on=TrackerCommon.TRACK_ID[0]
+    ).merge(
+        albums_df, on=AlbumerCommon.ALBUM_ID[0]
+    ).merge(
+        artists_df, on=ArtisterCommon.ARTIST_ID[0]
+    )
+
+    # Rearrange data-frame to be in ascending order of listened-timestamp and follow the right schema
+    assert joined_df.columns.size == len(JoinerCommon.SCHEMA)
+    joined_df = joined_df[JoinerCommon.SCHEMA]
+    return joined_df.sort_values(ListenerCommon.TIMESTAMP[0], ascending=True)
+
+
+def list_distinct_values(values: pd.Series) -> list:
+    """
+    Returns the distinct non-null values of a series as a list, in order of first appearance
+    """
+    return list(dict.fromkeys(values.dropna()))
+
+
+def join_compact_dataframes(listening_df: pd.DataFrame, tracks_df: pd.DataFrame, albums_df: pd.DataFrame,
+                            artists_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins the listening, track, album and artist dataframes into a compact dataframe following
+    JoinerCommon.COMPACT_SCHEMA, with exactly one row per play in ascending order of listened-timestamp.
+    Each metadata dataframe is first collapsed to one row per id, with its multi-valued field as a list, and then
+    looked up by id. Artist ids not found in the artists dataframe are left out of a track's artists, while plays of
+    tracks or albums not found are left out as in the wide join.
+    """
+    # Collapse the per-genre rows of albums and artists into one row per id, indexed by id. Categorical genres are
+    # collected as plain strings, as lists of genres are not values of their categories.
+    albums_df = albums_df.astype({AlbumerCommon.GENRE[0]: object})
+    artists_df = artists_df.astype({ArtisterCommon.ARTIST_GENRE[0]: object})
+    album_fields = [field for field in AlbumerCommon.SCHEMA if field != AlbumerCommon.GENRE[0]]
+    albums_grouped = albums_df.groupby(AlbumerCommon.ALBUM_ID[0], sort=False)
+    albums_compact_df = albums_grouped[album_fields[1:]].first()
+    albums_compact_df[JoinerCommon.ALBUM_GENRES[0]] = albums_grouped[AlbumerCommon.GENRE[0]].agg(list_distinct_values)
+
+    artists_grouped = artists_df.groupby(ArtisterCommon.ARTIST_ID[0], sort=False)
+    artists_compact_df = artists_grouped[[ArtisterCommon.ARTIST_NAME[0], ArtisterCommon.ARTIST_POPULARITY[0]]].first()
+    artists_compact_df[JoinerCommon.ARTIST_GENRES[0]] = \
+        artists_grouped[ArtisterCommon.ARTIST_GENRE[0]].agg(list_distinct_values)
+    artist_names = artists_compact_df[ArtisterCommon.ARTIST_NAME[0]].to_dict()
+    artist_popularities = artists_compact_df[ArtisterCommon.ARTIST_POPULARITY[0]].to_dict()
+    artist_genres = artists_compact_df[JoinerCommon.ARTIST_GENRES[0]].to_dict()
+
+    # Collapse the per-artist rows of tracks into one row per track, and resolve its artists' attributes by id once
+    # per track rather than once per play
+    track_fields = [field for field in TrackerCommon.SCHEMA if field != TrackerCommon.ARTIST_ID[0]]
+    tracks_grouped = tracks_df.groupby(TrackerCommon.TRACK_ID[0], sort=False)
+    tracks_compact_df = tracks_grouped[track_fields[1:]].first()
+    track_artist_ids = tracks_grouped[TrackerCommon.ARTIST_ID[0]].agg(list_distinct_values)
+    track_artist_ids = track_artist_ids.map(lambda ids: [artist_id for artist_id in ids if artist_id in artist_names])
+    tracks_compact_df[JoinerCommon.ARTIST_IDS[0]] = track_artist_ids
+    tracks_compact_df[JoinerCommon.ARTIST_NAMES[0]] = \
+        track_artist_ids.map(lambda ids: [artist_names[artist_id] for artist_id in ids])
+    tracks_compact_df[JoinerCommon.ARTIST_GENRES[0]] = \
+        track_artist_ids.map(lambda ids: [artist_genres[artist_id] for artist_id in ids])
+    tracks_compact_df[JoinerCommon.ARTIST_POPULARITIES[0]] = \
+        track_artist_ids.map(lambda ids: [artist_popularities[artist_id] for artist_id in ids])
+
+    # Look up each play's track, and each track's album, by id
+    joined_df = listening_df.join(tracks_compact_df, on=TrackerCommon.TRACK_ID[0], how='inner')
+    joined_df = joined_df.join(albums_compact_df, on=AlbumerCommon.ALBUM_ID[0], how='inner')
+
+    joined_df = joined_df[JoinerCommon.COMPACT_SCHEMA].sort_values(ListenerCommon.TIMESTAMP[0], ascending=True)
+    joined_df = joined_df.astype({field: 'category' for field in JoinerCommon.COMPACT_CATEGORICAL_SCHEMA})
+    return joined_df.reset_index(drop=True)
+
+
+def expand_compact_rows(compact_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Expands a compact dataframe following JoinerCommon.COMPACT_SCHEMA into the equivalent wide dataframe following
+    JoinerCommon.SCHEMA, by splitting it back into the listening, track, album and artist dataframes and joining those
+    """
+    compact_df = compact_df.astype({field: object for field in JoinerCommon.COMPACT_CATEGORICAL_SCHEMA})
+
+    listening_df = compact_df[ListenerCommon.SCHEMA]
+
+    track_fields = [field for field in TrackerCommon.SCHEMA if field != TrackerCommon.ARTIST_ID[0]]
+    unique_tracks_df = compact_df.drop_duplicates(TrackerCommon.TRACK_ID[0])
+    tracks_df = unique_tracks_df[track_fields + [JoinerCommon.ARTIST_IDS[0]]].explode(JoinerCommon.ARTIST_IDS[0])
+    tracks_df = tracks_df.rename(columns={JoinerCommon.ARTIST_IDS[0]: TrackerCommon.ARTIST_ID[0]})
+    tracks_df = tracks_df[TrackerCommon.SCHEMA]
+
+    album_fields = [field for field in AlbumerCommon.SCHEMA if field != AlbumerCommon.GENRE[0]]
+    unique_albums_df = compact_df.drop_duplicates(AlbumerCommon.ALBUM_ID[0])
+    albums_df = unique_albums_df[album_fields + [JoinerCommon.ALBUM_GENRES[0]]].explode(JoinerCommon.ALBUM_GENRES[0])
+    albums_df = albums_df.rename(columns={JoinerCommon.ALBUM_GENRES[0]: AlbumerCommon.GENRE[0]})
+    albums_df = albums_df[AlbumerCommon.SCHEMA]
+
+    # Expand the aligned artist lists of each track into a row per artist, and then each artist's genres into a row
+    # per genre, leaving out tracks without artists. Each list column is exploded on its own, as the lists of a track
+    # have the same length and so explode into aligned rows (exploding several columns at once needs pandas 1.3).
+    artist_list_fields = [JoinerCommon.ARTIST_IDS[0], JoinerCommon.ARTIST_NAMES[0], JoinerCommon.ARTIST_GENRES[0],
+                          JoinerCommon.ARTIST_POPULARITIES[0]]
+    artists_df = pd.DataFrame({field: unique_tracks_df[field].explode().to_numpy() for field in artist_list_fields})
+    artists_df = artists_df.dropna(subset=[JoinerCommon.ARTIST_IDS[0]])
+    artists_df = artists_df.set_axis([ArtisterCommon.ARTIST_ID[0], ArtisterCommon.ARTIST_NAME[0],
+                                      ArtisterCommon.ARTIST_GENRE[0], ArtisterCommon.ARTIST_POPULARITY[0]], axis=1)
+    artists_df = artists_df.explode(ArtisterCommon.ARTIST_GENRE[0], ignore_index=True)[ArtisterCommon.SCHEMA]
+    artists_df = schemaregistry.apply_dtypes(artists_df, ArtisterCommon.TYPED_SCHEMA)
+    artists_df = artists_df.drop_duplicates([ArtisterCommon.ARTIST_ID[0], ArtisterCommon.ARTIST_GENRE[0]])
+
+    return join_dataframes(listening_df, tracks_df, albums_df, artists_df)
 
 
 def lambda_handler(file_names_map, context):
@@ -14,7 +147,7 @@ def lambda_handler(file_names_map, context):
     albums: <S3 file path for file containing album-metadata for albums recently listened to>
     artists: <S3 file path for file containing artist-metadata for artists recently listened to>
     :param context:
-    :return:
+    :return: uploaded S3 file name for the joined file, in the layout of the join mode (see JOIN_MODE)
     """
     listening_file_name = file_names_map['listening']
     tracks_file_name = file_names_map['tracks']
@@ -22,27 +155,20 @@ def lambda_handler(file_names_map, context):
     artists_file_name = file_names_map['artists']
 
     # Download all the dataframes from S3
-    listening_df = soundprintutils.download_df_from_s3_csv(listening_file_name, ListenerCommon.SCHEMA)
-    tracks_df = soundprintutils.download_df_from_s3_csv(tracks_file_name, TrackerCommon.SCHEMA)
-    albums_df = soundprintutils.download_df_from_s3_csv(albums_file_name, AlbumerCommon.SCHEMA)
-    artists_df = soundprintutils.download_df_from_s3_csv(artists_file_name, ArtisterCommon.SCHEMA)
-
-    # Join all the dataframes together
-    joined_df = listening_df.merge(
-        tracks_df, on=TrackerCommon.TRACK_ID[0]
-    ).merge(
-        albums_df, on=AlbumerCommon.ALBUM_ID[0]
-    ).merge(
-        artists_df, on=ArtisterCommon.ARTIST_ID[0]
-    )
-
-    # Rearrange data-frame to be in ascending order of listened-timestamp and follow the right schema
-    assert joined_df.columns.size == len(JoinerCommon.SCHEMA)
-    joined_df = joined_df[JoinerCommon.SCHEMA]
-    joined_df = joined_df.sort_values(ListenerCommon.TIMESTAMP[0], ascending=True)
+    listening_df = soundprintutils.download_df_from_s3(listening_file_name, ListenerCommon.TYPED_SCHEMA)
+    tracks_df = soundprintutils.download_df_from_s3(tracks_file_name, TrackerCommon.TYPED_SCHEMA)
+    albums_df = soundprintutils.download_df_from_s3(albums_file_name, AlbumerCommon.TYPED_SCHEMA)
+    artists_df = soundprintutils.download_df_from_s3(artists_file_name, ArtisterCommon.TYPED_SCHEMA)
 
-    # Upload to S3 as a CSV
-    joint_file_name = f"{JoinerCommon.FILE_PATH_PREFIX}{listening_file_name.split(ListenerCommon.FILE_PATH_PREFIX)[1]}"
-    soundprintutils.upload_df_to_s3_csv(joined_df, False, joint_file_name)
+    # Join all the dataframes together and upload to S3
+    file_name_suffix = listening_file_name.split(ListenerCommon.FILE_PATH_PREFIX)[1]
+    if JOIN_MODE == JOIN_MODE_COMPACT:
+        joined_df = join_compact_dataframes(listening_df, tracks_df, albums_df, artists_df)
+        joint_file_name = f"{JoinerCommon.COMPACT_FILE_PATH_PREFIX}{file_name_suffix}"
+        soundprintutils.upload_df_to_s3(joined_df, False, joint_file_name, JoinerCommon.COMPACT_TYPED_SCHEMA)
+    else:
+        joined_df = join_dataframes(listening_df, tracks_df, albums_df, artists_df)
+        joint_file_name = f"{JoinerCommon.FILE_PATH_PREFIX}{file_name_suffix}"
+        soundprintutils.upload_df_to_s3(joined_df, False, joint_file_name, JoinerCommon.TYPED_SCHEMA)
 
     return joint_file_name
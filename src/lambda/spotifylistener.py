@@ -1,12 +1,24 @@
+from __future__ import annotations
+
+from typing import Iterator
 from typing import List
 from datetime import datetime, timezone
-import tekore as tk
-import pandas as pd
 
 from src.common import soundprintutils
+from src.common import spotifyscheduler
 from src.common.listener import ListenerCommon
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, as the users lambda shares this module without needing them
+tk = lazy_import('tekore')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Maximum number of recently played tracks Spotify returns per page
+RECENTLY_PLAYED_PAGE_SIZE = 50
 
-TRACK_DURATION_MS = {}
+# Time before the current time from which tracks are queried for an account without a listening cursor yet
+DEFAULT_LOOKBACK_MS = 3600*1000
 
 
 def extract_playback_info(playback_items: List[tk.model.PlayHistory]) -> List[dict]:
@@ -25,97 +37,172 @@ def extract_playback_info(playback_items: List[tk.model.PlayHistory]) -> List[di
         soundprintutils.update_dict_by_schema(item_dict, ListenerCommon.TIMESTAMP,
                                               item.played_at.replace(tzinfo=timezone.utc).timestamp())
         soundprintutils.update_dict_by_schema(item_dict, ListenerCommon.TRACK_ID, item.track.id)
-
-        TRACK_DURATION_MS[item.track.id] = item.track.duration_ms
+        soundprintutils.update_dict_by_schema(item_dict, ListenerCommon.TRACK_DURATION, item.track.duration_ms)
 
         items_dict_list.append(item_dict)
 
     return items_dict_list
 
 
-def get_tracks_played_after(spotify_client: tk.Spotify, after_timestamp_ms: int) -> pd.DataFrame:
+def iterate_recently_played_pages(spotify_client: tk.Spotify, after_timestamp_ms: int,
+                                  max_pages: int = None) -> Iterator[tk.model.PlayHistoryPaging]:
     """
-    Using the spotify-client, this function will query Spotify Web API to get recently played tracks after the
-    point of time specified by the provided timestamp.
-    The results are extracted, parsed and returned in a pandas DataFrame with schema according to ListenerCommon#SCHEMA.
-    The column for ListenerCommon#LISTENED_TIME is not populated for any row and is NaN
+    Generates the pages of recently played tracks after the point of time specified by the provided timestamp,
+    following the paging cursors forward in time until there are no more tracks or max_pages pages have been queried
     :param spotify_client: Client with access token to query Spotify Web API
     :param after_timestamp_ms: Epoch time in milliseconds after which recently played tracks are to be queried
-    :return: pandas DataFrame with relevant fields of recently played soundtracks on Spotify
+    :param max_pages: Maximum number of pages to query, unlimited if None
     """
-    df = pd.DataFrame([], columns=ListenerCommon.SCHEMA)
-
-    response = spotify_client.playback_recently_played(limit=50, after=after_timestamp_ms)
+    page_count = 0
+    response = spotify_client.playback_recently_played(limit=RECENTLY_PLAYED_PAGE_SIZE, after=after_timestamp_ms)
     while len(response.items) > 0:
-        df = df.append(pd.DataFrame(extract_playback_info(response.items), columns=ListenerCommon.SCHEMA))
-        if response.cursors is None:
-            break
-        else:
-            next_after_ms = int(response.cursors.after)
-            response = spotify_client.playback_recently_played(limit=50, after=next_after_ms)
+        yield response
+        page_count += 1
 
-    return df
+        if response.cursors is None or (max_pages is not None and page_count >= max_pages):
+            return
+        next_after_ms = int(response.cursors.after)
+        response = spotify_client.playback_recently_played(limit=RECENTLY_PLAYED_PAGE_SIZE, after=next_after_ms)
+
+
+def iterate_playback_records(spotify_client: tk.Spotify, after_timestamp_ms: int, before_timestamp_ms: int = None,
+                             max_pages: int = None) -> Iterator[dict]:
+    """
+    Generates the extracted playback records (see extract_playback_info) of tracks played in the window
+    (after_timestamp_ms, before_timestamp_ms]. Pages are queried forward in time, so no more pages are queried once a
+    page reaches past the end of the window.
+    :param spotify_client: Client with access token to query Spotify Web API
+    :param after_timestamp_ms: Epoch time in milliseconds after which recently played tracks are to be queried
+    :param before_timestamp_ms: Epoch time in milliseconds up to which recently played tracks are to be queried,
+    unbounded if None
+    :param max_pages: Maximum number of pages to query, unlimited if None
+    """
+    for page in iterate_recently_played_pages(spotify_client, after_timestamp_ms, max_pages):
+        records = extract_playback_info(page.items)
+        if before_timestamp_ms is None:
+            yield from records
+            continue
+
+        window_records = [record for record in records
+                          if record[ListenerCommon.TIMESTAMP[0]] * 1000 <= before_timestamp_ms]
+        yield from window_records
+        if len(window_records) < len(records):
+            return
+
+
+def get_tracks_played_after(spotify_client: tk.Spotify, after_timestamp_ms: int, before_timestamp_ms: int = None,
+                            max_pages: int = None) -> pd.DataFrame:
+    """
+    Using the spotify-client, this function will query Spotify Web API to get recently played tracks after the
+    point of time specified by the provided timestamp, and up to the point of time specified by before_timestamp_ms
+    if provided.
+    The results are extracted, parsed and returned in a pandas DataFrame with schema according to
+    ListenerCommon#PLAYBACK_SCHEMA. The column for ListenerCommon#LISTENED_TIME is not populated for any row and is NaN
+    :param spotify_client: Client with access token to query Spotify Web API
+    :param after_timestamp_ms: Epoch time in milliseconds after which recently played tracks are to be queried
+    :param before_timestamp_ms: Epoch time in milliseconds up to which recently played tracks are to be queried,
+    unbounded if None
+    :param max_pages: Maximum number of pages to query, unlimited if None
+    :return: pandas DataFrame with relevant fields of recently played soundtracks on Spotify
+    """
+    records = list(iterate_playback_records(spotify_client, after_timestamp_ms, before_timestamp_ms, max_pages))
+    return pd.DataFrame(records, columns=ListenerCommon.PLAYBACK_SCHEMA)
 
 
 def update_listened_to_durations(playtracks_df: pd.DataFrame, current_timestamp_ms: int) -> pd.DataFrame:
     """
     Given a populated pandas DataFrame containing extracted data from recently played tracks according to
-    ListenerCommon#SCHEMA, calculate the time in milliseconds spent in listening to each track.
-    Returns an updated pandas DataFrame with ListenerCommon#LISTENED_TIME filled in with results of the calculation.
+    ListenerCommon#PLAYBACK_SCHEMA, calculate the time in milliseconds spent in listening to each track.
+    Returns an updated pandas DataFrame according to ListenerCommon#SCHEMA with ListenerCommon#LISTENED_TIME filled in
+    with results of the calculation.
     The returned dataframe is sorted in ascending order of timestamp of when the track was played.
     :param playtracks_df: The input pandas DataFrame
     :param current_timestamp_ms: The timestamp of the time when query was run
     :return: Output pandas DataFrame with calculated ListenerCommon#LISTENED_TIME, sorted by when track was played in
     ascending order
     """
-    playtracks_df = playtracks_df.sort_values(ListenerCommon.TIMESTAMP[0], ascending=False)
+    playtracks_df = playtracks_df.sort_values(ListenerCommon.TIMESTAMP[0], ascending=True, kind='mergesort')
 
-    listened_ms_list = []
-    more_recent_timestamp_ms = current_timestamp_ms
+    played_at_timestamps_ms = \
+        (playtracks_df[ListenerCommon.TIMESTAMP[0]].to_numpy(dtype=np.float64) * 1000).astype(np.int64)
+    track_durations_ms = playtracks_df[ListenerCommon.TRACK_DURATION[0]].to_numpy(dtype=np.int64)
 
-    for index, row in playtracks_df.iterrows():
-        track_duration_ms = TRACK_DURATION_MS[row[ListenerCommon.TRACK_ID[0]]]
-        played_at_timestamp_ms = int(row[ListenerCommon.TIMESTAMP[0]]*1000)
+    # The time-gap after each track is until the next track was played, or until the query was run for the most
+    # recent track.
+    # If the time-gap is longer than the track's duration, assume the entire track was listened to and use
+    # track-duration as value. Else, use the time-gap.
+    gaps_ms = np.diff(played_at_timestamps_ms, append=np.int64(current_timestamp_ms))
+    listened_ms = np.minimum(gaps_ms, track_durations_ms)
 
-        # If the time-gap between when this track was played and when next track was played is longer than the
-        # track's duration, assume the entire track was listened to and use track-duration as value
-        # Else, use time-gap between when this track was played and when next track was played
-        if (more_recent_timestamp_ms - played_at_timestamp_ms) > track_duration_ms:
-            listened_ms_list.append(ListenerCommon.LISTENED_TIME[1](track_duration_ms))
-        else:
-            listened_ms_list.append(ListenerCommon.LISTENED_TIME[1](more_recent_timestamp_ms - played_at_timestamp_ms))
+    playtracks_df = playtracks_df.assign(**{ListenerCommon.LISTENED_TIME[0]: listened_ms})
 
-        more_recent_timestamp_ms = played_at_timestamp_ms
+    return playtracks_df[ListenerCommon.SCHEMA]
 
-    listened_ms_series = pd.Series(listened_ms_list, name=ListenerCommon.LISTENED_TIME[0], index=playtracks_df.index)
-    playtracks_df.update(listened_ms_series)
 
-    return playtracks_df.sort_values(ListenerCommon.TIMESTAMP[0], ascending=True)
+def get_listening_file_name(current_timestamp_ms: int, user_id: str = None) -> str:
+    """
+    Returns the S3 file name for the listening history of the given user queried at the given timestamp, in the
+    configured storage format. File names of the downstream stages are derived from it by replacing its prefix.
+    """
+    dt = datetime.fromtimestamp(current_timestamp_ms/1000, tz=timezone.utc)
+    file_path_prefix = soundprintutils.get_user_file_path_prefix(ListenerCommon.FILE_PATH_PREFIX, user_id)
+    return f"{file_path_prefix}{dt.year}/{dt.month}/{dt.day}/" \
+           f"{dt.hour}-{dt.day}-{dt.month}-{dt.year}{soundprintutils.get_file_extension()}"
+
+
+def get_after_timestamp_ms(current_timestamp_ms: int, user_id: str = None) -> int:
+    """
+    Returns the epoch time in milliseconds after which tracks played by the given user are to be queried: the user's
+    listening cursor, i.e. their most recent archived play, or DEFAULT_LOOKBACK_MS before the current time if nothing
+    has been archived for the user yet
+    """
+    cursor_ms = soundprintutils.get_listening_cursor(user_id)
+    return cursor_ms if cursor_ms is not None else current_timestamp_ms - DEFAULT_LOOKBACK_MS
 
 
 def lambda_handler(event, context):
     """
-    Lambda handler for the action of querying most recently heard tracks in the last 1 hour from Spotify
-    and uploading the results into a CSV file in the S3 bucket.
-    The CSV file follows the schema for ListenerCommon#SCHEMA.
-    :return uploaded S3 file name with listening history
+    Lambda handler for the action of querying the tracks heard since the most recent archived play from Spotify
+    and uploading the results into a file in the S3 bucket.
+    The file follows the schema for ListenerCommon#TYPED_SCHEMA.
+    :param event: Optionally, a map with the user_id of the listener to query, e.g. as an item of a Map state. The
+    original account is queried if not provided.
+    :return uploaded S3 file name with listening history, or None if no tracks were heard since the last run
     """
-    # First, get access token
-    access_token = soundprintutils.get_access_token()
+    user_id = event.get('user_id') if isinstance(event, dict) else None
+
+    # Bound the Retry-After of throttled Spotify requests by the time left in this invocation
+    spotifyscheduler.set_deadline(context)
 
-    # Initialize Spotify client and query tracks played in the last hour
-    spotify = tk.Spotify(access_token)
+    # Initialize Spotify client with the user's access token and query tracks played after the listening cursor
+    spotify = soundprintutils.get_spotify_client(user_id)
     current_timestamp_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
-    snapshot_begin_timestamp_ms = current_timestamp_ms - 3600*1000
-    tracks_df = get_tracks_played_after(spotify, snapshot_begin_timestamp_ms)
+    after_timestamp_ms = get_after_timestamp_ms(current_timestamp_ms, user_id)
+    tracks_df = get_tracks_played_after(spotify, after_timestamp_ms, current_timestamp_ms)
+    spotifyscheduler.log_counters()
+
+    # Nothing to do downstream if no tracks were heard since the last run
+    if len(tracks_df.index) == 0:
+        return None
+
+    # Start waking up the Aurora serverless cluster, so that it resumes while the downstream stages query Spotify
+    soundprintutils.trigger_aurora_wakeup()
 
     # Calculate time spent in listening to each track
     tracks_df = update_listened_to_durations(tracks_df, current_timestamp_ms)
 
-    # Upload to S3 as a CSV
-    dt = datetime.fromtimestamp(current_timestamp_ms/1000, tz=timezone.utc)
-    s3_file_name = f"{ListenerCommon.FILE_PATH_PREFIX}{dt.year}/{dt.month}/{dt.day}/" \
-                   f"{dt.hour}-{dt.day}-{dt.month}-{dt.year}.csv"
-    soundprintutils.upload_df_to_s3_csv(df=tracks_df, include_index=False, file_name=s3_file_name)
+    # Upload to S3 in the configured storage format
+    s3_file_name = get_listening_file_name(current_timestamp_ms, user_id)
+    soundprintutils.upload_df_to_s3(df=tracks_df, include_index=False, file_name=s3_file_name,
+                                    typed_schema=ListenerCommon.TYPED_SCHEMA)
 
     return s3_file_name
+
+
+def users_handler(event, context):
+    """
+    Lambda handler listing the listeners to query, as the items of the state machine's Map state that runs the
+    pipeline for each of them
+    :return: List of maps with the user_id of each listener: the original account (None) and all registered users
+    """
+    return [{'user_id': user_id} for user_id in [None] + soundprintutils.get_user_ids()]
@@ -0,0 +1,267 @@
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import os
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import tekore as tk
+import pandas as pd
+
+from src.common import soundprintutils
+from src.common import spotifyscheduler
+from src.common.entitycache import EntityCache
+from src.common.featureindex import AudioFeatureIndex
+from src.common.listener import ListenerCommon
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+from src.common.joiner import JoinerCommon
+from . import spotifylistener
+from . import spotifytracker
+from . import spotifyalbumer
+from . import spotifyartister
+from . import spotifyjoiner
+from .archiver import spotifyrdsarchiver
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.DEBUG)
+
+# If true, the output of every stage is uploaded to S3 as the individual stage lambdas would. The joined file is
+# uploaded either way, as the compactor compacts the listening history from the joined files.
+WRITE_INTERMEDIATE_FILES = os.environ.get('SOUNDPRINT_PIPELINE_WRITE_INTERMEDIATE_FILES', 'false').lower() == 'true'
+
+# Maximum number of users whose tokens and listening histories are queried at once
+MAX_USER_CONCURRENCY = int(os.environ.get('SOUNDPRINT_PIPELINE_MAX_USER_CONCURRENCY', 8))
+
+
+def get_joined_file_name(current_timestamp_ms: int, user_id: str = None) -> str:
+    """
+    Returns the file name of a user's joined file, following the file names of the individual stage lambdas
+    """
+    listening_file_name = spotifylistener.get_listening_file_name(current_timestamp_ms, user_id)
+    return f"{JoinerCommon.FILE_PATH_PREFIX}{listening_file_name.split(ListenerCommon.FILE_PATH_PREFIX)[1]}"
+
+
+def upload_stage_files(listening_df: pd.DataFrame, tracks_df: pd.DataFrame, albums_df: pd.DataFrame,
+                       artists_df: pd.DataFrame, joined_df: pd.DataFrame, current_timestamp_ms: int,
+                       user_id: str = None) -> str:
+    """
+    Uploads the output of every stage for a user to S3 under the same file names the individual stage lambdas use.
+    Returns the file name of the joined file
+    """
+    listening_file_name = spotifylistener.get_listening_file_name(current_timestamp_ms, user_id)
+    file_name_suffix = listening_file_name.split(ListenerCommon.FILE_PATH_PREFIX)[1]
+
+    soundprintutils.upload_df_to_s3(listening_df, False, listening_file_name, ListenerCommon.TYPED_SCHEMA)
+    soundprintutils.upload_df_to_s3(tracks_df, False, f"{TrackerCommon.FILE_PATH_PREFIX}{file_name_suffix}",
+                                    TrackerCommon.TYPED_SCHEMA)
+    soundprintutils.upload_df_to_s3(albums_df, False, f"{AlbumerCommon.FILE_PATH_PREFIX}{file_name_suffix}",
+                                    AlbumerCommon.TYPED_SCHEMA)
+    soundprintutils.upload_df_to_s3(artists_df, False, f"{ArtisterCommon.FILE_PATH_PREFIX}{file_name_suffix}",
+                                    ArtisterCommon.TYPED_SCHEMA)
+
+    joined_file_name = get_joined_file_name(current_timestamp_ms, user_id)
+    soundprintutils.upload_df_to_s3(joined_df, False, joined_file_name, JoinerCommon.TYPED_SCHEMA)
+    return joined_file_name
+
+
+def query_listening_history(spotify_client: tk.Spotify, after_timestamp_ms: int, current_timestamp_ms: int,
+                            max_pages: int = None) -> pd.DataFrame:
+    """
+    Queries the tracks played in the window (after_timestamp_ms, current_timestamp_ms] and calculates time spent in
+    listening to each track. Returns a DataFrame following ListenerCommon.SCHEMA
+    """
+    listening_df = spotifylistener.get_tracks_played_after(spotify_client, after_timestamp_ms, current_timestamp_ms,
+                                                           max_pages)
+    return spotifylistener.update_listened_to_durations(listening_df, current_timestamp_ms)
+
+
+def query_metadata(spotify_client: tk.Spotify, track_ids: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame,
+                                                                                pd.DataFrame]:
+    """
+    Extracts all data related to the tracks, and then their albums and artists in parallel, querying Spotify only for
+    entities that are not cached. The caches are saved once all the metadata is extracted.
+    :return: Tuple of tracks, albums and artists DataFrames
+    """
+    track_cache = EntityCache('tracks', TrackerCommon.TYPED_SCHEMA, TrackerCommon.TRACK_ID,
+                              TrackerCommon.VOLATILE_SCHEMA)
+    album_cache = EntityCache('albums', AlbumerCommon.TYPED_SCHEMA, AlbumerCommon.ALBUM_ID,
+                              AlbumerCommon.VOLATILE_SCHEMA)
+    artist_cache = EntityCache('artists', ArtisterCommon.TYPED_SCHEMA, ArtisterCommon.ARTIST_ID,
+                               ArtisterCommon.VOLATILE_SCHEMA)
+
+    tracks_df = spotifytracker.get_tracks_data(spotify_client, track_ids, track_cache)
+
+    album_ids = list(set(tracks_df[TrackerCommon.ALBUM_ID[0]].dropna()))
+    artist_ids = list(set(tracks_df[TrackerCommon.ARTIST_ID[0]].dropna()))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        albums_future = executor.submit(spotifyalbumer.get_albums_data, spotify_client, album_ids, album_cache)
+        artists_future = executor.submit(spotifyartister.get_artists_data, spotify_client, artist_ids, artist_cache)
+        albums_df = albums_future.result()
+        artists_df = artists_future.result()
+
+    for entity_cache in (track_cache, album_cache, artist_cache):
+        entity_cache.save()
+
+    feature_index = AudioFeatureIndex()
+    feature_index.add(tracks_df)
+    feature_index.save()
+
+    return tracks_df, albums_df, artists_df
+
+
+def join_user_rows(listening_df: pd.DataFrame, tracks_df: pd.DataFrame, albums_df: pd.DataFrame,
+                   artists_df: pd.DataFrame, current_timestamp_ms: int, user_id: str = None,
+                   write_intermediate_files: bool = WRITE_INTERMEDIATE_FILES) -> pd.DataFrame:
+    """
+    Joins a user's listening history with the metadata extracted for all users, uploading the user's stage files to
+    S3 if write_intermediate_files is true. Otherwise, only the joined file is uploaded if the user played any tracks,
+    for the compactor to compact. Returns the joined DataFrame following JoinerCommon.SCHEMA
+    """
+    joined_df = spotifyjoiner.join_dataframes(listening_df, tracks_df, albums_df, artists_df)
+    LOGGER.info(f"Joined {joined_df.shape[0]} records for user {user_id}")
+
+    if write_intermediate_files:
+        # Stage files only hold the metadata of the user's own tracks, as the individual stage lambdas would
+        user_tracks_df = tracks_df[tracks_df[TrackerCommon.TRACK_ID[0]].isin(listening_df[ListenerCommon.TRACK_ID[0]])]
+        user_albums_df = albums_df[albums_df[AlbumerCommon.ALBUM_ID[0]].isin(user_tracks_df[TrackerCommon.ALBUM_ID[0]])]
+        user_artists_df = \
+            artists_df[artists_df[ArtisterCommon.ARTIST_ID[0]].isin(user_tracks_df[TrackerCommon.ARTIST_ID[0]])]
+        joined_file_name = upload_stage_files(listening_df, user_tracks_df, user_albums_df, user_artists_df,
+                                              joined_df, current_timestamp_ms, user_id)
+        LOGGER.info(f"Uploaded stage files for user {user_id}, joined file: {joined_file_name}")
+    elif len(joined_df.index) > 0:
+        joined_file_name = get_joined_file_name(current_timestamp_ms, user_id)
+        soundprintutils.upload_df_to_s3(joined_df, False, joined_file_name, JoinerCommon.TYPED_SCHEMA)
+        LOGGER.info(f"Uploaded joined file for user {user_id}: {joined_file_name}")
+
+    return joined_df
+
+
+def run_users_pipeline(spotify_clients: Dict[Optional[str], tk.Spotify], after_timestamps_ms: Dict[Optional[str], int],
+                       current_timestamp_ms: int, rds_client, max_pages: int = None,
+                       write_intermediate_files: bool = WRITE_INTERMEDIATE_FILES,
+                       max_user_concurrency: int = MAX_USER_CONCURRENCY,
+                       advance_cursors: bool = False) -> Dict[Optional[str], pd.DataFrame]:
+    """
+    Runs all the stages of the Soundprint pipeline for many users in a single process, passing the DataFrames between
+    stages in memory instead of through S3:
+    listening history of each user (fanned out across users) -> metadata of the tracks played by any user, with their
+    albums and artists -> join for each user -> archive into each user's Aurora DB tables
+    Metadata is queried once for all users, so a track played by many users is fetched from Spotify at most once.
+    :param spotify_clients: Map of user-id (None for the original account) to a client with the user's access token
+    :param after_timestamps_ms: Map of user-id to the epoch time in milliseconds after which the user's played tracks
+    are processed
+    :param current_timestamp_ms: Epoch time in milliseconds up to which played tracks are processed, also used as the
+    boundary for calculating the listened time of the last track
+    :param rds_client: RDSDataService client for archiving
+    :param max_pages: Maximum number of pages of listening history to query per user, unlimited if None
+    :param write_intermediate_files: If true, the output of every stage is also uploaded to S3 for each user, not only
+    the joined file
+    :param max_user_concurrency: Maximum number of users whose listening histories are queried at once
+    :param advance_cursors: If true, the archived records of each user are added to their listening rollups, and
+    their listening cursor is advanced past the records
+    :return: Map of user-id to the joined DataFrame following JoinerCommon.SCHEMA that was archived for the user
+    """
+    user_ids = list(spotify_clients)
+    if len(user_ids) == 0:
+        return {}
+
+    # Query the listening history of all the users
+    with ThreadPoolExecutor(max_workers=max_user_concurrency) as executor:
+        listening_dfs = dict(zip(user_ids, executor.map(
+            lambda user_id: query_listening_history(spotify_clients[user_id], after_timestamps_ms[user_id],
+                                                    current_timestamp_ms, max_pages),
+            user_ids)))
+    num_plays = sum(df.shape[0] for df in listening_dfs.values())
+    LOGGER.info(f"Queried {num_plays} played tracks of {len(user_ids)} users")
+
+    # Nothing to do downstream if no tracks were heard by any of the users
+    if num_plays == 0:
+        return {user_id: pd.DataFrame([], columns=JoinerCommon.SCHEMA) for user_id in user_ids}
+
+    # Start waking up the Aurora serverless cluster, so that it resumes while the metadata is queried
+    soundprintutils.trigger_aurora_wakeup()
+
+    # Extract the metadata of the tracks played by any of the users. Metadata is the same for all users, so it is
+    # queried with the first user's client.
+    track_ids = list(set().union(*(df[ListenerCommon.TRACK_ID[0]] for df in listening_dfs.values())))
+    tracks_df, albums_df, artists_df = query_metadata(spotify_clients[user_ids[0]], track_ids)
+
+    joined_dfs = {
+        user_id: join_user_rows(listening_dfs[user_id], tracks_df, albums_df, artists_df, current_timestamp_ms,
+                                user_id, write_intermediate_files)
+        for user_id in user_ids
+    }
+
+    # Archive the joined records, waking up the Aurora serverless cluster only if there are records to archive
+    if any(len(joined_df.index) > 0 for joined_df in joined_dfs.values()):
+        wakeup_secs = spotifyrdsarchiver.wakeup_serverless(rds_client)
+        LOGGER.info(f"Waited {wakeup_secs:.1f}s for Aurora Serverless Cluster: {soundprintutils.AURORA_DB}")
+        for user_id, joined_df in joined_dfs.items():
+            if len(joined_df.index) == 0:
+                continue
+            spotifyrdsarchiver.archive_joined_rows(joined_df, rds_client, user_id=user_id)
+            LOGGER.info(f"Archived {joined_df.shape[0]} records for user {user_id}")
+            if advance_cursors:
+                spotifyrdsarchiver.update_listening_rollups(joined_df, user_id)
+                spotifyrdsarchiver.advance_listening_cursor(joined_df, user_id)
+
+    return joined_dfs
+
+
+def run_pipeline(spotify_client: tk.Spotify, after_timestamp_ms: int, current_timestamp_ms: int, rds_client,
+                 max_pages: int = None, write_intermediate_files: bool = WRITE_INTERMEDIATE_FILES,
+                 user_id: str = None) -> pd.DataFrame:
+    """
+    Runs all the stages of the Soundprint pipeline for a single user, see run_users_pipeline
+    :param user_id: User-id of the listener whose access token the client has, None for the original account
+    :return: The joined DataFrame following JoinerCommon.SCHEMA that was archived
+    """
+    return run_users_pipeline({user_id: spotify_client}, {user_id: after_timestamp_ms}, current_timestamp_ms,
+                              rds_client, max_pages, write_intermediate_files)[user_id]
+
+
+def lambda_handler(event, context):
+    """
+    Lambda handler for running the entire Soundprint pipeline in a single invocation. This is the hourly production
+    run; the state machine running each stage as its own lambda is only started on demand, as it queries metadata for
+    each account on its own. By default, processes the tracks played since their listening cursor by the original
+    account and all the users registered in the token store, and advances their cursors past the archived records.
+    The time-window can be provided in the event for reprocessing, as after_timestamp_ms and before_timestamp_ms
+    (epoch milliseconds), along with max_pages to bound the listening history queried, and user_ids to process only
+    some users. Cursors are left as they are when reprocessing a given time-window.
+    :return: Number of records archived for each user, by user-id
+    """
+    if event is None:
+        event = {}
+
+    current_timestamp_ms = event.get('before_timestamp_ms',
+                                     int(datetime.now(tz=timezone.utc).timestamp() * 1000))
+
+    user_ids = event.get('user_ids')
+    if user_ids is None:
+        user_ids = [None] + soundprintutils.get_user_ids()
+
+    # Bound the Retry-After of throttled Spotify requests by the time left in this invocation
+    spotifyscheduler.set_deadline(context)
+
+    # Get the Spotify client and listening cursor of every user, refreshing the expired access tokens concurrently
+    with ThreadPoolExecutor(max_workers=MAX_USER_CONCURRENCY) as executor:
+        spotify_clients = dict(zip(user_ids, executor.map(soundprintutils.get_spotify_client, user_ids)))
+        if 'after_timestamp_ms' in event:
+            after_timestamps_ms = [event['after_timestamp_ms']] * len(user_ids)
+        else:
+            after_timestamps_ms = list(executor.map(
+                lambda user_id: spotifylistener.get_after_timestamp_ms(current_timestamp_ms, user_id), user_ids))
+    rds_data_client = spotifyrdsarchiver.create_rds_data_client()
+
+    joined_dfs = run_users_pipeline(spotify_clients, dict(zip(user_ids, after_timestamps_ms)), current_timestamp_ms,
+                                    rds_data_client, max_pages=event.get('max_pages'),
+                                    advance_cursors='after_timestamp_ms' not in event)
+    spotifyscheduler.log_counters()
+
+    return {str(user_id): joined_df.shape[0] for user_id, joined_df in joined_dfs.items()}
@@ -1,13 +1,118 @@
+from __future__ import annotations
+
+from typing import Dict
 from typing import List
-import tekore as tk
-import pandas as pd
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from src.common import soundprintutils
+from src.common import spotifyscheduler
 from src.common.listener import ListenerCommon
 from src.common.tracker import TrackerCommon
+from src.common.lazyimport import lazy_import
+
+# Imported on first use, so that modules importing this one only pay for them once they run the stage
+tk = lazy_import('tekore')
+pd = lazy_import('pandas')
+extraction = lazy_import('src.common.extraction')
+entitycache = lazy_import('src.common.entitycache')
+featureindex = lazy_import('src.common.featureindex')
+
+# Maximum number of ids Spotify accepts per request for each kind of track query
+TRACKS_CHUNK_SIZE = 50
+AUDIO_FEATURES_CHUNK_SIZE = 100
+
+
+# Paths of the fields of track-objects, other than the track's id and artists, and of audio-features objects
+TRACK_METADATA_PATHS = [
+    (TrackerCommon.ALBUM_ID, 'album.id'),
+    (TrackerCommon.DURATION_MS, 'duration_ms'),
+    (TrackerCommon.NAME, 'name'),
+    (TrackerCommon.POPULARITY, 'popularity'),
+    (TrackerCommon.EXPLICIT, 'explicit'),
+]
+TRACK_AUDIO_FEATURES_PATHS = [
+    (TrackerCommon.ACOUSTICNESS, 'acousticness'),
+    (TrackerCommon.DANCEABILITY, 'danceability'),
+    (TrackerCommon.ENERGY, 'energy'),
+    (TrackerCommon.INSTRUMENTALNESS, 'instrumentalness'),
+    (TrackerCommon.KEY, 'key'),
+    (TrackerCommon.LIVENESS, 'liveness'),
+    (TrackerCommon.LOUDNESS, 'loudness'),
+    (TrackerCommon.MODE, 'mode'),
+    (TrackerCommon.SPEECHINESS, 'speechiness'),
+    (TrackerCommon.TEMPO, 'tempo'),
+    (TrackerCommon.TIME_SIGNATURE, 'time_signature'),
+    (TrackerCommon.VALENCE, 'valence'),
+]
+
+
+def extract_track_columns(track_ids: List[str], tracks_metadata: List[tk.model.FullTrack]) -> Dict[str, list]:
+    """
+    Extracts the fields of the track-objects into a list per field, with the list of artist-ids of each track as its
+    artist-id
+    """
+    for index, track_id in enumerate(track_ids):
+        assert tracks_metadata[index].id == track_id, f"Track metadata object mismatch at index {index}"
+
+    track_columns = {TrackerCommon.TRACK_ID[0]: track_ids}
+    track_columns.update(extraction.extract_columns(tracks_metadata, TRACK_METADATA_PATHS))
+    track_columns[TrackerCommon.ARTIST_ID[0]] = [[artist.id for artist in track_metadata.artists]
+                                                 for track_metadata in tracks_metadata]
+    return track_columns
 
 
-def get_tracks_data(spotify_client: tk.Spotify, track_ids: List[str]) -> pd.DataFrame:
+def fetch_tracks_data(spotify_client: tk.Spotify, track_ids: List[str],
+                      max_concurrency: int = soundprintutils.SPOTIFY_MAX_CONCURRENCY) -> pd.DataFrame:
+    """
+    Queries Spotify for the track-objects and track-audio-features of all the tracks and compiles them into a
+    data-frame with schema according to TrackerCommon.SCHEMA. The track-ids are queried in chunks of the maximum
+    size Spotify allows per request, with at most max_concurrency requests in flight at once.
+    """
+    # Get track-objects and track-audio-features for all tracks from querying Spotify, with all the chunked requests
+    # for both in flight concurrently
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        tracks_futures = soundprintutils.submit_chunked(executor, spotify_client.tracks, track_ids, TRACKS_CHUNK_SIZE)
+        tracks_audio_features_futures = soundprintutils.submit_chunked(
+            executor, spotify_client.tracks_audio_features, track_ids, AUDIO_FEATURES_CHUNK_SIZE)
+
+        tracks_metadata = soundprintutils.gather_chunked(tracks_futures)
+        tracks_audio_features = soundprintutils.gather_chunked(tracks_audio_features_futures)
+
+    for index, track_id in enumerate(track_ids):
+        assert tracks_audio_features[index].id == track_id, f"Track audio-features object mismatch at index {index}"
+
+    track_columns = extract_track_columns(track_ids, tracks_metadata)
+    track_columns.update(extraction.extract_columns(tracks_audio_features, TRACK_AUDIO_FEATURES_PATHS))
+
+    return extraction.build_df(track_columns, TrackerCommon.TYPED_SCHEMA, TrackerCommon.ARTIST_ID)
+
+
+def refresh_tracks_data(spotify_client: tk.Spotify, stale_tracks_df: pd.DataFrame,
+                        max_concurrency: int = soundprintutils.SPOTIFY_MAX_CONCURRENCY) -> pd.DataFrame:
+    """
+    Given cached track rows whose volatile fields have expired, queries Spotify for only the track-objects of those
+    tracks and compiles a data-frame with schema according to TrackerCommon.SCHEMA. Audio-features never change, so
+    they are carried over from the cached rows instead of being queried again.
+    """
+    track_ids = list(stale_tracks_df[TrackerCommon.TRACK_ID[0]].drop_duplicates())
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        tracks_futures = soundprintutils.submit_chunked(executor, spotify_client.tracks, track_ids, TRACKS_CHUNK_SIZE)
+        tracks_metadata = soundprintutils.gather_chunked(tracks_futures)
+
+    audio_features_df = stale_tracks_df[[TrackerCommon.TRACK_ID[0]] + TrackerCommon.AUDIO_FEATURES_SCHEMA]
+    audio_features_df = audio_features_df.drop_duplicates(TrackerCommon.TRACK_ID[0])
+
+    metadata_typed_schema = [ts for ts in TrackerCommon.TYPED_SCHEMA
+                             if ts[0] not in TrackerCommon.AUDIO_FEATURES_SCHEMA]
+    metadata_df = extraction.build_df(extract_track_columns(track_ids, tracks_metadata), metadata_typed_schema,
+                                      TrackerCommon.ARTIST_ID)
+
+    return metadata_df.merge(audio_features_df, on=TrackerCommon.TRACK_ID[0])[TrackerCommon.SCHEMA]
+
+
+def get_tracks_data(spotify_client: tk.Spotify, track_ids: List[str], track_cache: entitycache.EntityCache = None,
+                    max_concurrency: int = soundprintutils.SPOTIFY_MAX_CONCURRENCY) -> pd.DataFrame:
     """
     Given a spotify-client and a list of track-ids, compiles a data-frame with metadata for all the tracks in the list.
     The compiled metadata contains the following fields:
@@ -30,72 +135,60 @@ def get_tracks_data(spotify_client: tk.Spotify, track_ids: List[str]) -> pd.Data
     17. mode - Major is represented by 1 and minor is 0.
     18. tempo - overall beats per minute
     19. time-signature - integer notational convention to specify how many beats are in each bar
+    If a track-cache is provided, only tracks missing from the cache, or whose popularity has expired in the cache,
+    are queried from Spotify. The cache is updated with the queried tracks but not saved.
+    Track-ids are queried in chunks, with at most max_concurrency chunk requests in flight at once.
     :return: DataFrame with schema according to TrackerCommon.SCHEMA
     """
-    # Get track-objects and track-audio-features for all tracks from querying Spotify
-    tracks_metadata = spotify_client.tracks(track_ids) if len(track_ids) > 0 else []
-    tracks_audio_features = spotify_client.tracks_audio_features(track_ids) if len(track_ids) > 0 else []
+    if track_cache is None:
+        return fetch_tracks_data(spotify_client, track_ids, max_concurrency)
 
-    track_dict_list = []
-    for index, track_id in enumerate(track_ids):
-        assert tracks_metadata[index].id == track_id, f"Track metadata object mismatch at index {index}"
-        assert tracks_audio_features[index].id == track_id, f"Track audio-features object mismatch at index {index}"
+    now = datetime.now().timestamp()
+    cached_tracks_df, stale_tracks_df, missing_track_ids = track_cache.lookup(track_ids, now)
+
+    fetched_tracks_df = fetch_tracks_data(spotify_client, missing_track_ids, max_concurrency)
+    refreshed_tracks_df = refresh_tracks_data(spotify_client, stale_tracks_df, max_concurrency)
+    track_cache.update(pd.concat([fetched_tracks_df, refreshed_tracks_df], ignore_index=True), now)
 
-        track_metadata = tracks_metadata[index]
-        track_audio_features = tracks_audio_features[index]
-
-        track_dict = {}
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.TRACK_ID, track_id)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.ALBUM_ID, track_metadata.album.id)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.DURATION_MS, track_metadata.duration_ms)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.NAME, track_metadata.name)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.POPULARITY, track_metadata.popularity)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.EXPLICIT, track_metadata.explicit)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.ACOUSTICNESS, track_audio_features.acousticness)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.DANCEABILITY, track_audio_features.danceability)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.ENERGY, track_audio_features.energy)
-        soundprintutils.update_dict_by_schema(track_dict,
-                                              TrackerCommon.INSTRUMENTALNESS, track_audio_features.instrumentalness)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.KEY, track_audio_features.key)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.LIVENESS, track_audio_features.liveness)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.LOUDNESS, track_audio_features.loudness)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.MODE, track_audio_features.mode)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.SPEECHINESS, track_audio_features.speechiness)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.TEMPO, track_audio_features.tempo)
-        soundprintutils.update_dict_by_schema(track_dict,
-                                              TrackerCommon.TIME_SIGNATURE, track_audio_features.time_signature)
-        soundprintutils.update_dict_by_schema(track_dict, TrackerCommon.VALENCE, track_audio_features.valence)
-
-        track_artists = list(map(lambda artist: artist.id, track_metadata.artists))
-        track_dict_list += soundprintutils.normalize_dict_field_list(track_dict, track_artists, TrackerCommon.ARTIST_ID)
-
-    return pd.DataFrame(track_dict_list, columns=TrackerCommon.SCHEMA)
+    return pd.concat([cached_tracks_df, refreshed_tracks_df, fetched_tracks_df], ignore_index=True)
 
 
 def lambda_handler(listened_file_name, context):
     """
     Lambda handler for the action of querying spotify for all information related to spotify-soundtracks by track-id.
-    This function reads the S3 object CSV file containing the track-ids for the recently heard tracks and queries
-    Spotify to get the metadata about all those tracks. This metadata is compiled into a CSV file as a table with
-    primary key being track-id. This CSV is uploaded to S3.
+    This function reads the S3 object file containing the track-ids for the recently heard tracks and queries
+    Spotify to get the metadata about all those tracks. This metadata is compiled into a file as a table with
+    primary key being track-id. This file is uploaded to S3.
     :param listened_file_name: S3 file name containing track-ids of tracks recently listened to
     :param context:
     :return: S3 file name of tracks file containing track-metadata for tracks recently listened to
     """
-    # Read S3 Event to get the created csv file containing track-ids to query
-    listened_df = soundprintutils.download_df_from_s3_csv(listened_file_name, ListenerCommon.SCHEMA)
+    # Read S3 Event to get the created file containing track-ids to query
+    listened_df = soundprintutils.download_df_from_s3(listened_file_name, ListenerCommon.TYPED_SCHEMA)
 
     track_ids = list(set(listened_df[ListenerCommon.TRACK_ID[0]]))
 
+    # Bound the Retry-After of throttled Spotify requests by the time left in this invocation
+    spotifyscheduler.set_deadline(context)
+
     # Get Spotify access token and initialize Spotify client
-    access_token = soundprintutils.get_access_token()
-    spotify = tk.Spotify(access_token)
+    spotify = soundprintutils.get_spotify_client(soundprintutils.get_user_id_from_file_name(listened_file_name))
+
+    # Extract all data related to the recently heard tracks, querying Spotify only for tracks not cached
+    track_cache = entitycache.EntityCache('tracks', TrackerCommon.TYPED_SCHEMA, TrackerCommon.TRACK_ID,
+                                          TrackerCommon.VOLATILE_SCHEMA)
+    tracks_df = get_tracks_data(spotify, track_ids, track_cache)
+    spotifyscheduler.log_counters()
+    track_cache.save()
 
-    # Extract all data related to the recently heard tracks
-    tracks_df = get_tracks_data(spotify, track_ids)
+    # Index the audio-features of the tracks heard for the first time
+    feature_index = featureindex.AudioFeatureIndex()
+    feature_index.add(tracks_df)
+    feature_index.save()
 
-    # Upload dataframe to S3 as CSV
+    # Upload dataframe to S3
     tracks_file_name = f"{TrackerCommon.FILE_PATH_PREFIX}{listened_file_name.split(ListenerCommon.FILE_PATH_PREFIX)[1]}"
-    soundprintutils.upload_df_to_s3_csv(df=tracks_df, include_index=False, file_name=tracks_file_name)
+    soundprintutils.upload_df_to_s3(df=tracks_df, include_index=False, file_name=tracks_file_name,
+                                    typed_schema=TrackerCommon.TYPED_SCHEMA)
 
     return tracks_file_name
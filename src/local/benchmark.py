@@ -0,0 +1,316 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+from src.common import soundprintutils
+from src.common.listener import ListenerCommon
+from src.common.joiner import JoinerCommon
+from src.local.harness import FakeSpotify
+
+spotifylistener = importlib.import_module('src.lambda.spotifylistener')
+spotifytracker = importlib.import_module('src.lambda.spotifytracker')
+spotifyalbumer = importlib.import_module('src.lambda.spotifyalbumer')
+spotifyartister = importlib.import_module('src.lambda.spotifyartister')
+spotifyjoiner = importlib.import_module('src.lambda.spotifyjoiner')
+spotifyrdsarchiver = importlib.import_module('src.lambda.archiver.spotifyrdsarchiver')
+
+# Benchmarks of the per-stage hot paths on synthetic listening histories generated by the offline FakeSpotify.
+# Each benchmark is timed over a number of repeats, keeping the fastest, and then run once more under tracemalloc for
+# its peak memory of Python and NumPy allocations (Arrow's own allocations are not traced).
+# Results are written to a JSON file tagged with the git commit, and two results files can be compared:
+#   python -m src.local.benchmark run --sizes 1000 10000 100000
+#   python -m src.local.benchmark compare benchmark-results/<baseline>.json benchmark-results/<candidate>.json
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEATS = 3
+RESULTS_DIR = 'benchmark-results'
+
+# A benchmark whose wall time grows by more than this ratio over the baseline is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+class CatalogSpotify:
+    """
+    Spotify client serving pre-fetched entities from memory, so that benchmarks of the stages measure building their
+    rows rather than generating the entities
+    """
+    def __init__(self, spotify: FakeSpotify, track_ids: List[str]):
+        self.tracks_by_id = {track.id: track for track in spotify.tracks(track_ids)}
+        self.audio_features_by_id = {features.id: features for features in spotify.tracks_audio_features(track_ids)}
+
+        album_ids = list(dict.fromkeys(track.album.id for track in self.tracks_by_id.values()))
+        artist_ids = list(dict.fromkeys(artist.id for track in self.tracks_by_id.values() for artist in track.artists))
+        self.albums_by_id = {album.id: album for album in spotify.albums(album_ids)}
+        self.artists_by_id = {artist.id: artist for artist in spotify.artists(artist_ids)}
+
+    def tracks(self, track_ids: List[str], market: str = None) -> list:
+        return [self.tracks_by_id[track_id] for track_id in track_ids]
+
+    def tracks_audio_features(self, track_ids: List[str]) -> list:
+        return [self.audio_features_by_id[track_id] for track_id in track_ids]
+
+    def albums(self, album_ids: List[str], market: str = None) -> list:
+        return [self.albums_by_id[album_id] for album_id in album_ids]
+
+    def artists(self, artist_ids: List[str]) -> list:
+        return [self.artists_by_id[artist_id] for artist_id in artist_ids]
+
+
+def build_playback_df(spotify: FakeSpotify) -> pd.DataFrame:
+    """
+    Builds the listener's playback DataFrame (ListenerCommon.PLAYBACK_SCHEMA) for the whole listening history of the
+    fake Spotify directly, instead of paging through it
+    """
+    track_nums = pd.Series(spotify.played_track_nums)
+    track_ids = track_nums.map(lambda track_num: spotify.entity_id('t', track_num))
+    track_durations = {track_id: spotify.get_track_duration_ms(track_id) for track_id in track_ids.unique()}
+
+    return pd.DataFrame({
+        ListenerCommon.TIMESTAMP[0]: spotify.played_at_ms / 1000,
+        ListenerCommon.TRACK_ID[0]: track_ids,
+        ListenerCommon.TRACK_DURATION[0]: track_ids.map(track_durations).astype(np.int64),
+    }, columns=ListenerCommon.PLAYBACK_SCHEMA)
+
+
+def build_dataset(num_plays: int, seed: int = 0) -> SimpleNamespace:
+    """
+    Builds the synthetic dataset of the given number of plays: the playback history, the outputs of every stage for
+    it, and an in-memory Spotify client serving its entities
+    """
+    spotify = FakeSpotify(num_plays=num_plays, seed=seed, end_timestamp_ms=1609459200000 + num_plays * 60 * 1000)
+
+    playback_df = build_playback_df(spotify)
+    listening_df = spotifylistener.update_listened_to_durations(playback_df, spotify.end_timestamp_ms)
+    track_ids = list(listening_df[ListenerCommon.TRACK_ID[0]].unique())
+
+    catalog = CatalogSpotify(spotify, track_ids)
+    tracks_df = spotifytracker.get_tracks_data(catalog, track_ids)
+    albums_df = spotifyalbumer.get_albums_data(catalog, list(catalog.albums_by_id))
+    artists_df = spotifyartister.get_artists_data(catalog, list(catalog.artists_by_id))
+    joined_df = spotifyjoiner.join_dataframes(listening_df, tracks_df, albums_df, artists_df)
+
+    return SimpleNamespace(num_plays=num_plays, spotify=spotify, catalog=catalog, track_ids=track_ids,
+                           playback_df=playback_df, listening_df=listening_df, tracks_df=tracks_df,
+                           albums_df=albums_df, artists_df=artists_df, joined_df=joined_df)
+
+
+def bench_listened_durations(dataset: SimpleNamespace):
+    spotifylistener.update_listened_to_durations(dataset.playback_df, dataset.spotify.end_timestamp_ms)
+
+
+def bench_track_rows(dataset: SimpleNamespace):
+    spotifytracker.get_tracks_data(dataset.catalog, dataset.track_ids)
+
+
+def bench_album_rows(dataset: SimpleNamespace):
+    spotifyalbumer.fetch_albums_data(dataset.catalog, list(dataset.catalog.albums_by_id))
+
+
+def bench_artist_rows(dataset: SimpleNamespace):
+    spotifyartister.fetch_artists_data(dataset.catalog, list(dataset.catalog.artists_by_id))
+
+
+def bench_join(dataset: SimpleNamespace):
+    spotifyjoiner.join_dataframes(dataset.listening_df, dataset.tracks_df, dataset.albums_df, dataset.artists_df)
+
+
+def bench_join_compact(dataset: SimpleNamespace):
+    spotifyjoiner.join_compact_dataframes(dataset.listening_df, dataset.tracks_df, dataset.albums_df,
+                                          dataset.artists_df)
+
+
+def bench_insert_parameters(dataset: SimpleNamespace):
+    sql_parameter_sets = spotifyrdsarchiver.build_sql_parameter_sets(dataset.joined_df, JoinerCommon.TYPED_SCHEMA)
+    spotifyrdsarchiver.split_sql_parameter_sets(sql_parameter_sets)
+
+
+def bench_parquet_round_trip(dataset: SimpleNamespace):
+    body = soundprintutils.serialize_df_parquet(dataset.joined_df, False, JoinerCommon.TYPED_SCHEMA)
+    soundprintutils.deserialize_df_parquet(body, JoinerCommon.TYPED_SCHEMA)
+
+
+def bench_csv_round_trip(dataset: SimpleNamespace):
+    body = soundprintutils.serialize_df_csv(dataset.joined_df, False, JoinerCommon.TYPED_SCHEMA)
+    soundprintutils.deserialize_df_csv(body, JoinerCommon.TYPED_SCHEMA)
+
+
+# Benchmark name -> (benchmark function, maximum number of plays it is run for, None if unlimited).
+# Building the parameter-sets of every joined row holds a dict per field of every row in memory, so it is bounded.
+BENCHMARKS: Dict[str, tuple] = {
+    'listened_durations': (bench_listened_durations, None),
+    'track_rows': (bench_track_rows, None),
+    'album_rows': (bench_album_rows, None),
+    'artist_rows': (bench_artist_rows, None),
+    'join': (bench_join, None),
+    'join_compact': (bench_join_compact, None),
+    'insert_parameters': (bench_insert_parameters, 10000),
+    'parquet_round_trip': (bench_parquet_round_trip, None),
+    'csv_round_trip': (bench_csv_round_trip, None),
+}
+
+
+def measure(benchmark_function: Callable, dataset: SimpleNamespace, repeats: int) -> dict:
+    """
+    Returns the fastest wall time of the benchmark over the repeats, and its peak traced memory over one more run
+    """
+    wall_secs = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        benchmark_function(dataset)
+        wall_secs.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        benchmark_function(dataset)
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'wall_secs': min(wall_secs), 'peak_memory_bytes': peak_memory_bytes}
+
+
+def get_git_commit() -> dict:
+    """
+    Returns the current git commit and whether the working tree has uncommitted changes, or None if not in a git repo
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit.strip(), 'dirty': len(status.strip()) > 0}
+
+
+def run_benchmarks(sizes: List[int], benchmark_names: List[str], repeats: int = DEFAULT_REPEATS,
+                   seed: int = 0) -> dict:
+    """
+    Runs the named benchmarks on the synthetic dataset of each size, and returns the results along with the git commit
+    and environment they were measured in
+    """
+    results = []
+    for num_plays in sizes:
+        start = time.perf_counter()
+        dataset = build_dataset(num_plays, seed)
+        print(f"Built dataset of {num_plays} plays ({dataset.joined_df.shape[0]} joined rows) in "
+              f"{time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+        for benchmark_name in benchmark_names:
+            benchmark_function, max_plays = BENCHMARKS[benchmark_name]
+            if max_plays is not None and num_plays > max_plays:
+                print(f"Skipping {benchmark_name} for {num_plays} plays (limit {max_plays})", file=sys.stderr)
+                continue
+
+            result = {'benchmark': benchmark_name, 'plays': num_plays, 'joined_rows': dataset.joined_df.shape[0],
+                      'repeats': repeats}
+            result.update(measure(benchmark_function, dataset, repeats))
+            results.append(result)
+            print(f"{benchmark_name:>20} {num_plays:>9} plays: {result['wall_secs']:10.4f}s "
+                  f"{result['peak_memory_bytes'] / 2**20:10.1f} MiB", file=sys.stderr)
+
+    run_info = get_git_commit()
+    run_info.update({
+        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'seed': seed,
+        'results': results,
+    })
+    return run_info
+
+
+def compare_results(baseline: dict, candidate: dict, threshold: float = REGRESSION_THRESHOLD) -> List[dict]:
+    """
+    Compares the results of the benchmarks measured in both runs, by benchmark and size.
+    :return: A comparison for each benchmark and size, with the ratios of candidate to baseline wall time and peak
+    memory, and whether the wall time regressed by more than the threshold
+    """
+    baseline_results = {(result['benchmark'], result['plays']): result for result in baseline['results']}
+
+    comparisons = []
+    for result in candidate['results']:
+        baseline_result = baseline_results.get((result['benchmark'], result['plays']))
+        if baseline_result is None:
+            continue
+        wall_ratio = result['wall_secs'] / max(baseline_result['wall_secs'], 1e-9)
+        memory_ratio = result['peak_memory_bytes'] / max(baseline_result['peak_memory_bytes'], 1)
+        comparisons.append({'benchmark': result['benchmark'], 'plays': result['plays'],
+                            'baseline_wall_secs': baseline_result['wall_secs'], 'wall_secs': result['wall_secs'],
+                            'wall_ratio': wall_ratio, 'memory_ratio': memory_ratio,
+                            'regressed': wall_ratio > threshold})
+    return comparisons
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks the per-stage hot paths of the Soundprint pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and write the results to a JSON file')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of plays')
+    run_parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    run_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help=f"Results file, defaults to {RESULTS_DIR}/<commit>.json")
+    run_parser.add_argument('--baseline', help='Results file to compare the results against')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                               help='Wall time ratio over the baseline above which a benchmark has regressed')
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.command == 'run':
+        candidate = run_benchmarks(parsed_args.sizes, parsed_args.benchmarks, parsed_args.repeats, parsed_args.seed)
+        output = parsed_args.output
+        if output is None:
+            commit_name = (candidate['commit'] or 'unversioned')[:12] + ('-dirty' if candidate['dirty'] else '')
+            output = os.path.join(RESULTS_DIR, f"{commit_name}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as results_file:
+            json.dump(candidate, results_file, indent=2)
+        print(f"Wrote results to {output}", file=sys.stderr)
+
+        if parsed_args.baseline is None:
+            return 0
+        with open(parsed_args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    else:
+        with open(parsed_args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(parsed_args.candidate) as candidate_file:
+            candidate = json.load(candidate_file)
+
+    comparisons = compare_results(baseline, candidate, parsed_args.threshold)
+    print(f"{'benchmark':>20} {'plays':>9} {'baseline':>10} {'candidate':>10} {'time':>7} {'memory':>7}")
+    for comparison in comparisons:
+        print(f"{comparison['benchmark']:>20} {comparison['plays']:>9} {comparison['baseline_wall_secs']:9.4f}s "
+              f"{comparison['wall_secs']:9.4f}s {comparison['wall_ratio']:6.2f}x {comparison['memory_ratio']:6.2f}x"
+              f"{'  REGRESSED' if comparison['regressed'] else ''}")
+
+    return 1 if any(comparison['regressed'] for comparison in comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+from typing import Dict
+from typing import List
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from src.local.benchmark import get_git_commit
+
+# Report of the cold-start import cost of the handler of each function of the SAM template. Each handler's module is
+# imported in a fresh interpreter with -X importtime, as on the cold start of its Lambda, over a number of repeats,
+# keeping the fastest. The report holds the import time of the handler and the wall time of the whole process, along
+# with the import time of each module, summed into the packages with the largest share:
+#   python -m src.local.coldstart
+#   python -m src.local.coldstart --handlers SoundprintStatsApi --top 15 --output coldstart.json
+
+TEMPLATE_FILE = 'template.yml'
+DEFAULT_REPEATS = 3
+DEFAULT_TOP = 8
+
+RESOURCE_REGEX = re.compile(r"^  (\w+):\s*$")
+HANDLER_REGEX = re.compile(r"^\s+Handler:\s*([\w.]+)\s*$")
+IMPORT_TIME_REGEX = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)\s*$")
+
+IMPORT_SCRIPT = '''
+import sys, json, time, importlib
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'import_secs': time.perf_counter() - start}))
+'''
+
+
+def get_handlers(template_file: str = TEMPLATE_FILE) -> Dict[str, str]:
+    """
+    Returns the map of the logical name of each function of the SAM template to its handler, e.g.
+    SoundprintSpotifyListener -> src.lambda.spotifylistener.lambda_handler
+    """
+    handlers = {}
+    resource_name = None
+    with open(template_file) as template:
+        for line in template:
+            resource_match = RESOURCE_REGEX.match(line)
+            if resource_match is not None:
+                resource_name = resource_match.group(1)
+            handler_match = HANDLER_REGEX.match(line)
+            if handler_match is not None and resource_name is not None:
+                handlers[resource_name] = handler_match.group(1)
+    return handlers
+
+
+def parse_import_times(import_time_output: str) -> List[dict]:
+    """
+    Parses the -X importtime output of an interpreter into a record per imported module, with its own import time,
+    its import time including the modules it imported, and its depth in the import tree
+    """
+    import_times = []
+    for line in import_time_output.splitlines():
+        match = IMPORT_TIME_REGEX.match(line)
+        if match is not None:
+            import_times.append({'module': match.group(4), 'self_secs': int(match.group(1)) / 1e6,
+                                 'cumulative_secs': int(match.group(2)) / 1e6, 'depth': len(match.group(3)) // 2})
+    return import_times
+
+
+def measure_cold_start(module_name: str) -> dict:
+    """
+    Imports a module in a fresh interpreter and returns the import time of the module, the wall time of the process
+    and the import time of every module imported along with it
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT, module_name],
+                               capture_output=True, text=True, check=True)
+    process_secs = time.perf_counter() - start
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['process_secs'] = process_secs
+    result['modules'] = parse_import_times(completed.stderr)
+    return result
+
+
+def summarize_packages(modules: List[dict], top: int) -> List[dict]:
+    """
+    Sums the own import time of the modules of each top-level package, and returns the top packages by import time
+    """
+    package_secs = defaultdict(float)
+    for module in modules:
+        package_secs[module['module'].split('.')[0]] += module['self_secs']
+    packages = sorted(package_secs.items(), key=lambda package: package[1], reverse=True)[:top]
+    return [{'package': package, 'import_secs': import_secs} for package, import_secs in packages]
+
+
+def run_report(handler_names: List[str], repeats: int = DEFAULT_REPEATS, top: int = DEFAULT_TOP,
+               template_file: str = TEMPLATE_FILE) -> dict:
+    """
+    Measures the cold-start imports of the named functions' handlers, and returns the results along with the git
+    commit and the environment they were measured in
+    """
+    handlers = get_handlers(template_file)
+    results = []
+    for handler_name in handler_names:
+        module_name = handlers[handler_name].rsplit('.', 1)[0]
+        measurements = [measure_cold_start(module_name) for _ in range(repeats)]
+        fastest = min(measurements, key=lambda measurement: measurement['import_secs'])
+
+        result = {'function': handler_name, 'handler': handlers[handler_name], 'repeats': repeats,
+                  'import_secs': fastest['import_secs'], 'process_secs': fastest['process_secs'],
+                  'modules_imported': len(fastest['modules']),
+                  'packages': summarize_packages(fastest['modules'], top)}
+        results.append(result)
+        packages = ', '.join(f"{package['package']} {package['import_secs']:.3f}s" for package in result['packages'])
+        print(f"{handler_name:>32}: import {result['import_secs']:.3f}s, process {result['process_secs']:.3f}s "
+              f"({packages})", file=sys.stderr)
+
+    run_info = get_git_commit()
+    run_info.update({
+        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    })
+    return run_info
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Reports the cold-start import time of the Soundprint handlers')
+    parser.add_argument('--handlers', nargs='+', help='Logical names of the functions, defaults to all of them')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help='Number of packages reported per handler')
+    parser.add_argument('--template', default=TEMPLATE_FILE)
+    parser.add_argument('--output', help='Results file to write the report to')
+    parsed_args = parser.parse_args(args)
+
+    handler_names = parsed_args.handlers or list(get_handlers(parsed_args.template))
+    report = run_report(handler_names, parsed_args.repeats, parsed_args.top, parsed_args.template)
+    if parsed_args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(parsed_args.output)), exist_ok=True)
+        with open(parsed_args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"Wrote report to {parsed_args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
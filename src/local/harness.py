@@ -0,0 +1,715 @@
+from typing import Dict
+from typing import List
+
+import os
+import io
+import math
+import re
+import time
+import random
+import sqlite3
+import importlib
+import tempfile
+import threading
+import unittest
+import contextlib
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import boto3
+import tekore as tk
+from botocore.exceptions import ClientError
+
+from src.common import awsclients
+from src.common import soundprintutils
+from src.common import spotifyscheduler
+from src.common import rollups
+
+# Offline stand-ins for S3, the DynamoDB token store, the RDS Data API and the Spotify Web API, so that the stages and
+# the fused pipeline can be run and measured without AWS or Spotify. See OfflineEnvironment.
+
+# Refresh tokens of the offline accounts are OFFLINE_REFRESH_TOKEN suffixed with /<user-id> for users other than the
+# original account, and are refreshed into access tokens with the same suffix
+OFFLINE_REFRESH_TOKEN = 'offline-refresh-token'
+OFFLINE_ACCESS_TOKEN = 'offline-access-token'
+OFFLINE_DB_SECRET_ARN = 'arn:aws:secretsmanager:offline:000000000000:secret:soundprint-db-secret'
+OFFLINE_AURORA_CLUSTER_ARN = 'arn:aws:rds:offline:000000000000:cluster:soundprint'
+
+GENRES = ['ambient', 'blues', 'classical', 'country', 'dance pop', 'disco', 'drum and bass', 'dub', 'electro',
+          'folk', 'funk', 'garage rock', 'gospel', 'grunge', 'hip hop', 'house', 'indie pop', 'indie rock', 'jazz',
+          'k-pop', 'latin', 'lo-fi', 'metal', 'new wave', 'opera', 'pop', 'pop punk', 'post-rock', 'psychedelic rock',
+          'punk', 'r&b', 'reggae', 'rock', 'shoegaze', 'soul', 'synthpop', 'techno', 'trance', 'trap', 'trip hop']
+LABELS = ['Offline Records', 'Sample Sounds', 'Fixture Music', 'Local Label', 'Stand-in Recordings']
+ALBUM_TYPES = ['album', 'single', 'compilation']
+
+
+def client_error(code: str, message: str, operation_name: str) -> ClientError:
+    """
+    Returns a botocore ClientError with the given error code, as raised by the AWS service clients
+    """
+    return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}},
+                       operation_name)
+
+
+class FakeS3Client:
+    """
+    S3 client storing the objects of each bucket as files under a directory on the local file-system
+    """
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.request_counts = Counter()
+
+    def get_file_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root_dir, bucket, *key.split('/'))
+
+    def write_object(self, bucket: str, key: str, body: bytes):
+        file_path = self.get_file_path(bucket, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as object_file:
+            object_file.write(body)
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs) -> dict:
+        self.request_counts['put_object'] += 1
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif not isinstance(Body, (bytes, bytearray)):
+            Body = Body.read()
+
+        self.write_object(Bucket, Key, Body)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs: dict = None, Callback=None,
+                       Config=None):
+        """
+        Stores the contents of a file-object, counting the requests of a multipart upload if they are larger than the
+        transfer config's multipart threshold, as the managed transfer of the boto3 client does
+        """
+        body = Fileobj.read()
+        if Config is not None and len(body) >= Config.multipart_threshold:
+            self.request_counts['create_multipart_upload'] += 1
+            self.request_counts['upload_part'] += max(1, math.ceil(len(body) / Config.multipart_chunksize))
+            self.request_counts['complete_multipart_upload'] += 1
+        else:
+            self.request_counts['put_object'] += 1
+        self.write_object(Bucket, Key, body)
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self.request_counts['get_object'] += 1
+        file_path = self.get_file_path(Bucket, Key)
+        if not os.path.isfile(file_path):
+            raise client_error('NoSuchKey', 'The specified key does not exist.', 'GetObject')
+        with open(file_path, 'rb') as object_file:
+            body = object_file.read()
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', **kwargs) -> dict:
+        self.request_counts['list_objects_v2'] += 1
+        bucket_dir = os.path.join(self.root_dir, Bucket)
+        contents = []
+        for dir_path, _, file_names in os.walk(bucket_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(file_path, bucket_dir).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    contents.append({'Key': key, 'Size': os.path.getsize(file_path)})
+        contents.sort(key=lambda content: content['Key'])
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False,
+                'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+class FakeDynamoDBTable:
+    """
+    In-memory DynamoDB table of the boto3 resource API, keyed by the values of the key attributes of its items.
+    Supports SET and ADD update expressions, condition expressions made of attribute_exists/attribute_not_exists
+    functions and comparisons joined by AND/OR, without parentheses, and queries by partition key with an optional
+    BETWEEN condition on the sort key, without pagination.
+    """
+    CONDITION_TERM_REGEX = re.compile(r"^(\w+)\s*(<=|>=|<>|=|<|>)\s*(:\w+)$")
+    KEY_CONDITION_REGEX = re.compile(r"^(\w+)\s*=\s*(:\w+)(?:\s+AND\s+(\w+)\s+BETWEEN\s+(:\w+)\s+AND\s+(:\w+))?$")
+
+    def __init__(self, name: str, key_attributes: List[str]):
+        self.name = name
+        self.key_attributes = key_attributes
+        self.items = {}
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+
+    def get_item_key(self, key: dict) -> tuple:
+        return tuple(key[attribute] for attribute in self.key_attributes)
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['get_item'] += 1
+            item = self.items.get(self.get_item_key(Key))
+            return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item: dict, ConditionExpression: str = None, ExpressionAttributeValues: dict = None,
+                 **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['put_item'] += 1
+            item_key = self.get_item_key(Item)
+            self.check_condition(self.items.get(item_key), ConditionExpression, ExpressionAttributeValues)
+            self.items[item_key] = dict(Item)
+            return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ConditionExpression: str = None,
+                    ExpressionAttributeValues: dict = None, **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['update_item'] += 1
+            item_key = self.get_item_key(Key)
+            item = self.items.get(item_key)
+            self.check_condition(item, ConditionExpression, ExpressionAttributeValues)
+
+            item = dict(item) if item is not None else dict(Key)
+            for action, assignments in re.findall(r"(SET|ADD)\s+(.*?)(?=\s+(?:SET|ADD)\s+|$)", UpdateExpression):
+                for assignment in assignments.split(','):
+                    if action == 'SET':
+                        attribute, value_name = map(str.strip, assignment.split('='))
+                        item[attribute] = ExpressionAttributeValues[value_name]
+                    else:
+                        attribute, value_name = assignment.split()
+                        item[attribute] = item.get(attribute, 0) + ExpressionAttributeValues[value_name]
+            self.items[item_key] = item
+            return {'Attributes': dict(item), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def query(self, KeyConditionExpression: str, ExpressionAttributeValues: dict, **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['query'] += 1
+            key_condition_match = self.KEY_CONDITION_REGEX.match(KeyConditionExpression.strip())
+            if key_condition_match is None:
+                raise ValueError(f"Unsupported key condition expression: {KeyConditionExpression}")
+            partition_attribute, partition_value_name, sort_attribute, start_value_name, end_value_name = \
+                key_condition_match.groups()
+
+            items = [dict(item) for item in self.items.values()
+                     if item[partition_attribute] == ExpressionAttributeValues[partition_value_name]]
+            if sort_attribute is not None:
+                items = [item for item in items if ExpressionAttributeValues[start_value_name] <= item[sort_attribute]
+                         <= ExpressionAttributeValues[end_value_name]]
+            if len(self.key_attributes) > 1:
+                items.sort(key=lambda item: item[self.key_attributes[1]])
+            return {'Items': items, 'Count': len(items), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def check_condition(self, item: dict, condition_expression: str, expression_values: dict):
+        """
+        Raises ConditionalCheckFailedException if the item does not satisfy the condition expression
+        """
+        if condition_expression is None:
+            return
+        if item is None:
+            item = {}
+
+        satisfied = any(
+            all(self.evaluate_condition_term(item, term.strip(), expression_values) for term in or_term.split(' AND '))
+            for or_term in condition_expression.split(' OR ')
+        )
+        if not satisfied:
+            raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'UpdateItem')
+
+    def evaluate_condition_term(self, item: dict, term: str, expression_values: dict) -> bool:
+        function_match = re.match(r"^(attribute_exists|attribute_not_exists)\((\w+)\)$", term)
+        if function_match is not None:
+            return (function_match.group(2) in item) == (function_match.group(1) == 'attribute_exists')
+
+        comparison_match = self.CONDITION_TERM_REGEX.match(term)
+        if comparison_match is None:
+            raise ValueError(f"Unsupported condition expression term: {term}")
+        attribute, operator, value_name = comparison_match.groups()
+        if attribute not in item:
+            return False
+        item_value = item[attribute]
+        value = expression_values[value_name]
+        return {
+            '<': item_value < value, '<=': item_value <= value, '>': item_value > value, '>=': item_value >= value,
+            '=': item_value == value, '<>': item_value != value,
+        }[operator]
+
+
+class FakeDynamoDBResource:
+    """
+    DynamoDB resource holding in-memory tables. The token state table is created with the stored Spotify credentials
+    and an expired access token, so that the first stage to run refreshes it, along with an empty rollups table.
+    """
+    def __init__(self):
+        self.tables = {}
+        token_table = self.create_table(soundprintutils.TOKEN_STATE_TABLE, ['spotify'])
+        self.create_table(soundprintutils.ROLLUPS_TABLE, [rollups.ROLLUP_DDB_KEY, rollups.BUCKET_DDB_KEY])
+
+        credentials_item = {
+            soundprintutils.CLIENT_ID_DDB_KEY: 'offline-client-id',
+            soundprintutils.CLIENT_SECRET_DDB_KEY: 'offline-client-secret',
+            soundprintutils.REFRESH_TOKEN_DDB_KEY: OFFLINE_REFRESH_TOKEN,
+        }
+        credentials_item.update(soundprintutils.DDB_CREDENTIALS_ITEM_KEY)
+        token_table.put_item(Item=credentials_item)
+
+        token_item = {soundprintutils.ACCESS_TOKEN_DDB_KEY: 'expired-access-token',
+                      soundprintutils.EXPIRES_AT_DDB_KEY: 0}
+        token_item.update(soundprintutils.DDB_TOKEN_ITEM_KEY)
+        token_table.put_item(Item=token_item)
+
+    def add_user(self, user_id: str):
+        """
+        Registers a listener other than the original account, with credentials but without an access token yet
+        """
+        token_table = self.tables[soundprintutils.TOKEN_STATE_TABLE]
+
+        credentials_item = {soundprintutils.REFRESH_TOKEN_DDB_KEY: f"{OFFLINE_REFRESH_TOKEN}/{user_id}"}
+        credentials_item.update(soundprintutils.get_credentials_item_key(user_id))
+        token_table.put_item(Item=credentials_item)
+
+        users_item = token_table.get_item(Key=soundprintutils.DDB_USERS_ITEM_KEY).get('Item', {})
+        users_item.update(soundprintutils.DDB_USERS_ITEM_KEY)
+        users_item[soundprintutils.USER_IDS_DDB_KEY] = users_item.get(soundprintutils.USER_IDS_DDB_KEY, []) + [user_id]
+        token_table.put_item(Item=users_item)
+
+    def create_table(self, name: str, key_attributes: List[str]) -> FakeDynamoDBTable:
+        self.tables[name] = FakeDynamoDBTable(name, key_attributes)
+        return self.tables[name]
+
+    def Table(self, name: str) -> FakeDynamoDBTable:
+        if name not in self.tables:
+            raise client_error('ResourceNotFoundException', f"Requested resource not found: {name}", 'DescribeTable')
+        return self.tables[name]
+
+
+class FakeRdsDataClient:
+    """
+    RDS Data API client executing statements on a SQLite database. The MySQL dialect used by the archiver is
+    translated to SQLite: SHOW TABLES, INDEX clauses of CREATE TABLE, and INSERT ... ON DUPLICATE KEY UPDATE.
+    The cluster can be paused, as an Aurora serverless cluster is when idle (see pause).
+    """
+    INDEX_CLAUSE_REGEX = re.compile(r",\s*INDEX\s+(\w+)\s*\(([^)]*)\)", re.IGNORECASE)
+    CREATE_TABLE_REGEX = re.compile(r"CREATE TABLE IF NOT EXISTS\s+(\w+)", re.IGNORECASE)
+    INSERT_TABLE_REGEX = re.compile(r"INSERT INTO\s+(\w+)", re.IGNORECASE)
+    ON_DUPLICATE_KEY_REGEX = re.compile(r"\s+ON DUPLICATE KEY UPDATE\s+(.*)$", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, database_path: str = ':memory:'):
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+        self.paused = False
+        self.resume_secs = 0.0
+        self.resumed_at = None
+
+    def pause(self, resume_secs: float):
+        """
+        Pauses the cluster. The first request to the paused cluster starts resuming it, and every request fails with
+        a communications link failure until resume_secs after that request.
+        """
+        with self.lock:
+            self.paused = True
+            self.resume_secs = resume_secs
+            self.resumed_at = None
+
+    def check_resumed(self, operation_name: str):
+        if not self.paused:
+            return
+        now = time.monotonic()
+        if self.resumed_at is None:
+            self.resumed_at = now + self.resume_secs
+        if now < self.resumed_at:
+            self.request_counts['communications_link_failure'] += 1
+            raise client_error('BadRequestException', 'Communications link failure', operation_name)
+        self.paused = False
+
+    def translate_sql(self, sql: str) -> List[str]:
+        """
+        Translates a MySQL statement into the equivalent SQLite statements
+        """
+        if sql.strip().lower() == 'show tables':
+            return ["SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"]
+
+        create_match = self.CREATE_TABLE_REGEX.match(sql.strip())
+        if create_match is not None:
+            table_name = create_match.group(1)
+            # Index names are unique per database in SQLite but per table in MySQL, so they are prefixed by the table
+            index_statements = [f"CREATE INDEX IF NOT EXISTS {table_name}_{index_name} "
+                                f"ON {table_name} ({index_columns})"
+                                for index_name, index_columns in self.INDEX_CLAUSE_REGEX.findall(sql)]
+            return [self.INDEX_CLAUSE_REGEX.sub('', sql)] + index_statements
+
+        duplicate_key_match = self.ON_DUPLICATE_KEY_REGEX.search(sql)
+        if duplicate_key_match is not None:
+            table_name = self.INSERT_TABLE_REGEX.search(sql).group(1)
+            primary_key_columns = [row[1] for row in sorted(
+                self.connection.execute(f"PRAGMA table_info({table_name})").fetchall(), key=lambda row: row[5])
+                if row[5] > 0]
+            update_str = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", duplicate_key_match.group(1))
+            return [f"{sql[:duplicate_key_match.start()]} "
+                    f"ON CONFLICT ({', '.join(primary_key_columns)}) DO UPDATE SET {update_str}"]
+
+        return [sql]
+
+    @staticmethod
+    def parameters_to_dict(sql_parameters: List[dict]) -> dict:
+        parameters = {}
+        for sql_parameter in sql_parameters or []:
+            value_type, value = next(iter(sql_parameter['value'].items()))
+            parameters[sql_parameter['name']] = None if value_type == 'isNull' else value
+        return parameters
+
+    @staticmethod
+    def value_to_field(value) -> dict:
+        if value is None:
+            return {'isNull': True}
+        elif isinstance(value, int):
+            return {'longValue': value}
+        elif isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def execute_statements(self, sql: str, parameter_sets: List[dict]) -> sqlite3.Cursor:
+        statements = self.translate_sql(sql)
+        try:
+            with self.connection:
+                if len(parameter_sets) == 1:
+                    cursor = self.connection.execute(statements[0], parameter_sets[0])
+                else:
+                    cursor = self.connection.executemany(statements[0], parameter_sets)
+                for statement in statements[1:]:
+                    self.connection.execute(statement)
+                return cursor
+        except sqlite3.Error as sqle:
+            raise client_error('BadRequestException', f"{type(sqle).__name__}: {sqle}", 'ExecuteStatement')
+
+    def execute_statement(self, sql: str, parameters: List[dict] = None, **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['execute_statement'] += 1
+            self.check_resumed('ExecuteStatement')
+            cursor = self.execute_statements(sql, [self.parameters_to_dict(parameters)])
+            response = {'numberOfRecordsUpdated': max(cursor.rowcount, 0), 'generatedFields': [],
+                        'ResponseMetadata': {'HTTPStatusCode': 200}}
+            if cursor.description is not None:
+                response['records'] = [list(map(self.value_to_field, row)) for row in cursor.fetchall()]
+            return response
+
+    def batch_execute_statement(self, sql: str, parameterSets: List[List[dict]] = None, **kwargs) -> dict:
+        with self.lock:
+            self.request_counts['batch_execute_statement'] += 1
+            self.check_resumed('BatchExecuteStatement')
+            parameter_sets = [self.parameters_to_dict(parameter_set) for parameter_set in parameterSets or [[]]]
+            self.execute_statements(sql, parameter_sets)
+            return {'updateResults': [{'generatedFields': []} for _ in parameter_sets],
+                    'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def query(self, sql: str) -> List[tuple]:
+        """
+        Returns the rows of a SQLite query, for inspecting the archived tables
+        """
+        with self.lock:
+            return self.connection.execute(sql).fetchall()
+
+
+class FakeSpotify:
+    """
+    Deterministic stand-in for tk.Spotify serving a generated listening history and the metadata of its tracks, albums
+    and artists. Plays are spread over the time up to end_timestamp_ms, 30 seconds to 6 minutes apart, with tracks
+    drawn so that some are played much more often than others. The attributes of each entity are generated from its
+    id and the catalog seed, so only the entities that are queried are ever generated, and fake clients of different
+    listeners with the same catalog seed and size agree on the metadata of the entities they share.
+    """
+    def __init__(self, num_plays: int = 100, num_tracks: int = None, num_albums: int = None, num_artists: int = None,
+                 end_timestamp_ms: int = None, seed: int = 0, latency_secs: float = 0.0, catalog_seed: int = 0,
+                 throttle_every: int = 0, retry_after_secs: float = 0.0):
+        """
+        :param num_plays: Number of plays in the listening history
+        :param num_tracks: Number of distinct tracks in the catalog, defaults to a quarter of the plays
+        :param num_albums: Number of distinct albums in the catalog, defaults to a fifth of the tracks
+        :param num_artists: Number of distinct artists in the catalog, defaults to a quarter of the tracks
+        :param end_timestamp_ms: Epoch time in milliseconds of the last play, defaults to the current time
+        :param seed: Seed of the generated listening history
+        :param latency_secs: Time every request takes, to simulate the round trip to Spotify
+        :param catalog_seed: Seed of the generated tracks, albums and artists
+        :param throttle_every: If positive, every throttle_every-th request is throttled, failing with HTTP 429 and
+        a Retry-After of retry_after_secs, as Spotify does when its rate-limit is hit
+        """
+        self.num_tracks = num_tracks if num_tracks is not None else max(1, num_plays // 4)
+        self.num_albums = num_albums if num_albums is not None else max(1, self.num_tracks // 5)
+        self.num_artists = num_artists if num_artists is not None else max(1, self.num_tracks // 4)
+        self.catalog_seed = catalog_seed
+        self.latency_secs = latency_secs
+        self.throttle_every = throttle_every
+        self.retry_after_secs = retry_after_secs
+        self.num_requests = 0
+        self.request_counts = Counter()
+        self.request_counts_lock = threading.Lock()
+
+        if end_timestamp_ms is None:
+            end_timestamp_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
+        rng = np.random.default_rng(seed)
+        gaps_ms = rng.integers(30 * 1000, 6 * 60 * 1000, num_plays)
+        self.played_at_ms = end_timestamp_ms - (np.cumsum(gaps_ms[::-1])[::-1] - gaps_ms)
+        self.played_track_nums = (self.num_tracks * rng.random(num_plays) ** 2).astype(np.int64)
+
+    @property
+    def start_timestamp_ms(self) -> int:
+        return int(self.played_at_ms[0]) if len(self.played_at_ms) > 0 else 0
+
+    @property
+    def end_timestamp_ms(self) -> int:
+        return int(self.played_at_ms[-1]) if len(self.played_at_ms) > 0 else 0
+
+    @staticmethod
+    def entity_id(kind: str, entity_num: int) -> str:
+        return f"{kind}{entity_num:021d}"
+
+    @staticmethod
+    def entity_num(entity_id: str) -> int:
+        return int(entity_id[1:])
+
+    def entity_random(self, entity_id: str) -> random.Random:
+        return random.Random(f"{self.catalog_seed}-{entity_id}")
+
+    def record_request(self, method_name: str):
+        with self.request_counts_lock:
+            self.num_requests += 1
+            is_throttled = self.throttle_every > 0 and self.num_requests % self.throttle_every == 0
+            self.request_counts['throttled' if is_throttled else method_name] += 1
+        if self.latency_secs > 0:
+            time.sleep(self.latency_secs)
+        if is_throttled:
+            response = tk.Response(url=f"https://api.spotify.com/v1/{method_name}",
+                                   headers={'Retry-After': str(self.retry_after_secs)}, status_code=429, content=None)
+            raise tk.TooManyRequests('Error in API call - API rate limit exceeded', request=None, response=response)
+
+    def get_track_album_num(self, track_num: int) -> int:
+        return track_num % self.num_albums
+
+    def get_track_artist_nums(self, track_id: str) -> List[int]:
+        rng = self.entity_random(track_id)
+        artist_nums = [self.entity_num(track_id) % self.num_artists]
+        artist_nums += [rng.randrange(self.num_artists) for _ in range(rng.choice([0, 0, 0, 1, 2]))]
+        return list(dict.fromkeys(artist_nums))
+
+    def get_track_duration_ms(self, track_id: str) -> int:
+        return self.entity_random(f"{track_id}-duration").randint(90 * 1000, 7 * 60 * 1000)
+
+    def playback_recently_played(self, limit: int = 20, after: int = None, before: int = None):
+        """
+        Returns the page of at most limit plays after the given timestamp, most recent first, like Spotify does
+        """
+        self.record_request('playback_recently_played')
+        if after is not None:
+            start = int(np.searchsorted(self.played_at_ms, after, side='right'))
+            end = min(start + limit, len(self.played_at_ms))
+        else:
+            end = int(np.searchsorted(self.played_at_ms, before, side='left')) if before is not None \
+                else len(self.played_at_ms)
+            start = max(end - limit, 0)
+
+        items = []
+        for play_num in reversed(range(start, end)):
+            track_id = self.entity_id('t', int(self.played_track_nums[play_num]))
+            played_at = datetime.fromtimestamp(int(self.played_at_ms[play_num]) / 1000, tz=timezone.utc)
+            items.append(SimpleNamespace(
+                played_at=played_at.replace(tzinfo=None),
+                track=SimpleNamespace(id=track_id, duration_ms=self.get_track_duration_ms(track_id)),
+            ))
+
+        cursors = None
+        if len(items) > 0:
+            cursors = SimpleNamespace(after=str(int(self.played_at_ms[end - 1])),
+                                      before=str(int(self.played_at_ms[start])))
+        return SimpleNamespace(items=items, cursors=cursors, limit=limit)
+
+    def get_track(self, track_id: str) -> SimpleNamespace:
+        rng = self.entity_random(track_id)
+        album_id = self.entity_id('a', self.get_track_album_num(self.entity_num(track_id)))
+        return SimpleNamespace(
+            id=track_id,
+            name=f"Track {self.entity_num(track_id)}",
+            duration_ms=self.get_track_duration_ms(track_id),
+            album=SimpleNamespace(id=album_id),
+            artists=[SimpleNamespace(id=self.entity_id('r', artist_num))
+                     for artist_num in self.get_track_artist_nums(track_id)],
+            popularity=rng.randint(0, 100),
+            explicit=rng.random() < 0.2,
+        )
+
+    def track(self, track_id: str, market: str = None) -> SimpleNamespace:
+        self.record_request('track')
+        return self.get_track(track_id)
+
+    def tracks(self, track_ids: List[str], market: str = None) -> List[SimpleNamespace]:
+        self.record_request('tracks')
+        return [self.get_track(track_id) for track_id in track_ids]
+
+    def tracks_audio_features(self, track_ids: List[str]) -> List[SimpleNamespace]:
+        self.record_request('tracks_audio_features')
+        audio_features = []
+        for track_id in track_ids:
+            rng = self.entity_random(f"{track_id}-features")
+            audio_features.append(SimpleNamespace(
+                id=track_id,
+                acousticness=rng.random(),
+                danceability=rng.random(),
+                energy=rng.random(),
+                instrumentalness=rng.random(),
+                key=rng.randint(0, 11),
+                liveness=rng.random(),
+                loudness=rng.uniform(-30.0, 0.0),
+                mode=rng.randint(0, 1),
+                speechiness=rng.random(),
+                tempo=rng.uniform(60.0, 200.0),
+                time_signature=rng.choice([3, 4, 4, 4, 5]),
+                valence=rng.random(),
+            ))
+        return audio_features
+
+    def albums(self, album_ids: List[str], market: str = None) -> List[SimpleNamespace]:
+        self.record_request('albums')
+        albums = []
+        for album_id in album_ids:
+            rng = self.entity_random(album_id)
+            albums.append(SimpleNamespace(
+                id=album_id,
+                name=f"Album {self.entity_num(album_id)}",
+                album_type=rng.choice(ALBUM_TYPES),
+                label=rng.choice(LABELS),
+                popularity=rng.randint(0, 100),
+                release_date=f"{rng.randint(1960, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                total_tracks=rng.randint(1, 24),
+                genres=rng.sample(GENRES, rng.choice([0, 1, 1, 2])),
+            ))
+            # Release dates are given to the precision of a year, month or day
+            albums[-1].release_date = albums[-1].release_date[:rng.choice([4, 7, 10, 10])]
+        return albums
+
+    def artists(self, artist_ids: List[str]) -> List[SimpleNamespace]:
+        self.record_request('artists')
+        artists = []
+        for artist_id in artist_ids:
+            rng = self.entity_random(artist_id)
+            artists.append(SimpleNamespace(
+                id=artist_id,
+                name=f"Artist {self.entity_num(artist_id)}",
+                popularity=rng.randint(0, 100),
+                genres=rng.sample(GENRES, rng.choice([0, 1, 2, 3, 4])),
+            ))
+        return artists
+
+
+class OfflineEnvironment(contextlib.ExitStack):
+    """
+    Context manager that routes the AWS and Spotify clients created by the stages to the offline stand-ins:
+    boto3.client('s3') and boto3.client('rds-data') to the fake S3 and RDS Data API clients, boto3.resource('dynamodb')
+    to the in-memory token store, and tk.Spotify/tk.refresh_user_token to the fake Spotify of the listener whose
+    access token the client is created with. S3 objects and the SQLite database are kept under root_dir.
+    """
+    def __init__(self, root_dir: str, spotify: FakeSpotify = None, user_spotifies: Dict[str, FakeSpotify] = None):
+        """
+        :param root_dir: Directory to keep S3 objects and the SQLite database under
+        :param spotify: Fake Spotify of the original account
+        :param user_spotifies: Fake Spotify of each listener other than the original account, by user-id. The users
+        are registered in the token store.
+        """
+        super().__init__()
+        self.root_dir = root_dir
+        self.s3 = FakeS3Client(os.path.join(root_dir, 's3'))
+        self.dynamodb = FakeDynamoDBResource()
+        self.rds_data = FakeRdsDataClient(os.path.join(root_dir, f"{soundprintutils.AURORA_DB}.sqlite"))
+        self.spotify = spotify if spotify is not None else FakeSpotify()
+        self.clients = {'s3': self.s3, 'rds-data': self.rds_data}
+
+        self.spotifies_by_token = {OFFLINE_ACCESS_TOKEN: self.spotify}
+        for user_id, user_spotify in (user_spotifies or {}).items():
+            self.dynamodb.add_user(user_id)
+            self.spotifies_by_token[f"{OFFLINE_ACCESS_TOKEN}/{user_id}"] = user_spotify
+
+    def get_spotify(self, access_token: str, *args, **kwargs) -> FakeSpotify:
+        return self.spotifies_by_token[access_token]
+
+    @staticmethod
+    def refresh_user_token(client_id: str, client_secret: str, refresh_token: str) -> SimpleNamespace:
+        return SimpleNamespace(access_token=refresh_token.replace(OFFLINE_REFRESH_TOKEN, OFFLINE_ACCESS_TOKEN))
+
+    def get_client(self, service_name: str, *args, **kwargs):
+        if service_name not in self.clients:
+            raise ValueError(f"No offline stand-in for AWS service: {service_name}")
+        return self.clients[service_name]
+
+    def get_resource(self, service_name: str, *args, **kwargs):
+        if service_name != 'dynamodb':
+            raise ValueError(f"No offline stand-in for AWS service resource: {service_name}")
+        return self.dynamodb
+
+    def __enter__(self):
+        super().__enter__()
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.enter_context(mock.patch.object(boto3, 'client', side_effect=self.get_client))
+        self.enter_context(mock.patch.object(boto3, 'resource', side_effect=self.get_resource))
+        self.enter_context(mock.patch.object(tk, 'Spotify', side_effect=self.get_spotify))
+        self.enter_context(mock.patch.object(tk, 'refresh_user_token', side_effect=self.refresh_user_token))
+        self.enter_context(mock.patch.dict(os.environ, {
+            soundprintutils.DB_SECRET_ARN_ENV: OFFLINE_DB_SECRET_ARN,
+            soundprintutils.AURORA_CLUSTER_ARN_ENV: OFFLINE_AURORA_CLUSTER_ARN,
+        }))
+        self.enter_context(mock.patch.dict(soundprintutils.ACCESS_TOKEN_CACHE, clear=True))
+
+        # Shared AWS clients are created again with the patched boto3, both in and after the offline environment
+        awsclients.clear()
+        self.callback(awsclients.clear)
+
+        # Spotify clients start with a new request scheduler at the maximum rate
+        spotifyscheduler.reset_scheduler()
+        self.callback(spotifyscheduler.reset_scheduler)
+
+        # Cached ARNs are resolved again from the environment, both in and after the offline environment
+        soundprintutils.get_db_secrets_arn.cache_clear()
+        soundprintutils.get_rds_cluster_arn.cache_clear()
+        self.callback(soundprintutils.get_db_secrets_arn.cache_clear)
+        self.callback(soundprintutils.get_rds_cluster_arn.cache_clear)
+        return self
+
+    def run_users_state_machine(self) -> List[Dict[str, str]]:
+        """
+        Runs the state machine as an execution started without input does: lists the accounts with the users lambda,
+        then runs the stages for each account as the Map state does (see run_state_machine). Returns the data of each
+        account's run.
+        """
+        listener = importlib.import_module('src.lambda.spotifylistener')
+        return [self.run_state_machine(user['user_id']) for user in listener.users_handler(None, None)]
+
+    def run_state_machine(self, user_id: str = None) -> Dict[str, str]:
+        """
+        Invokes the lambda handler of each stage in the order of the state machine's Map state for the given user,
+        passing the stage outputs as the state machine does, and returns the state machine's data. As in the state
+        machine, no stage runs after the listener if it found no new plays.
+        """
+        listener = importlib.import_module('src.lambda.spotifylistener')
+        tracker = importlib.import_module('src.lambda.spotifytracker')
+        albumer = importlib.import_module('src.lambda.spotifyalbumer')
+        artister = importlib.import_module('src.lambda.spotifyartister')
+        joiner = importlib.import_module('src.lambda.spotifyjoiner')
+        archiver = importlib.import_module('src.lambda.archiver.spotifyrdsarchiver')
+
+        state = {'listening': listener.lambda_handler({'user_id': user_id}, None)}
+        if state['listening'] is None:
+            return state
+        state['tracks'] = tracker.lambda_handler(state['listening'], None)
+        state['albums'] = albumer.lambda_handler(state['tracks'], None)
+        state['artists'] = artister.lambda_handler(state['tracks'], None)
+        state['data'] = joiner.lambda_handler(dict(state), None)
+        archiver.lambda_handler(state['data'], None)
+        return state
+
+
+class OfflineTestCase(unittest.TestCase):
+    """
+    Base test case of the tests run offline. Each test gets its own temporary directory, removed after the test, under
+    which the offline environments it enters keep their S3 objects and SQLite database.
+    """
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def offline_environment(self, spotify: FakeSpotify = None,
+                            user_spotifies: Dict[str, FakeSpotify] = None) -> OfflineEnvironment:
+        """
+        Returns an offline environment kept under the test's temporary directory, see OfflineEnvironment
+        """
+        return OfflineEnvironment(self.temp_dir.name, spotify, user_spotifies)
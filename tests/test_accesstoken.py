@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import tekore as tk
+
+from src.common import soundprintutils
+from src.local.harness import OfflineEnvironment, OfflineTestCase, OFFLINE_ACCESS_TOKEN
+
+
+class TestAccessTokenCase(OfflineTestCase):
+
+    @staticmethod
+    def get_token_item(environment: OfflineEnvironment) -> dict:
+        token_table = environment.dynamodb.Table(soundprintutils.TOKEN_STATE_TABLE)
+        return token_table.get_item(Key=soundprintutils.DDB_TOKEN_ITEM_KEY)['Item']
+
+    def update_token_item(self, environment: OfflineEnvironment, **attributes):
+        token_item = self.get_token_item(environment)
+        token_item.update(attributes)
+        environment.dynamodb.Table(soundprintutils.TOKEN_STATE_TABLE).put_item(Item=token_item)
+
+    @staticmethod
+    def slow_refresh(*args, **kwargs):
+        time.sleep(0.3)
+        return OfflineEnvironment.refresh_user_token(*args, **kwargs)
+
+    def test_concurrent_callers_refresh_once(self):
+        with self.offline_environment() as environment, \
+                mock.patch.object(tk, 'refresh_user_token', side_effect=self.slow_refresh) as refresh_user_token, \
+                mock.patch.object(soundprintutils, 'TOKEN_REFRESH_POLL_SECS', 0.05):
+            barrier = threading.Barrier(8)
+
+            def get_access_token(_):
+                barrier.wait()
+                return soundprintutils.get_access_token()
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                access_tokens = list(executor.map(get_access_token, range(8)))
+            self.assertEqual(access_tokens, [OFFLINE_ACCESS_TOKEN] * 8)
+            self.assertEqual(refresh_user_token.call_count, 1)
+
+            # Callers in separate stages don't share the in-process lock or cache, so they wait on the stored lock
+            self.update_token_item(environment, **{soundprintutils.EXPIRES_AT_DDB_KEY: 0})
+            soundprintutils.ACCESS_TOKEN_CACHE.clear()
+            barrier.reset()
+            with mock.patch.object(soundprintutils, 'get_access_token_lock', side_effect=lambda _: threading.Lock()), \
+                    ThreadPoolExecutor(max_workers=8) as executor:
+                access_tokens = list(executor.map(get_access_token, range(8)))
+            self.assertEqual(access_tokens, [OFFLINE_ACCESS_TOKEN] * 8)
+            self.assertEqual(refresh_user_token.call_count, 2)
+            self.assertNotIn(soundprintutils.REFRESH_LOCKED_UNTIL_DDB_KEY, self.get_token_item(environment))
+
+    def test_lock_of_crashed_refresher_expires(self):
+        with self.offline_environment() as environment, \
+                mock.patch.object(soundprintutils, 'TOKEN_REFRESH_POLL_SECS', 0.1):
+            # A stage that crashed while refreshing left the token locked, briefly
+            locked_until = int(datetime.now().timestamp()) + 1
+            self.update_token_item(environment, **{soundprintutils.REFRESH_LOCKED_UNTIL_DDB_KEY: locked_until})
+
+            self.assertEqual(soundprintutils.get_access_token(), OFFLINE_ACCESS_TOKEN)
+            self.assertGreater(datetime.now().timestamp(), locked_until)
+            token_item = self.get_token_item(environment)
+            self.assertEqual(token_item[soundprintutils.ACCESS_TOKEN_DDB_KEY], OFFLINE_ACCESS_TOKEN)
+            self.assertNotIn(soundprintutils.REFRESH_LOCKED_UNTIL_DDB_KEY, token_item)
+
+    def test_cached_token_close_to_expiry_is_not_used(self):
+        with self.offline_environment() as environment, \
+                mock.patch.object(tk, 'refresh_user_token',
+                                  side_effect=OfflineEnvironment.refresh_user_token) as refresh_user_token:
+            now = datetime.now().timestamp()
+            self.update_token_item(environment, **{soundprintutils.ACCESS_TOKEN_DDB_KEY: 'stored-access-token',
+                                                   soundprintutils.EXPIRES_AT_DDB_KEY: int(now) + 600})
+            token_table = environment.dynamodb.Table(soundprintutils.TOKEN_STATE_TABLE)
+            token_cache_key = soundprintutils.DDB_TOKEN_ITEM_KEY['spotify']
+
+            # A cached token far from expiry is served from memory, without reading the token store
+            soundprintutils.ACCESS_TOKEN_CACHE[token_cache_key] = ('cached-access-token', now + 600)
+            num_reads = token_table.request_counts['get_item']
+            self.assertEqual(soundprintutils.get_access_token(), 'cached-access-token')
+            self.assertEqual(token_table.request_counts['get_item'], num_reads)
+
+            # Within the expiry margin, the cached token is replaced by the stored one, which is still valid
+            expires_at = now + soundprintutils.ACCESS_TOKEN_EXPIRY_MARGIN_SECS / 2
+            soundprintutils.ACCESS_TOKEN_CACHE[token_cache_key] = ('cached-access-token', expires_at)
+            self.assertEqual(soundprintutils.get_access_token(), 'stored-access-token')
+            self.assertEqual(soundprintutils.ACCESS_TOKEN_CACHE[token_cache_key][0], 'stored-access-token')
+
+            # Once the stored token is within the margin as well, it is refreshed
+            self.update_token_item(environment, **{soundprintutils.EXPIRES_AT_DDB_KEY: int(expires_at)})
+            soundprintutils.ACCESS_TOKEN_CACHE[token_cache_key] = ('cached-access-token', expires_at)
+            self.assertEqual(soundprintutils.get_access_token(), OFFLINE_ACCESS_TOKEN)
+            self.assertEqual(refresh_user_token.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
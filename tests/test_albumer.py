@@ -0,0 +1,21 @@
+import importlib
+import unittest
+
+import pandas as pd
+
+spotifyalbumer = importlib.import_module('src.lambda.spotifyalbumer')
+
+
+class TestAlbumerCase(unittest.TestCase):
+
+    def test_release_dates_of_mixed_precision(self):
+        release_timestamps = spotifyalbumer.get_release_timestamps(['1999-05-01', '1999', '1999-05', '2021-12-31'])
+        expected_timestamps = [pd.Timestamp(release_date).timestamp()
+                               for release_date in ['1999-05-01', '1999-01-01', '1999-05-01', '2021-12-31']]
+        self.assertEqual(release_timestamps.tolist(), expected_timestamps)
+
+        self.assertEqual(len(spotifyalbumer.get_release_timestamps([])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
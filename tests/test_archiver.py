@@ -0,0 +1,186 @@
+import json
+import importlib
+import unittest
+from unittest import mock
+import pandas as pd
+
+from src.common import soundprintutils
+from src.common.archiver import ArchiverCommon
+from src.common.joiner import JoinerCommon
+from src.common.listener import ListenerCommon
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+from src.local.harness import FakeSpotify, OfflineTestCase, client_error
+
+spotifyjoiner = importlib.import_module('src.lambda.spotifyjoiner')
+spotifyrdsarchiver = importlib.import_module('src.lambda.archiver.spotifyrdsarchiver')
+
+
+class TestArchiverCase(OfflineTestCase):
+
+    def test_star_layout_archives_plays_and_dimensions(self):
+        spotify = FakeSpotify(num_plays=12, seed=15)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = soundprintutils.download_df_from_s3(state['data'], JoinerCommon.TYPED_SCHEMA)
+
+            spotifyrdsarchiver.archive_joined_rows(joined_df, environment.rds_data, ArchiverCommon.LAYOUT_STAR)
+
+            def count_distinct(fields: list) -> int:
+                return joined_df[[field[0] for field in fields]].dropna().drop_duplicates().shape[0]
+            for table in ArchiverCommon.STAR_TABLES:
+                table_name = spotifyrdsarchiver.get_star_table_name(table)
+                self.assertEqual(environment.rds_data.query(f"SELECT COUNT(*) FROM {table_name}")[0][0],
+                                 count_distinct(table.PRIMARY_KEY), table_name)
+            self.assertEqual(environment.rds_data.query(
+                f"SELECT COUNT(*) FROM {spotifyrdsarchiver.get_star_table_name(ArchiverCommon.FACT_TABLES[0])}")[0][0],
+                12)
+
+            # Archiving the rows again upserts only the plays, as the dimension rows are unchanged
+            dimension_rows = {table.NAME: environment.rds_data.query(f"SELECT * FROM {table.NAME} ORDER BY 1, 2")
+                              for table in ArchiverCommon.DIMENSION_TABLES}
+            batch_count = environment.rds_data.request_counts['batch_execute_statement']
+            spotifyrdsarchiver.archive_joined_rows(joined_df, environment.rds_data, ArchiverCommon.LAYOUT_STAR)
+            self.assertEqual(environment.rds_data.request_counts['batch_execute_statement'], batch_count + 1)
+            for table in ArchiverCommon.DIMENSION_TABLES:
+                self.assertEqual(environment.rds_data.query(f"SELECT * FROM {table.NAME} ORDER BY 1, 2"),
+                                 dimension_rows[table.NAME])
+
+    def test_compact_files_are_archived_in_chunks(self):
+        spotify = FakeSpotify(num_plays=15, seed=16)
+        with self.offline_environment(spotify) as environment:
+            with mock.patch.object(spotifyjoiner, 'JOIN_MODE', spotifyjoiner.JOIN_MODE_COMPACT):
+                state = environment.run_state_machine()
+            self.assertTrue(state['data'].startswith(JoinerCommon.COMPACT_FILE_PATH_PREFIX))
+
+            # The archived rows are those of the wide join of the stage files
+            wide_df = spotifyjoiner.join_dataframes(
+                soundprintutils.download_df_from_s3(state['listening'], ListenerCommon.TYPED_SCHEMA),
+                soundprintutils.download_df_from_s3(state['tracks'], TrackerCommon.TYPED_SCHEMA),
+                soundprintutils.download_df_from_s3(state['albums'], AlbumerCommon.TYPED_SCHEMA),
+                soundprintutils.download_df_from_s3(state['artists'], ArtisterCommon.TYPED_SCHEMA))
+            self.assertEqual(environment.rds_data.query(
+                f"SELECT COUNT(*) FROM {soundprintutils.AURORA_HISTORY_TABLE}")[0][0], wide_df.shape[0])
+            self.assertEqual(soundprintutils.get_listening_cursor(), spotify.end_timestamp_ms)
+
+            # The compact file is expanded a chunk of plays at a time, in order of the plays
+            chunk_dfs = list(spotifyrdsarchiver.iter_joined_rows(state['data'], compact_chunk_plays=4))
+            timestamp_field = JoinerCommon.LISTEN_TIMESTAMP[0]
+            num_plays = wide_df[timestamp_field].nunique()
+            self.assertEqual([chunk_df[timestamp_field].nunique() for chunk_df in chunk_dfs],
+                             [4] * (num_plays // 4) + ([num_plays % 4] if num_plays % 4 else []))
+            self.assertTrue(pd.concat(chunk_dfs)[timestamp_field].is_monotonic_increasing)
+            self.assertEqual(sum(chunk_df.shape[0] for chunk_df in chunk_dfs), wide_df.shape[0])
+
+    def test_overlapping_files_are_archived_once(self):
+        spotify = FakeSpotify(num_plays=20, seed=18)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = soundprintutils.download_df_from_s3(state['data'], JoinerCommon.TYPED_SCHEMA)
+            timestamp_field, popularity_field = JoinerCommon.LISTEN_TIMESTAMP[0], JoinerCommon.TRACK_POPULARITY[0]
+            history_table = soundprintutils.AURORA_HISTORY_TABLE
+
+            # The second file holds the later plays of the first along with new plays, with refreshed popularities
+            timestamps = sorted(joined_df[timestamp_field].unique())
+            first_df = joined_df[joined_df[timestamp_field] <= timestamps[12]]
+            second_df = joined_df[joined_df[timestamp_field] > timestamps[6]]
+            second_df = second_df.assign(**{popularity_field: second_df[popularity_field] + 1})
+            num_new_rows = (second_df[timestamp_field] > timestamps[12]).sum()
+
+            rds_data = environment.rds_data
+            for prefilter_existing_rows in (False, True):
+                rds_data.query(f"DELETE FROM {history_table}")
+                spotifyrdsarchiver.archive_joined_rows(first_df, rds_data, ArchiverCommon.LAYOUT_WIDE)
+
+                with mock.patch.object(spotifyrdsarchiver, 'PREFILTER_EXISTING_ROWS', prefilter_existing_rows), \
+                        mock.patch.object(rds_data, 'batch_execute_statement',
+                                          wraps=rds_data.batch_execute_statement) as batch_execute_statement:
+                    spotifyrdsarchiver.archive_joined_rows(second_df, rds_data, ArchiverCommon.LAYOUT_WIDE)
+
+                # Every row is archived once either way, but only the new rows are sent when prefiltering
+                num_sent_rows = sum(len(call.kwargs['parameterSets'])
+                                    for call in batch_execute_statement.call_args_list)
+                self.assertEqual(num_sent_rows, num_new_rows if prefilter_existing_rows else second_df.shape[0])
+                self.assertEqual(rds_data.query(f"SELECT COUNT(*) FROM {history_table}")[0][0], joined_df.shape[0])
+
+                # Without prefiltering, the overlapping rows are upserted with the popularities of the second file
+                overlap_popularities = rds_data.query(
+                    f"SELECT {popularity_field} FROM {history_table} "
+                    f"WHERE {timestamp_field} > {timestamps[6]} AND {timestamp_field} <= {timestamps[12]}")
+                overlap_df = first_df[first_df[timestamp_field] > timestamps[6]]
+                expected_popularities = overlap_df[popularity_field] + (0 if prefilter_existing_rows else 1)
+                self.assertEqual(sorted(popularity for popularity, in overlap_popularities),
+                                 sorted(expected_popularities.tolist()))
+
+    def test_parameter_sets_are_split_by_rows_and_bytes(self):
+        sql_parameter_sets = [[{'name': 'ID', 'value': {'longValue': i}},
+                               {'name': 'NAME', 'value': {'stringValue': 'x' * (200 if i == 7 else 20)}}]
+                              for i in range(10)]
+        parameter_set_bytes = len(json.dumps(sql_parameter_sets[0]))
+
+        batches = spotifyrdsarchiver.split_sql_parameter_sets(sql_parameter_sets, max_rows=3, max_bytes=10 ** 6)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+        self.assertEqual([parameter_set for batch in batches for parameter_set in batch], sql_parameter_sets)
+
+        # The parameter-set larger than max_bytes by itself is a batch of its own
+        batches = spotifyrdsarchiver.split_sql_parameter_sets(sql_parameter_sets, max_rows=3,
+                                                              max_bytes=int(2.5 * parameter_set_bytes))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2, 1, 1, 2])
+        self.assertEqual(batches[4][0], sql_parameter_sets[7])
+        self.assertEqual([parameter_set for batch in batches for parameter_set in batch], sql_parameter_sets)
+
+        # Archiving with small batches sends every row, a batch at a time
+        spotify = FakeSpotify(num_plays=12, seed=17)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = soundprintutils.download_df_from_s3(state['data'], JoinerCommon.TYPED_SCHEMA)
+            environment.rds_data.query(f"DELETE FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+
+            split_sql_parameter_sets = spotifyrdsarchiver.split_sql_parameter_sets
+            batch_count = environment.rds_data.request_counts['batch_execute_statement']
+            with mock.patch.object(spotifyrdsarchiver, 'split_sql_parameter_sets',
+                                   side_effect=lambda parameter_sets: split_sql_parameter_sets(parameter_sets, 5)):
+                spotifyrdsarchiver.archive_joined_rows(joined_df, environment.rds_data, ArchiverCommon.LAYOUT_WIDE)
+            self.assertEqual(environment.rds_data.request_counts['batch_execute_statement'] - batch_count,
+                             -(-joined_df.shape[0] // 5))
+            self.assertEqual(environment.rds_data.query(
+                f"SELECT COUNT(*) FROM {soundprintutils.AURORA_HISTORY_TABLE}")[0][0], joined_df.shape[0])
+
+    def test_failed_batches_are_retried_with_backoff(self):
+        with self.offline_environment() as environment:
+            rds_data = environment.rds_data
+            spotifyrdsarchiver.execute_sql(rds_data, "CREATE TABLE IF NOT EXISTS retried (ID INTEGER PRIMARY KEY)")
+            sql = "INSERT INTO retried (ID) VALUES (:ID)"
+            sql_parameter_sets = [[{'name': 'ID', 'value': {'longValue': i}}] for i in range(3)]
+            link_failure = client_error('BadRequestException', 'Communications link failure', 'BatchExecuteStatement')
+
+            # A batch sent while the cluster pauses again is retried, backing off longer after every attempt
+            with mock.patch.object(rds_data, 'batch_execute_statement', wraps=rds_data.batch_execute_statement,
+                                   side_effect=[link_failure, link_failure, mock.DEFAULT]) as batch_execute_statement, \
+                    mock.patch.object(spotifyrdsarchiver.time, 'sleep') as sleep:
+                spotifyrdsarchiver.execute_batch_sql_with_retries(rds_data, sql, sql_parameter_sets)
+            self.assertEqual(batch_execute_statement.call_count, 3)
+            self.assertEqual([call.args[0] for call in sleep.call_args_list], [1, 2])
+            self.assertEqual(rds_data.query("SELECT COUNT(*) FROM retried")[0][0], 3)
+
+            # A batch failing on every attempt raises the last failure
+            rds_data.pause(resume_secs=60)
+            with mock.patch.object(spotifyrdsarchiver.time, 'sleep') as sleep, \
+                    self.assertRaises(spotifyrdsarchiver.ClientError) as raised:
+                spotifyrdsarchiver.execute_batch_sql_with_retries(rds_data, sql, sql_parameter_sets)
+            self.assertTrue(spotifyrdsarchiver.is_cluster_resuming(raised.exception))
+            self.assertEqual(sleep.call_count, spotifyrdsarchiver.MAX_BATCH_ATTEMPTS - 1)
+            rds_data.paused = False
+
+            # Other bad requests, e.g. rows that are already archived, are not retried
+            with mock.patch.object(spotifyrdsarchiver.time, 'sleep') as sleep, \
+                    self.assertRaises(spotifyrdsarchiver.ClientError) as raised:
+                spotifyrdsarchiver.execute_batch_sql_with_retries(rds_data, sql, sql_parameter_sets)
+            self.assertEqual(raised.exception.response['Error']['Code'], 'BadRequestException')
+            self.assertFalse(spotifyrdsarchiver.is_cluster_resuming(raised.exception))
+            sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import importlib
+import unittest
+
+from src.common.entitycache import EntityCache, LocalFileCacheBackend, CACHED_AT
+from src.common.tracker import TrackerCommon
+from src.local.harness import FakeSpotify, OfflineTestCase
+
+spotifytracker = importlib.import_module('src.lambda.spotifytracker')
+
+
+class TestEntityCacheCase(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = LocalFileCacheBackend(self.temp_dir.name)
+        self.spotify = FakeSpotify(num_tracks=30)
+        self.track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(30)]
+
+    def build_cache(self, **kwargs) -> EntityCache:
+        return EntityCache('tracks', TrackerCommon.TYPED_SCHEMA, TrackerCommon.TRACK_ID, TrackerCommon.VOLATILE_SCHEMA,
+                           backend=self.backend, **kwargs)
+
+    def test_expired_tracks_are_refreshed(self):
+        track_cache = self.build_cache()
+        tracks_df = spotifytracker.get_tracks_data(self.spotify, self.track_ids, track_cache)
+        track_cache.save()
+        self.assertEqual(self.spotify.request_counts['tracks_audio_features'], 1)
+        self.assertEqual(self.spotify.request_counts['tracks'], 1)
+
+        # Fresh tracks are served from the saved cache without querying Spotify
+        cached_tracks_df = spotifytracker.get_tracks_data(self.spotify, self.track_ids, self.build_cache())
+        self.assertEqual(self.spotify.request_counts['tracks'], 1)
+        self.assertEqual(sorted(cached_tracks_df.itertuples(index=False)), sorted(tracks_df.itertuples(index=False)))
+
+        # Once their popularity has expired, only the track-objects are queried again, and the refresh is saved
+        track_cache = self.build_cache(volatile_ttl_secs=-1)
+        refreshed_tracks_df = spotifytracker.get_tracks_data(self.spotify, self.track_ids, track_cache)
+        cached_at = track_cache.load()[CACHED_AT[0]].max()
+        track_cache.save()
+        self.assertEqual(self.spotify.request_counts['tracks'], 2)
+        self.assertEqual(self.spotify.request_counts['tracks_audio_features'], 1)
+        self.assertEqual(sorted(refreshed_tracks_df.itertuples(index=False)), sorted(tracks_df.itertuples(index=False)))
+        self.assertTrue((self.build_cache().load()[CACHED_AT[0]] == cached_at).all())
+
+    def test_expired_entities_are_evicted_on_save(self):
+        tracks_df = spotifytracker.fetch_tracks_data(self.spotify, self.track_ids)
+        track_cache = self.build_cache(eviction_ttl_secs=100)
+        track_cache.update(tracks_df[tracks_df[TrackerCommon.TRACK_ID[0]].isin(self.track_ids[:10])], 1000)
+        track_cache.save(now=1050)
+        track_cache = self.build_cache(eviction_ttl_secs=100)
+        track_cache.update(tracks_df[tracks_df[TrackerCommon.TRACK_ID[0]].isin(self.track_ids[10:])], 1080)
+        track_cache.save(now=1120)
+
+        # Only the tracks cached within the eviction TTL of the last save are kept
+        _, _, missing_ids = self.build_cache().lookup(self.track_ids, 1120)
+        self.assertEqual(missing_ids, self.track_ids[:10])
+
+    def test_concurrent_saves_keep_each_others_entities(self):
+        tracks_df = spotifytracker.fetch_tracks_data(self.spotify, self.track_ids)
+        first_cache, second_cache = self.build_cache(), self.build_cache()
+        self.assertEqual(len(first_cache.load().index), 0)
+        self.assertEqual(len(second_cache.load().index), 0)
+
+        # Both runs loaded the empty cache; the second also refreshes a track the first cached, at a later time
+        first_cache.update(tracks_df[tracks_df[TrackerCommon.TRACK_ID[0]].isin(self.track_ids[:20])], 1000)
+        second_cache.update(tracks_df[tracks_df[TrackerCommon.TRACK_ID[0]].isin(self.track_ids[19:])], 1010)
+        second_cache.save(now=1010)
+        first_cache.save(now=1020)
+
+        cached_df = self.build_cache().load()
+        self.assertEqual(set(cached_df[TrackerCommon.TRACK_ID[0]]), set(self.track_ids))
+        self.assertEqual(len(cached_df.index), len(tracks_df.index))
+        last_track_df = cached_df[cached_df[TrackerCommon.TRACK_ID[0]] == self.track_ids[19]]
+        self.assertTrue((last_track_df[CACHED_AT[0]] == 1010).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from src.common.entitycache import LocalFileCacheBackend
+from src.common.featureindex import AudioFeatureIndex, INDEX_FEATURES
+from src.common.tracker import TrackerCommon
+from src.local.harness import OfflineTestCase
+
+
+def build_tracks_df(track_ids, features) -> pd.DataFrame:
+    tracks_df = pd.DataFrame(features, columns=INDEX_FEATURES)
+    tracks_df.insert(0, TrackerCommon.TRACK_ID[0], track_ids)
+    return tracks_df
+
+
+class TestFeatureIndexCase(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = LocalFileCacheBackend(self.temp_dir.name)
+
+        rng = np.random.default_rng(9)
+        self.features = rng.random((200, len(INDEX_FEATURES)))
+        self.features[:, INDEX_FEATURES.index(TrackerCommon.TEMPO[0])] *= 200
+        self.track_ids = [f"track{i}" for i in range(200)]
+
+    def test_most_similar_matches_brute_force(self):
+        index = AudioFeatureIndex(backend=self.backend)
+        self.assertEqual(index.add(build_tracks_df(self.track_ids, self.features)), 200)
+
+        normalized = (self.features - self.features.mean(axis=0)) / self.features.std(axis=0)
+        normalized /= np.linalg.norm(normalized, axis=1, keepdims=True)
+        similarities = normalized @ normalized[7]
+        similarities[7] = -np.inf
+        expected_ids = [self.track_ids[row] for row in np.argsort(-similarities)[:5]]
+
+        similar_tracks = index.most_similar('track7', k=5)
+        self.assertEqual([track_id for track_id, _ in similar_tracks], expected_ids)
+        self.assertAlmostEqual(similar_tracks[0][1], similarities.max(), places=4)
+
+        # The centroid of a single track is the track itself, which is left out of the results
+        centroid_tracks = index.most_similar_to_tracks(['track7', 'unknown'], k=5)
+        self.assertEqual([track_id for track_id, _ in centroid_tracks], expected_ids)
+        np.testing.assert_allclose([similarity for _, similarity in centroid_tracks],
+                                   [similarity for _, similarity in similar_tracks], rtol=1e-5)
+        self.assertEqual(index.most_similar_to_tracks(['track7'], k=1, exclude_tracks=False)[0][0], 'track7')
+
+    def test_incremental_add_persists(self):
+        index = AudioFeatureIndex(backend=self.backend)
+        index.add(build_tracks_df(self.track_ids[:150], self.features[:150]))
+        # The matrix and the ids are written together, so that readers never see them out of step
+        with mock.patch.object(self.backend, 'write', wraps=self.backend.write) as write:
+            index.save()
+        write.assert_called_once()
+        self.assertEqual(os.listdir(self.temp_dir.name), [index.file_name])
+
+        # Tracks already indexed, and tracks without audio-features, are not added again
+        features = self.features[100:].copy()
+        features[-1, 0] = np.nan
+        index = AudioFeatureIndex(backend=self.backend)
+        self.assertIsInstance(index.load().matrix, np.memmap)
+        self.assertIsInstance(index.ids, np.memmap)
+        self.assertEqual(index.add(build_tracks_df(self.track_ids[100:], features)), 49)
+        index.save()
+
+        index = AudioFeatureIndex(backend=self.backend).load()
+        self.assertEqual(len(index), 199)
+        self.assertEqual(index.matrix.dtype, np.float32)
+        np.testing.assert_allclose(index.matrix, self.features[:199].astype(np.float32))
+        self.assertEqual([track_id for track_id, _ in index.most_similar('track160', k=3)],
+                         [track_id for track_id, _ in index.most_similar_to_tracks(['track160'], k=3)])
+
+    def test_concurrent_saves_keep_each_others_tracks(self):
+        # Both runs loaded the empty index, and index some of the same tracks
+        first_index, second_index = AudioFeatureIndex(backend=self.backend), AudioFeatureIndex(backend=self.backend)
+        self.assertEqual(first_index.add(build_tracks_df(self.track_ids[:120], self.features[:120])), 120)
+        self.assertEqual(second_index.add(build_tracks_df(self.track_ids[100:], self.features[100:])), 100)
+        second_index.save()
+        first_index.save()
+
+        index = AudioFeatureIndex(backend=self.backend).load()
+        self.assertEqual(index.ids.dtype, np.dtype('S22'))
+        self.assertEqual(sorted(index.get_id_rows()), sorted(self.track_ids))
+        rows = [index.get_id_rows()[track_id] for track_id in self.track_ids]
+        np.testing.assert_allclose(index.matrix[rows], self.features.astype(np.float32))
+
+        # The index that saved last queries the merged tracks
+        self.assertEqual(len(first_index), 200)
+        self.assertEqual(first_index.most_similar('track150', k=3), index.most_similar('track150', k=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
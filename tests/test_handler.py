@@ -1,16 +1,155 @@
+import importlib
+import sys
+import json
+import subprocess
 import unittest
+from unittest import mock
+from datetime import datetime, timezone
+
+import boto3
+import pandas as pd
+
 import index
+from src.common import rollups
+from src.common import soundprintutils
+from src.common.joiner import JoinerCommon
+from src.local.harness import FakeSpotify, OfflineTestCase
 
+spotifypipeline = importlib.import_module('src.lambda.spotifypipeline')
+spotifyrdsarchiver = importlib.import_module('src.lambda.archiver.spotifyrdsarchiver')
 
-class TestHandlerCase(unittest.TestCase):
 
-    def test_response(self):
-        print("testing response.")
-        result = index.handler(None, None)
-        print(result)
-        self.assertEqual(result['statusCode'], 200)
+class TestHandlerCase(OfflineTestCase):
+
+    def query_stats(self, claims: dict = None, **parameters) -> dict:
+        if claims is None:
+            claims = {index.GROUPS_CLAIM: index.OWNER_GROUP}
+        result = index.handler({'queryStringParameters': parameters,
+                                'requestContext': {'authorizer': {'claims': claims}}}, None)
         self.assertEqual(result['headers']['Content-Type'], 'application/json')
-        self.assertIn('Hello World', result['body'])
+        return {'statusCode': result['statusCode'], **json.loads(result['body'])}
+
+    def test_response(self):
+        spotify = FakeSpotify(num_plays=10, seed=4)
+        with self.offline_environment(spotify) as environment:
+            spotifypipeline.lambda_handler(None, None)
+            archived_plays = environment.rds_data.query(
+                f"SELECT DISTINCT PLAYED_AT, LISTENED_MS FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            start = datetime.fromtimestamp(spotify.start_timestamp_ms / 1000, tz=timezone.utc).isoformat()
+            end = datetime.fromtimestamp(spotify.end_timestamp_ms / 1000, tz=timezone.utc).isoformat()
+
+            result = self.query_stats(granularity='hour', group_by='total', start=start, end=end)
+            self.assertEqual(result['statusCode'], 200)
+            totals = [bucket['groups'][0] for bucket in result['buckets']]
+            self.assertEqual(sum(total['playCount'] for total in totals), 10)
+            self.assertAlmostEqual(sum(total['listenedMinutes'] for total in totals),
+                                   sum(listened_ms for _, listened_ms in archived_plays) / 60000, places=2)
+            self.assertIsNotNone(totals[0]['averageFeatures']['TRACK_ENERGY'])
+
+            result = self.query_stats(granularity='week', group_by='artist', start=start, end=end, limit='2')
+            self.assertEqual(result['statusCode'], 200)
+            for bucket in result['buckets']:
+                self.assertLessEqual(len(bucket['groups']), 2)
+                minutes = [group['listenedMinutes'] for group in bucket['groups']]
+                self.assertEqual(minutes, sorted(minutes, reverse=True))
+
+            # Reprocessing the same time-window archives the rows again, without counting them twice in the rollups
+            spotifypipeline.lambda_handler({'after_timestamp_ms': 0, 'before_timestamp_ms': spotify.end_timestamp_ms},
+                                           None)
+            spotifypipeline.lambda_handler(None, None)
+            result = self.query_stats(granularity='day', group_by='total', start=start, end=end)
+            self.assertEqual(sum(bucket['groups'][0]['playCount'] for bucket in result['buckets']), 10)
+
+    def test_retried_archiver_does_not_count_plays_twice(self):
+        spotify = FakeSpotify(num_plays=8, seed=12)
+        with self.offline_environment(spotify) as environment:
+            rollups_table = environment.dynamodb.Table(soundprintutils.ROLLUPS_TABLE)
+
+            # The archiver stops after updating the rollups, before it advances the listening cursor
+            with mock.patch.object(soundprintutils, 'advance_listening_cursor', return_value=False):
+                state = environment.run_state_machine()
+            self.assertIsNone(soundprintutils.get_listening_cursor())
+            rollup_items = {key: dict(item) for key, item in rollups_table.items.items()}
+            self.assertGreater(len(rollup_items), 0)
+
+            # Retrying it adds none of the plays again, and advances the cursor; so does re-running it by hand
+            spotifyrdsarchiver.lambda_handler(state['data'], None)
+            self.assertEqual(soundprintutils.get_listening_cursor(), spotify.end_timestamp_ms)
+            spotifyrdsarchiver.lambda_handler(state['data'], None)
+            self.assertEqual(rollups_table.items, rollup_items)
+            total_items = [item for item in rollup_items.values() if item['rollup'] == 'hour/total']
+            self.assertEqual(sum(int(item['playCount']) for item in total_items), 8)
+
+    def test_plays_at_the_cursor_are_not_added_again(self):
+        spotify = FakeSpotify(num_plays=8, seed=12)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = pd.concat(spotifyrdsarchiver.iter_joined_rows(state['data']), ignore_index=True)
+            played_at = joined_df[JoinerCommon.LISTEN_TIMESTAMP[0]]
+            self.assertEqual(soundprintutils.get_listening_cursor(), int(round(played_at.max() * 1000)))
+
+            # The most recent play, at a fraction of a millisecond after the cursor that rounds down to it
+            last_play_df = joined_df[played_at == played_at.max()].copy()
+            last_play_df[JoinerCommon.LISTEN_TIMESTAMP[0]] += 0.0004
+            with mock.patch.object(rollups, 'update_rollups', return_value=0) as update_rollups:
+                spotifyrdsarchiver.update_listening_rollups(last_play_df)
+            self.assertEqual(len(update_rollups.call_args.args[0].index), 0)
+
+    def test_invalid_parameters(self):
+        with self.offline_environment(FakeSpotify(num_plays=1)):
+            self.assertEqual(self.query_stats(granularity='minute')['statusCode'], 400)
+            self.assertEqual(self.query_stats(group_by='label')['statusCode'], 400)
+            self.assertEqual(self.query_stats(start='yesterday')['statusCode'], 400)
+            self.assertEqual(self.query_stats(start='2026-10-18', end='2026-10-11')['statusCode'], 400)
+            self.assertEqual(self.query_stats()['buckets'], [])
+
+    def test_datetimes_in_utc(self):
+        expected_dt = datetime(2026, 10, 18, 5, 30, tzinfo=timezone.utc)
+        self.assertEqual(index.parse_datetime('2026-10-18T05:30:00Z'), expected_dt)
+        self.assertEqual(index.parse_datetime('2026-10-18T05:30:00'), expected_dt)
+        self.assertEqual(index.parse_datetime('2026-10-18T07:30:00+02:00'), expected_dt)
+        self.assertEqual(index.parse_datetime('2026-10-18'), datetime(2026, 10, 18, tzinfo=timezone.utc))
+        with self.offline_environment(FakeSpotify(num_plays=1)):
+            self.assertEqual(self.query_stats(start='2026-10-11T00:00:00Z', end='2026-10-18T00:00:00Z')['statusCode'],
+                             200)
+
+    def test_callers_read_only_their_own_stats(self):
+        spotify = FakeSpotify(num_plays=6, seed=13)
+        user_spotifies = {'alice': FakeSpotify(num_plays=4, seed=14)}
+        with self.offline_environment(spotify, user_spotifies=user_spotifies):
+            spotifypipeline.lambda_handler(None, None)
+            start = datetime.fromtimestamp(spotify.start_timestamp_ms / 1000 - 86400, tz=timezone.utc).isoformat()
+
+            def count_plays(claims: dict, **parameters) -> int:
+                result = self.query_stats(claims, granularity='week', start=start, **parameters)
+                self.assertEqual(result['statusCode'], 200)
+                return sum(bucket['groups'][0]['playCount'] for bucket in result['buckets'])
+
+            self.assertEqual(count_plays({index.GROUPS_CLAIM: f"other,{index.OWNER_GROUP}"}), 6)
+            self.assertEqual(count_plays({index.USER_ID_CLAIM: 'alice'}), 4)
+            # The user-id of the query string is ignored
+            self.assertEqual(count_plays({index.USER_ID_CLAIM: 'alice'}, user_id='None'), 4)
+
+            self.assertEqual(self.query_stats({})['statusCode'], 403)
+            self.assertEqual(self.query_stats({index.GROUPS_CLAIM: 'other'})['statusCode'], 403)
+            self.assertEqual(self.query_stats({index.USER_ID_CLAIM: '../other'})['statusCode'], 403)
+            self.assertEqual(index.handler({'queryStringParameters': {}}, None)['statusCode'], 403)
+
+    def test_cold_start_defers_heavy_imports(self):
+        # Neither the stats API nor the stage modules import the heavy packages until they are used
+        for module_name in ('index', 'src.lambda.spotifylistener', 'src.lambda.spotifytracker',
+                            'src.lambda.spotifyalbumer', 'src.lambda.spotifyartister', 'src.lambda.spotifyjoiner'):
+            import_script = (f"import sys, importlib; importlib.import_module('{module_name}'); "
+                             f"print(sorted({{'pandas', 'pyarrow', 'tekore'}} & set(sys.modules)))")
+            imported = subprocess.run([sys.executable, '-c', import_script], capture_output=True, text=True,
+                                      check=True).stdout
+            self.assertEqual(imported.strip(), '[]', module_name)
+
+        # Queries share the registered clients rather than creating their own
+        with self.offline_environment(FakeSpotify(num_plays=5, seed=2)):
+            for _ in range(3):
+                self.assertEqual(self.query_stats()['statusCode'], 200)
+            self.assertEqual(boto3.resource.call_count, 1)
 
 
 if __name__ == '__main__':
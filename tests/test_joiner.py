@@ -0,0 +1,73 @@
+import importlib
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.common.joiner import JoinerCommon
+from src.common.listener import ListenerCommon
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+
+spotifyjoiner = importlib.import_module('src.lambda.spotifyjoiner')
+
+
+def build_stage_df(typed_schema: list, **columns) -> pd.DataFrame:
+    """
+    Builds a stage dataframe following the typed schema with the given columns, which include its first field. Every
+    other field is filled with a value of its data-type that is the same for the rows with the same first field.
+    """
+    df = pd.DataFrame(columns)
+    entity_nums = df[typed_schema[0][0]].factorize()[0]
+    for field, dtype in typed_schema:
+        if field not in columns:
+            df[field] = [f"{field.lower()}{entity_num}" if dtype == str else dtype(entity_num)
+                         for entity_num in entity_nums]
+    return df[[field for field, _ in typed_schema]]
+
+
+class TestJoinerCase(unittest.TestCase):
+
+    def test_compact_join_expands_to_wide_join(self):
+        # Tracks have one or more artists, albums and artists one or more genres or none, and one artist and one
+        # played track are unknown
+        listening_df = build_stage_df(ListenerCommon.TYPED_SCHEMA, **{
+            ListenerCommon.TIMESTAMP[0]: [1_760_000_000.0 + 60 * play_num for play_num in [3, 0, 1, 2, 4, 5, 6]],
+            ListenerCommon.TRACK_ID[0]: ['t0', 't1', 't2', 't0', 't1', 't3', 't2'],
+        })
+        tracks_df = build_stage_df(TrackerCommon.TYPED_SCHEMA, **{
+            TrackerCommon.TRACK_ID[0]: ['t0', 't0', 't1', 't2', 't2'],
+            TrackerCommon.ALBUM_ID[0]: ['b0', 'b0', 'b1', 'b0', 'b0'],
+            TrackerCommon.ARTIST_ID[0]: ['a0', 'a1', 'a1', 'a2', 'a9'],
+            TrackerCommon.NAME[0]: ['Track 0', 'Track 0', 'Track 1', 'Track 2', 'Track 2'],
+        })
+        albums_df = build_stage_df(AlbumerCommon.TYPED_SCHEMA, **{
+            AlbumerCommon.ALBUM_ID[0]: ['b0', 'b0', 'b1'],
+            AlbumerCommon.GENRE[0]: ['rock', 'pop', np.nan],
+            AlbumerCommon.NAME[0]: ['Album 0', 'Album 0', 'Album 1'],
+        })
+        artists_df = build_stage_df(ArtisterCommon.TYPED_SCHEMA, **{
+            ArtisterCommon.ARTIST_ID[0]: ['a0', 'a1', 'a1', 'a2'],
+            ArtisterCommon.ARTIST_GENRE[0]: ['rock', 'jazz', 'blues', np.nan],
+            ArtisterCommon.ARTIST_NAME[0]: ['Artist 0', 'Artist 1', 'Artist 1', 'Artist 2'],
+        })
+        stage_dfs = [listening_df, tracks_df, albums_df, artists_df]
+
+        wide_df = spotifyjoiner.join_dataframes(*stage_dfs)
+        compact_df = spotifyjoiner.join_compact_dataframes(*stage_dfs)
+        self.assertEqual(compact_df.shape[0], 6)
+        self.assertTrue(compact_df[ListenerCommon.TIMESTAMP[0]].is_monotonic_increasing)
+        track_zero_df = compact_df[compact_df[TrackerCommon.TRACK_ID[0]] == 't0']
+        self.assertEqual(track_zero_df[JoinerCommon.ARTIST_IDS[0]].map(list).tolist(), [['a0', 'a1']] * 2)
+
+        # Rows are compared as strings, in a canonical order, as their order within a play may differ
+        def canonical_rows(df: pd.DataFrame) -> pd.DataFrame:
+            return df.astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+        expanded_df = spotifyjoiner.expand_compact_rows(compact_df)
+        self.assertEqual(list(expanded_df.columns), JoinerCommon.SCHEMA)
+        pd.testing.assert_frame_equal(canonical_rows(expanded_df), canonical_rows(wide_df))
+
+
+if __name__ == '__main__':
+    unittest.main()
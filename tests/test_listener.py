@@ -0,0 +1,106 @@
+import importlib
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from src.common.listener import ListenerCommon
+from src.local.harness import FakeSpotify
+
+spotifylistener = importlib.import_module('src.lambda.spotifylistener')
+
+
+def update_listened_to_durations_baseline(playtracks_df: pd.DataFrame, current_timestamp_ms: int) -> pd.DataFrame:
+    """
+    Calculates the listened time of each play with the row-by-row loop the vectorized calculation replaced, going from
+    the most recent play back. Plays at the same time are visited in reverse order of the input, so that the play
+    listed last is the one followed by the next play.
+    """
+    playtracks_df = playtracks_df.sort_values(ListenerCommon.TIMESTAMP[0], kind='mergesort').iloc[::-1]
+
+    listened_ms_list = []
+    more_recent_timestamp_ms = current_timestamp_ms
+    for _, row in playtracks_df.iterrows():
+        track_duration_ms = row[ListenerCommon.TRACK_DURATION[0]]
+        played_at_timestamp_ms = int(row[ListenerCommon.TIMESTAMP[0]] * 1000)
+        if (more_recent_timestamp_ms - played_at_timestamp_ms) > track_duration_ms:
+            listened_ms_list.append(ListenerCommon.LISTENED_TIME[1](track_duration_ms))
+        else:
+            listened_ms_list.append(ListenerCommon.LISTENED_TIME[1](more_recent_timestamp_ms - played_at_timestamp_ms))
+        more_recent_timestamp_ms = played_at_timestamp_ms
+
+    playtracks_df = playtracks_df.assign(**{ListenerCommon.LISTENED_TIME[0]: listened_ms_list})
+    return playtracks_df.iloc[::-1][ListenerCommon.SCHEMA]
+
+
+class TestListenerCase(unittest.TestCase):
+
+    def assert_matches_baseline(self, playtracks_df: pd.DataFrame, current_timestamp_ms: int):
+        listened_df = spotifylistener.update_listened_to_durations(playtracks_df, current_timestamp_ms)
+        expected_df = update_listened_to_durations_baseline(playtracks_df, current_timestamp_ms)
+        pd.testing.assert_frame_equal(listened_df.reset_index(drop=True), expected_df.reset_index(drop=True),
+                                      check_dtype=False)
+        self.assertTrue(listened_df[ListenerCommon.TIMESTAMP[0]].is_monotonic_increasing)
+        return listened_df
+
+    def test_listened_time_matches_baseline(self):
+        rng = np.random.default_rng(5)
+        played_at_ms = 1_760_000_000_000 + np.cumsum(rng.integers(0, 6 * 60 * 1000, 200))
+        # Some plays share their timestamp with the play before them, of the same or another track
+        played_at_ms[50:53] = played_at_ms[49]
+        playtracks_df = pd.DataFrame({
+            ListenerCommon.TIMESTAMP[0]: played_at_ms / 1000,
+            ListenerCommon.TRACK_ID[0]: [f"track{num}" for num in rng.integers(0, 40, 200)],
+            ListenerCommon.LISTENED_TIME[0]: np.nan,
+            ListenerCommon.TRACK_DURATION[0]: rng.integers(60 * 1000, 5 * 60 * 1000, 200),
+        })
+        playtracks_df.loc[51, ListenerCommon.TRACK_ID[0]] = playtracks_df.loc[50, ListenerCommon.TRACK_ID[0]]
+        shuffled_df = playtracks_df.sample(frac=1, random_state=3)
+
+        # The last play is cut short by the query time, or listened to entirely well before it
+        last_play_ms = int(played_at_ms[-1])
+        last_duration_ms = int(playtracks_df[ListenerCommon.TRACK_DURATION[0]].iloc[-1])
+        for current_timestamp_ms in (last_play_ms + last_duration_ms // 2, last_play_ms + 10 * last_duration_ms):
+            listened_df = self.assert_matches_baseline(shuffled_df, current_timestamp_ms)
+            self.assertEqual(listened_df[ListenerCommon.LISTENED_TIME[0]].iloc[-1],
+                             min(current_timestamp_ms - last_play_ms, last_duration_ms))
+
+        # Only the last of the plays at the same time is followed by the next play
+        listened_df = spotifylistener.update_listened_to_durations(playtracks_df, last_play_ms)
+        self.assertEqual(listened_df[ListenerCommon.LISTENED_TIME[0]].iloc[49:52].tolist(), [0, 0, 0])
+
+        # A single play is only bounded by the query time
+        self.assert_matches_baseline(playtracks_df.iloc[[7]], int(played_at_ms[7]) + 1000)
+
+    def test_playback_records_stop_at_the_end_of_the_window(self):
+        spotify = FakeSpotify(num_plays=130, seed=2)
+        played_at_ms = spotify.played_at_ms
+
+        # Pages reaching past the end of the window are the last queried, and plays at its end are included
+        records = list(spotifylistener.iterate_playback_records(spotify, int(played_at_ms[0]) - 1,
+                                                                int(played_at_ms[60])))
+        self.assertEqual([int(round(record[ListenerCommon.TIMESTAMP[0]] * 1000)) for record in records],
+                         sorted(played_at_ms[:50].tolist(), reverse=True) +
+                         sorted(played_at_ms[50:61].tolist(), reverse=True))
+        self.assertEqual(spotify.request_counts['playback_recently_played'], 2)
+
+        # The play at the start of the window is left out
+        records = list(spotifylistener.iterate_playback_records(spotify, int(played_at_ms[10]),
+                                                                int(played_at_ms[20])))
+        self.assertEqual(len(records), 10)
+        self.assertEqual(spotify.request_counts['playback_recently_played'], 3)
+
+    def test_playback_records_stop_at_max_pages(self):
+        spotify = FakeSpotify(num_plays=130, seed=2)
+        records = list(spotifylistener.iterate_playback_records(spotify, 0, max_pages=2))
+        self.assertEqual(len(records), 2 * spotifylistener.RECENTLY_PLAYED_PAGE_SIZE)
+        self.assertEqual(spotify.request_counts['playback_recently_played'], 2)
+
+        # Without max_pages, pages are queried until there are no more plays
+        records = list(spotifylistener.iterate_playback_records(spotify, 0))
+        self.assertEqual(len(records), 130)
+        self.assertEqual(spotify.request_counts['playback_recently_played'], 2 + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
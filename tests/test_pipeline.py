@@ -0,0 +1,256 @@
+import importlib
+import time
+import unittest
+from unittest import mock
+from datetime import datetime, timezone
+import pandas as pd
+
+from src.common import compaction
+from src.common import soundprintutils
+from src.common.joiner import JoinerCommon
+from src.common.listener import ListenerCommon
+from src.common.tracker import TrackerCommon
+from src.common.albumer import AlbumerCommon
+from src.common.artister import ArtisterCommon
+from src.local.harness import FakeSpotify, OfflineTestCase
+
+spotifypipeline = importlib.import_module('src.lambda.spotifypipeline')
+spotifycompactor = importlib.import_module('src.lambda.spotifycompactor')
+spotifyjoiner = importlib.import_module('src.lambda.spotifyjoiner')
+spotifylistener = importlib.import_module('src.lambda.spotifylistener')
+spotifyrdsarchiver = importlib.import_module('src.lambda.archiver.spotifyrdsarchiver')
+
+
+class TestPipelineCase(OfflineTestCase):
+
+    def test_pipeline_archives_all_plays(self):
+        spotify = FakeSpotify(num_plays=120, seed=7)
+        with self.offline_environment(spotify) as environment:
+            joined_df = spotifypipeline.run_pipeline(spotify, spotify.start_timestamp_ms - 1,
+                                                     spotify.end_timestamp_ms, environment.rds_data)
+
+            archived_rows = environment.rds_data.query(
+                f"SELECT COUNT(*), COUNT(DISTINCT PLAYED_AT) FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            self.assertEqual(archived_rows[0][0], joined_df.shape[0])
+            self.assertEqual(archived_rows[0][1], 120)
+
+            # Re-running over the same window upserts the same rows, and serves all metadata from the caches
+            request_counts = dict(spotify.request_counts)
+            spotifypipeline.run_pipeline(spotify, spotify.start_timestamp_ms - 1, spotify.end_timestamp_ms,
+                                         environment.rds_data)
+            archived_rows = environment.rds_data.query(
+                f"SELECT COUNT(*) FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            self.assertEqual(archived_rows[0][0], joined_df.shape[0])
+            self.assertEqual(spotify.request_counts['tracks'], request_counts['tracks'])
+            self.assertEqual(spotify.request_counts['albums'], request_counts['albums'])
+
+    def test_state_machine_matches_pipeline(self):
+        spotify = FakeSpotify(num_plays=15, seed=3)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            self.assertTrue(state['data'].startswith('history/data/'))
+            staged_rows = environment.rds_data.query(
+                f"SELECT * FROM {soundprintutils.AURORA_HISTORY_TABLE} ORDER BY 1, 2, 3, 4, 5")
+
+            environment.rds_data.query(f"DELETE FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            spotifypipeline.run_pipeline(spotify, spotify.end_timestamp_ms - 3600*1000, spotify.end_timestamp_ms,
+                                         environment.rds_data)
+            fused_rows = environment.rds_data.query(
+                f"SELECT * FROM {soundprintutils.AURORA_HISTORY_TABLE} ORDER BY 1, 2, 3, 4, 5")
+
+            self.assertGreater(len(staged_rows), 0)
+            self.assertEqual(len(staged_rows), len(fused_rows))
+
+    def test_stage_files_are_read_with_compact_dtypes(self):
+        spotify = FakeSpotify(num_plays=20, seed=8)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = soundprintutils.download_df_from_s3(state['data'], JoinerCommon.TYPED_SCHEMA)
+            self.assertEqual(joined_df[JoinerCommon.TRACK_KEY[0]].dtype, 'int8')
+            self.assertEqual(joined_df[JoinerCommon.TRACK_ENERGY[0]].dtype, 'float32')
+            self.assertEqual(joined_df[JoinerCommon.ARTIST_GENRE[0]].dtype, 'category')
+            self.assertEqual(joined_df[JoinerCommon.LISTEN_TIMESTAMP[0]].dtype, 'float64')
+
+            # Features are archived as they were read, without the noise of widening float32 to float64
+            archived_energies = environment.rds_data.query(
+                f"SELECT DISTINCT TRACK_ENERGY FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            self.assertEqual(sorted(energy for energy, in archived_energies),
+                             sorted(float(str(energy)) for energy in joined_df[JoinerCommon.TRACK_ENERGY[0]].unique()))
+
+    def test_compact_join_expands_to_wide_join(self):
+        spotify = FakeSpotify(num_plays=40, seed=17)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            stage_dfs = [soundprintutils.download_df_from_s3(state[stage], typed_schema) for stage, typed_schema in [
+                ('listening', ListenerCommon.TYPED_SCHEMA), ('tracks', TrackerCommon.TYPED_SCHEMA),
+                ('albums', AlbumerCommon.TYPED_SCHEMA), ('artists', ArtisterCommon.TYPED_SCHEMA)]]
+            wide_df = spotifyjoiner.join_dataframes(*stage_dfs)
+            compact_df = spotifyjoiner.join_compact_dataframes(*stage_dfs)
+            self.assertEqual(compact_df.shape[0], stage_dfs[0].shape[0])
+
+            # Rows are compared as strings, in a canonical order, as their order within a play may differ
+            def canonical_rows(df: pd.DataFrame) -> pd.DataFrame:
+                return df.astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+            expanded_df = spotifyjoiner.expand_compact_rows(compact_df)
+            self.assertEqual(list(expanded_df.columns), JoinerCommon.SCHEMA)
+            pd.testing.assert_frame_equal(canonical_rows(expanded_df), canonical_rows(wide_df))
+
+    def test_compressed_files_are_streamed_in_chunks(self):
+        spotify = FakeSpotify(num_plays=60, seed=4)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            joined_df = soundprintutils.download_df_from_s3(state['data'], JoinerCommon.TYPED_SCHEMA)
+            chunk_rows = joined_df.shape[0] // 3 + 1
+
+            for file_name in ('streamed/joined.csv.gz', 'streamed/joined.csv.zst', 'streamed/joined.parquet'):
+                df_chunks = (joined_df[start:start + chunk_rows] for start in range(0, joined_df.shape[0], chunk_rows))
+                with mock.patch.object(soundprintutils, 'S3_MULTIPART_THRESHOLD_BYTES', 1024), \
+                        mock.patch.object(soundprintutils, 'S3_SPOOL_MAX_BYTES', 1024):
+                    soundprintutils.upload_df_chunks_to_s3(df_chunks, False, file_name, JoinerCommon.TYPED_SCHEMA)
+
+                read_chunks = list(soundprintutils.iter_df_chunks_from_s3(file_name, JoinerCommon.TYPED_SCHEMA,
+                                                                          chunk_rows))
+                self.assertEqual([df.shape[0] for df in read_chunks],
+                                 [len(range(start, min(start + chunk_rows, joined_df.shape[0])))
+                                  for start in range(0, joined_df.shape[0], chunk_rows)])
+                read_df = soundprintutils.download_df_from_s3(file_name, JoinerCommon.TYPED_SCHEMA)
+                pd.testing.assert_frame_equal(read_df, joined_df, check_dtype=False, check_categorical=False)
+
+            self.assertEqual(environment.s3.request_counts['create_multipart_upload'], 3)
+            with open(environment.s3.get_file_path(soundprintutils.S3_BUCKET, 'streamed/joined.csv.gz'), 'rb') as f:
+                self.assertEqual(f.read(2), b'\x1f\x8b')
+
+    def test_listener_triggers_aurora_wakeup(self):
+        spotify = FakeSpotify(num_plays=20, seed=8)
+        with self.offline_environment(spotify) as environment:
+            environment.rds_data.pause(resume_secs=0.2)
+            self.assertIsNotNone(spotifylistener.lambda_handler({}, None))
+            self.assertEqual(environment.rds_data.request_counts['communications_link_failure'], 1)
+
+            # The cluster resumes while the downstream stages run, so the archiver does not wait for it
+            time.sleep(0.2)
+            self.assertLess(spotifyrdsarchiver.wakeup_serverless(environment.rds_data), 0.5)
+            self.assertEqual(environment.rds_data.request_counts['communications_link_failure'], 1)
+
+            # No wake-up is triggered if there are no plays to archive
+            environment.rds_data.pause(resume_secs=0.2)
+            soundprintutils.advance_listening_cursor(spotify.end_timestamp_ms)
+            self.assertIsNone(spotifylistener.lambda_handler({}, None))
+            self.assertEqual(environment.rds_data.request_counts['communications_link_failure'], 1)
+
+    def test_users_pipeline_deduplicates_metadata(self):
+        spotify = FakeSpotify(num_plays=0)
+        user_spotifies = {'alice': FakeSpotify(num_plays=80, num_tracks=40, seed=1),
+                          'bob': FakeSpotify(num_plays=80, num_tracks=40, seed=2)}
+        with self.offline_environment(spotify, user_spotifies=user_spotifies) as environment:
+            end_timestamp_ms = max(spotify.end_timestamp_ms for spotify in user_spotifies.values())
+            archived_counts = spotifypipeline.lambda_handler({'after_timestamp_ms': 0,
+                                                              'before_timestamp_ms': end_timestamp_ms}, None)
+
+            self.assertEqual(archived_counts, {'None': 0, 'alice': archived_counts['alice'],
+                                               'bob': archived_counts['bob']})
+            for user_id in user_spotifies:
+                history_table_name = soundprintutils.get_user_table_name(soundprintutils.AURORA_HISTORY_TABLE, user_id)
+                archived_plays = environment.rds_data.query(
+                    f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {history_table_name}")
+                self.assertEqual(archived_plays[0][0], 80)
+
+            # Tracks played by both users are queried once, with the first account's client
+            self.assertEqual(spotify.request_counts['tracks'], 1)
+            self.assertEqual(user_spotifies['alice'].request_counts['tracks'], 0)
+            self.assertEqual(user_spotifies['bob'].request_counts['tracks'], 0)
+
+    def test_original_account_and_users_are_archived_in_one_run(self):
+        # Few enough plays that they all fall in the hour queried for an account without a cursor
+        spotify = FakeSpotify(num_plays=8, seed=9)
+        user_spotifies = {'alice': FakeSpotify(num_plays=6, seed=10), 'bob': FakeSpotify(num_plays=7, seed=11)}
+        num_plays = {None: 8, 'alice': 6, 'bob': 7}
+        with self.offline_environment(spotify, user_spotifies=user_spotifies) as environment:
+            states = environment.run_users_state_machine()
+            self.assertEqual(len(states), 3)
+            self.assertTrue(all(state['data'] is not None for state in states))
+
+            archived_plays = {}
+            for user_id in num_plays:
+                history_table_name = soundprintutils.get_user_table_name(soundprintutils.AURORA_HISTORY_TABLE, user_id)
+                archived_plays[user_id] = environment.rds_data.query(
+                    f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {history_table_name}")[0][0]
+                environment.rds_data.query(f"DELETE FROM {history_table_name}")
+            self.assertEqual(archived_plays, num_plays)
+
+            # The fused pipeline processes the same accounts, from before their cursors
+            archived_counts = spotifypipeline.lambda_handler({'after_timestamp_ms': 0}, None)
+            self.assertEqual(set(archived_counts), {'None', 'alice', 'bob'})
+            for user_id in num_plays:
+                history_table_name = soundprintutils.get_user_table_name(soundprintutils.AURORA_HISTORY_TABLE, user_id)
+                self.assertEqual(environment.rds_data.query(
+                    f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {history_table_name}")[0][0], num_plays[user_id])
+
+    def test_cursor_skips_archived_plays(self):
+        spotify = FakeSpotify(num_plays=30, seed=5)
+        with self.offline_environment(spotify) as environment:
+            state = environment.run_state_machine()
+            self.assertIsNotNone(state['listening'])
+            archived_plays = environment.rds_data.query(
+                f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {soundprintutils.AURORA_HISTORY_TABLE}")[0][0]
+            self.assertEqual(soundprintutils.get_listening_cursor(), spotify.end_timestamp_ms)
+
+            # Without new plays since the cursor, neither run does any work after querying the listening history
+            request_counts = dict(spotify.request_counts)
+            self.assertIsNone(environment.run_state_machine()['listening'])
+            self.assertEqual(spotifypipeline.lambda_handler(None, None), {'None': 0})
+            self.assertEqual(spotify.request_counts['playback_recently_played'],
+                             request_counts['playback_recently_played'] + 2)
+            self.assertEqual(sum(spotify.request_counts.values()), sum(request_counts.values()) + 2)
+            self.assertEqual(environment.rds_data.query(
+                f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {soundprintutils.AURORA_HISTORY_TABLE}")[0][0], archived_plays)
+
+    def test_compaction_partitions_plays_by_date(self):
+        # Plays up to shortly after midnight, so that the file written at the end holds plays of both days
+        end_timestamp_ms = int(datetime(2026, 10, 18, 0, 20, tzinfo=timezone.utc).timestamp() * 1000)
+        spotify = FakeSpotify(num_plays=40, end_timestamp_ms=end_timestamp_ms, seed=11)
+        with self.offline_environment(spotify) as environment:
+            joined_df = spotifypipeline.run_pipeline(spotify, spotify.start_timestamp_ms - 1, end_timestamp_ms + 1,
+                                                     environment.rds_data, write_intermediate_files=True)
+
+            partition_row_counts = spotifycompactor.lambda_handler({'date': '2026-10-18'}, None)['None']
+            self.assertEqual(set(partition_row_counts), {'2026-10-17', '2026-10-18'})
+            self.assertEqual(sum(partition_row_counts.values()), joined_df.shape[0])
+
+            # Compacting the same files again leaves the partitions as they are
+            self.assertEqual(spotifycompactor.lambda_handler({'date': '2026-10-18'}, None)['None'],
+                             partition_row_counts)
+
+            manifest = compaction.load_manifest()
+            history_df = compaction.read_history_range(0, end_timestamp_ms / 1000, manifest=manifest)
+            self.assertEqual(history_df.shape[0], joined_df.shape[0])
+            self.assertEqual(history_df['PLAYED_AT'].nunique(), 40)
+
+            # Only the partition of the last day overlaps a range after midnight
+            midnight_timestamp = datetime(2026, 10, 18, tzinfo=timezone.utc).timestamp()
+            self.assertEqual(len(compaction.get_overlapping_partitions(manifest, midnight_timestamp,
+                                                                       end_timestamp_ms / 1000)), 1)
+            history_df = compaction.read_history_range(midnight_timestamp, end_timestamp_ms / 1000, manifest=manifest)
+            self.assertEqual(history_df.shape[0], partition_row_counts['2026-10-18'])
+
+    def test_fused_pipeline_history_is_compacted(self):
+        end_timestamp_ms = int(datetime(2026, 10, 18, 9, 30, tzinfo=timezone.utc).timestamp() * 1000)
+        spotify = FakeSpotify(num_plays=12, end_timestamp_ms=end_timestamp_ms, seed=12)
+        user_spotifies = {'alice': FakeSpotify(num_plays=9, end_timestamp_ms=end_timestamp_ms, seed=13)}
+        with self.offline_environment(spotify, user_spotifies=user_spotifies) as environment:
+            # Intermediate files are not written by default, yet the joined files are still there to compact
+            archived_counts = spotifypipeline.lambda_handler(
+                {'after_timestamp_ms': 0, 'before_timestamp_ms': end_timestamp_ms + 1}, None)
+            self.assertEqual(soundprintutils.list_s3_keys(ListenerCommon.FILE_PATH_PREFIX), [])
+
+            partition_row_counts = spotifycompactor.lambda_handler({'date': '2026-10-18'}, None)
+            self.assertEqual({user_id: sum(row_counts.values())
+                              for user_id, row_counts in partition_row_counts.items()}, archived_counts)
+
+            for user_id, num_plays in ((None, 12), ('alice', 9)):
+                history_df = compaction.read_history_range(0, end_timestamp_ms / 1000, user_id)
+                self.assertEqual(history_df['PLAYED_AT'].nunique(), num_plays)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import tekore as tk
+
+from src.common import soundprintutils
+from src.common import spotifyscheduler
+from src.common.spotifyscheduler import ScheduledSpotify, SpotifyScheduler
+from src.local.harness import FakeSpotify, OfflineTestCase
+
+
+class TestSpotifySchedulerCase(OfflineTestCase):
+
+    def test_throttled_requests_pause_all_workers(self):
+        spotify = FakeSpotify(num_plays=200, num_tracks=200, throttle_every=4, retry_after_secs=0.2)
+        scheduler = SpotifyScheduler(requests_per_sec=1000, burst_requests=1000, retry_jitter_secs=0.0)
+        scheduled_spotify = ScheduledSpotify(spotify, scheduler)
+        track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(200)]
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            chunks = list(executor.map(scheduled_spotify.tracks, [track_ids[i:i + 20] for i in range(0, 200, 20)]))
+        elapsed_secs = time.monotonic() - start
+
+        # Every chunk is fetched despite the throttling, waiting out the Retry-After of each throttled request
+        self.assertEqual([track.id for chunk in chunks for track in chunk], track_ids)
+        counters = scheduler.get_counters()
+        self.assertEqual(counters['calls'], 10)
+        self.assertEqual(counters['throttled'], spotify.request_counts['throttled'])
+        self.assertEqual(counters['retries'], counters['throttled'])
+        self.assertEqual(counters['requests'], 10 + counters['retries'])
+        self.assertGreaterEqual(counters['throttled'], 3)
+        self.assertGreaterEqual(elapsed_secs, 0.2 * counters['throttled'] - 0.05)
+        self.assertLess(scheduler.token_bucket.rate, 1000)
+
+    def test_duplicate_lookups_are_coalesced(self):
+        spotify = FakeSpotify(num_tracks=10, latency_secs=0.2)
+        scheduler = SpotifyScheduler(requests_per_sec=1000, burst_requests=1000)
+        track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(10)]
+
+        barrier = threading.Barrier(3)
+
+        def get_tracks(_):
+            barrier.wait()
+            return ScheduledSpotify(spotify, scheduler).tracks(list(track_ids))
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(get_tracks, range(3)))
+
+        self.assertEqual(spotify.request_counts['tracks'], 1)
+        self.assertTrue(all(track is first_track
+                            for result in results for track, first_track in zip(result, results[0])))
+        self.assertEqual(scheduler.get_counters()['coalesced'], 20)
+
+        # Lookups made once the others are done are requested again
+        ScheduledSpotify(spotify, scheduler).tracks(track_ids[:5])
+        self.assertEqual(spotify.request_counts['tracks'], 2)
+
+    def test_overlapping_lookups_request_only_new_ids(self):
+        spotify = FakeSpotify(num_tracks=20, latency_secs=0.2)
+        scheduler = SpotifyScheduler(requests_per_sec=1000, burst_requests=1000)
+        track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(20)]
+
+        with mock.patch.object(spotify, 'tracks', wraps=spotify.tracks) as tracks:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                first_future = executor.submit(ScheduledSpotify(spotify, scheduler).tracks, track_ids[:10])
+                time.sleep(0.05)
+                # The ids of the first lookup still in flight wait for it, as does the lookup of a single id
+                second_future = executor.submit(ScheduledSpotify(spotify, scheduler).tracks, track_ids[5:15])
+                single_future = executor.submit(ScheduledSpotify(spotify, scheduler).track, track_ids[2])
+                first_tracks, second_tracks = first_future.result(), second_future.result()
+
+            self.assertEqual([call.args[0] for call in tracks.call_args_list], [track_ids[:10], track_ids[10:15]])
+        self.assertEqual([track.id for track in second_tracks], track_ids[5:15])
+        self.assertTrue(all(track is first_track for track, first_track in zip(second_tracks, first_tracks[5:])))
+        self.assertIs(single_future.result(), first_tracks[2])
+        self.assertEqual(spotify.request_counts['track'], 0)
+        self.assertEqual(scheduler.get_counters()['coalesced'], 6)
+
+    def test_retry_after_past_the_deadline_is_raised(self):
+        spotify = FakeSpotify(num_tracks=10, throttle_every=1, retry_after_secs=5)
+        scheduler = SpotifyScheduler(requests_per_sec=1000, burst_requests=1000, retry_jitter_secs=0.0)
+        track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(10)]
+
+        # A Retry-After that leaves too little of the invocation to finish it is not waited out
+        remaining_ms = (spotifyscheduler.DEADLINE_RESERVE_SECS + 3) * 1000
+        context = SimpleNamespace(get_remaining_time_in_millis=lambda: remaining_ms)
+        scheduler.set_deadline(spotifyscheduler.get_remaining_secs(context))
+        start = time.monotonic()
+        with self.assertRaises(tk.TooManyRequests):
+            ScheduledSpotify(spotify, scheduler).tracks(track_ids)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(spotify.request_counts['throttled'], 1)
+
+        # Without a deadline, it is waited out as long as it is below MAX_RETRY_AFTER_SECS
+        scheduler.set_deadline(None)
+        self.assertEqual(scheduler.get_max_retry_after_secs(), spotifyscheduler.MAX_RETRY_AFTER_SECS)
+
+    def test_throttles_are_shared_across_processes(self):
+        with self.offline_environment():
+            # Schedulers of two stages running at the same time, each with its own client
+            throttled_spotify = FakeSpotify(num_tracks=10, throttle_every=1, retry_after_secs=0.5)
+            other_spotify = FakeSpotify(num_tracks=10)
+            throttled_scheduler, other_scheduler = [
+                SpotifyScheduler(requests_per_sec=1000, burst_requests=1000, max_retries=0, retry_jitter_secs=0.0,
+                                 share_throttles=True, sync_secs=0.0) for _ in range(2)]
+            track_ids = [FakeSpotify.entity_id('t', track_num) for track_num in range(10)]
+
+            with self.assertRaises(tk.TooManyRequests):
+                ScheduledSpotify(throttled_spotify, throttled_scheduler).tracks(track_ids)
+            self.assertGreater(soundprintutils.get_spotify_throttled_until_ms(), time.time() * 1000)
+
+            # The other stage waits out the Retry-After of the throttled one, and lowers its rate, but only once
+            start = time.monotonic()
+            ScheduledSpotify(other_spotify, other_scheduler).tracks(track_ids)
+            self.assertGreaterEqual(time.monotonic() - start, 0.4)
+            self.assertEqual(other_scheduler.get_counters()['shared_throttled'], 1)
+            self.assertLess(other_scheduler.token_bucket.rate, 1000)
+            ScheduledSpotify(other_spotify, other_scheduler).tracks(track_ids)
+            self.assertEqual(other_scheduler.get_counters()['shared_throttled'], 1)
+
+            # A stage does not pause for its own throttle twice, nor for throttles that have passed
+            self.assertNotIn('shared_throttled', throttled_scheduler.get_counters())
+            new_scheduler = SpotifyScheduler(share_throttles=True)
+            time.sleep(0.1)
+            ScheduledSpotify(other_spotify, new_scheduler).tracks(track_ids)
+            self.assertNotIn('shared_throttled', new_scheduler.get_counters())
+
+    def test_stages_survive_throttling(self):
+        spotify = FakeSpotify(num_plays=120, seed=6, throttle_every=3)
+        with self.offline_environment(spotify) as environment:
+            spotifyscheduler.get_scheduler().retry_jitter_secs = 0.0
+            state = environment.run_state_machine()
+            archived_rows = environment.rds_data.query(
+                f"SELECT COUNT(DISTINCT PLAYED_AT) FROM {soundprintutils.AURORA_HISTORY_TABLE}")
+            self.assertIsNotNone(state['data'])
+            self.assertGreater(archived_rows[0][0], 0)
+            self.assertGreater(spotify.request_counts['throttled'], 0)
+            self.assertEqual(spotifyscheduler.get_scheduler().get_counters()['throttled'],
+                             spotify.request_counts['throttled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import importlib
+import threading
+import unittest
+from types import SimpleNamespace
+from typing import List
+
+from src.common.tracker import TrackerCommon
+
+spotifytracker = importlib.import_module('src.lambda.spotifytracker')
+
+
+class ChunkRecordingSpotify:
+    """
+    Stands in for the Spotify client's track queries, answering each from the track-ids alone and recording the
+    track-ids of every request it is sent
+    """
+
+    def __init__(self):
+        self.requested_ids = {'tracks': [], 'tracks_audio_features': []}
+        self.lock = threading.Lock()
+
+    def record(self, query: str, track_ids: List[str]):
+        with self.lock:
+            self.requested_ids[query].append(list(track_ids))
+
+    def tracks(self, track_ids: List[str], **kwargs) -> List[SimpleNamespace]:
+        self.record('tracks', track_ids)
+        return [SimpleNamespace(id=track_id, album=SimpleNamespace(id=f"album-{track_id}"),
+                                duration_ms=1000 * int(track_id[1:]), name=f"Track {track_id}", popularity=50,
+                                explicit=False, artists=[SimpleNamespace(id=f"artist-{track_id}")])
+                for track_id in track_ids]
+
+    def tracks_audio_features(self, track_ids: List[str], **kwargs) -> List[SimpleNamespace]:
+        self.record('tracks_audio_features', track_ids)
+        return [SimpleNamespace(id=track_id, acousticness=0.5, danceability=0.5, energy=0.5,
+                                instrumentalness=0.5, key=int(track_id[1:]) % 12, liveness=0.5, loudness=-5.0,
+                                mode=1, speechiness=0.5, tempo=120.0, time_signature=4, valence=0.5)
+                for track_id in track_ids]
+
+
+class TestTrackerCase(unittest.TestCase):
+
+    def test_tracks_are_fetched_in_chunks(self):
+        spotify = ChunkRecordingSpotify()
+        track_ids = [f"t{track_num}" for track_num in range(120)]
+        tracks_df = spotifytracker.fetch_tracks_data(spotify, track_ids, max_concurrency=4)
+
+        # Each query is sent in chunks of the most ids Spotify accepts for it, covering every track once
+        tracks_chunks = sorted(spotify.requested_ids['tracks'], key=lambda chunk: int(chunk[0][1:]))
+        self.assertEqual([len(chunk) for chunk in tracks_chunks], [50, 50, 20])
+        self.assertEqual(sum(tracks_chunks, []), track_ids)
+        audio_features_chunks = sorted(spotify.requested_ids['tracks_audio_features'],
+                                       key=lambda chunk: int(chunk[0][1:]))
+        self.assertEqual([len(chunk) for chunk in audio_features_chunks], [100, 20])
+        self.assertEqual(sum(audio_features_chunks, []), track_ids)
+
+        # The chunks are gathered back in order, so each track is matched with its own metadata and audio-features
+        self.assertEqual(tracks_df[TrackerCommon.TRACK_ID[0]].tolist(), track_ids)
+        self.assertEqual(tracks_df[TrackerCommon.DURATION_MS[0]].tolist(), [1000 * num for num in range(120)])
+        self.assertEqual(tracks_df[TrackerCommon.KEY[0]].tolist(), [num % 12 for num in range(120)])
+        self.assertEqual(tracks_df[TrackerCommon.ARTIST_ID[0]].tolist(),
+                         [f"artist-{track_id}" for track_id in track_ids])
+
+
+if __name__ == '__main__':
+    unittest.main()